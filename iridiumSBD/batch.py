@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized decoding of many ISBD messages at once.
+
+Reprocessing an archive with IridiumSBD means one Python object per
+message. Instead, decode_batch() takes all the messages concatenated in a
+single buffer, plus the offset where each one starts, and decodes the
+header and location of all of them with NumPy, walking the IEs of every
+message simultaneously.
+
+IridiumSBD remains the reference implementation, decode_batch() must give
+the same values.
+
+This module requires NumPy, which is an optional dependency.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+HEADER_DTYPE = [
+    ('CDR_reference', 'u4'),
+    ('IMEI', 'S15'),
+    ('session_status', 'u1'),
+    ('MOMSN', 'u2'),
+    ('MTMSN', 'u2'),
+    ('session_epoch', 'u4'),
+    ('session_datetime', 'datetime64[s]'),
+    ]
+
+LOCATION_DTYPE = [
+    ('orient', 'u1'),
+    ('lat_deg', 'u1'),
+    ('lat_min', 'f8'),
+    ('lon_deg', 'u1'),
+    ('lon_min', 'f8'),
+    ('CEP_radius', 'u4'),
+    ('latitude', 'f8'),
+    ('longitude', 'f8'),
+    ]
+
+# Content size of the fixed size IEs
+MO_HEADER_LENGTH = 28
+MO_LOCATION_LENGTH = 11
+
+
+def concatenate(messages):
+    """Join a sequence of binary messages into (buffer, offsets)"""
+    if np is None:
+        raise ImportError("decode_batch requires NumPy")
+    sizes = np.fromiter((len(m) for m in messages), dtype='i8',
+                        count=len(messages))
+    offsets = np.zeros(len(messages), dtype='i8')
+    np.cumsum(sizes[:-1], out=offsets[1:])
+    return b''.join(messages), offsets
+
+
+def _uint(buf, pos, nbytes):
+    """Big endian unsigned integers of nbytes starting at each pos"""
+    output = np.zeros(len(pos), dtype='u8')
+    for i in range(nbytes):
+        output <<= 8
+        output |= buf[pos + i]
+    return output
+
+
+def decode_batch(buffer, offsets=None):
+    """Decode the header and location of many messages at once
+
+    Args:
+        buffer: Concatenated binary messages (bytes, bytearray, memoryview
+            or uint8 array), or a list of messages.
+        offsets: Where each message starts in buffer. Each message ends
+            where the next one starts, the last one at the end of buffer.
+            Not required if buffer is a list.
+
+    Returns:
+        dict with:
+            header: Structured array with the MO header (HEADER_DTYPE).
+            location: Structured array with the MO location, including
+                latitude and longitude (LOCATION_DTYPE).
+            has_header, has_location: Boolean masks, since not every
+                message has those IEs. Masked values are zero.
+            payload_offset, payload_length: Where the payload of each
+                message is in buffer (offset -1 if no payload).
+    """
+    if np is None:
+        raise ImportError("decode_batch requires NumPy")
+
+    if isinstance(buffer, (list, tuple)):
+        buffer, offsets = concatenate(buffer)
+    buf = np.frombuffer(buffer, dtype='u1')
+    starts = np.asarray(offsets, dtype='i8')
+    n = len(starts)
+    ends = np.empty(n, dtype='i8')
+    ends[:-1] = starts[1:]
+    ends[-1:] = len(buf)
+
+    # Walk the IEs of all messages in parallel, one IE per iteration
+    header_pos = np.full(n, -1, dtype='i8')
+    location_pos = np.full(n, -1, dtype='i8')
+    payload_pos = np.full(n, -1, dtype='i8')
+    pos = starts + 3
+    idx = np.nonzero(pos + 3 <= ends)[0]
+    while len(idx) > 0:
+        p = pos[idx]
+        iei = buf[p]
+        length = (buf[p + 1].astype('i8') << 8) | buf[p + 2]
+        stop = p + 3 + length
+        fits = stop <= ends[idx]
+        for code, size, target in ((1, MO_HEADER_LENGTH, header_pos),
+                                   (3, MO_LOCATION_LENGTH, location_pos),
+                                   (2, None, payload_pos)):
+            found = (iei == code) & fits
+            if size is not None:
+                found &= (length >= size)
+            target[idx[found]] = p[found]
+        pos[idx] = stop
+        idx = idx[pos[idx] + 3 <= ends[idx]]
+
+    has_header = header_pos >= 0
+    has_location = location_pos >= 0
+
+    header = np.zeros(n, dtype=HEADER_DTYPE)
+    p = header_pos[has_header] + 3
+    h = header[has_header]
+    h['CDR_reference'] = _uint(buf, p, 4)
+    h['IMEI'] = buf[p[:, None] + 4 + np.arange(15)].copy().view(
+        'S15').ravel()
+    h['session_status'] = buf[p + 19]
+    h['MOMSN'] = _uint(buf, p + 20, 2)
+    h['MTMSN'] = _uint(buf, p + 22, 2)
+    h['session_epoch'] = _uint(buf, p + 24, 4)
+    h['session_datetime'] = h['session_epoch'].astype('datetime64[s]')
+    header[has_header] = h
+
+    location = np.zeros(n, dtype=LOCATION_DTYPE)
+    p = location_pos[has_location] + 3
+    loc = location[has_location]
+    loc['orient'] = buf[p]
+    loc['lat_deg'] = buf[p + 1]
+    loc['lat_min'] = _uint(buf, p + 2, 2) * 1e-3
+    loc['lon_deg'] = buf[p + 4]
+    loc['lon_min'] = _uint(buf, p + 5, 2) * 1e-3
+    loc['CEP_radius'] = _uint(buf, p + 7, 4)
+    # 0=N,E; 1=N,W; 2=S,E; 3=S,W
+    south = (loc['orient'] == 2) | (loc['orient'] == 3)
+    west = (loc['orient'] == 1) | (loc['orient'] == 3)
+    loc['latitude'] = np.where(south, -1, 1) * \
+        (loc['lat_deg'] + loc['lat_min'] / 60.)
+    loc['longitude'] = np.where(west, -1, 1) * \
+        (loc['lon_deg'] + loc['lon_min'] / 60.)
+    location[has_location] = loc
+
+    payload_length = np.zeros(n, dtype='i8')
+    has_payload = payload_pos >= 0
+    payload_length[has_payload] = _uint(
+        buf, payload_pos[has_payload] + 1, 2)
+    payload_offset = np.where(has_payload, payload_pos + 3, -1)
+
+    return {'header': header,
+            'location': location,
+            'has_header': has_header,
+            'has_location': has_location,
+            'payload_offset': payload_offset,
+            'payload_length': payload_length}
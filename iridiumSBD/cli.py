@@ -10,14 +10,28 @@ that it still requires Python installed in the running machine.
 #    python directip --loglevel=info --logfile=/var/log/directip listen \
 #            --host=localhost --port=10800
 
+import json
 import os
 import logging
 import logging.handlers
+from tempfile import TemporaryDirectory
 
 import click
 
 from .iridiumSBD import dump
-from .directip.server import runserver
+from .directip.server import runserver, InboxStorage
+from .directip.postprocessing import make_postprocessing
+from .directip.metrics import serve_metrics, TextfileExporter, \
+        AggregateRegistry, REGISTRY
+from .directip.mtqueue import MTQueue
+from .directip.dedup import DedupCache, SharedDedupCache
+from .directip.journal import GroupCommitLog
+from .directip.pubsub import Publisher, parse_address, subscribe
+from .directip.bench import MODES, make_messages, run, report, local_server
+from .store import SegmentStore, SegmentStorage, import_inbox
+from .export import export, FORMATS, message_row, as_text
+from .index import MessageIndex, IndexedStorage, rebuild
+from .watch import InboxWatcher, make_handler
 
 
 @click.group()
@@ -62,8 +76,143 @@ def main(loglevel, logfile):
         help='Directory where incomming messages are saved.')
 @click.option(
         'postProcessing', '--post-processing', type=click.STRING,
-        help='External shell command to run on received messages.')
-def listen(host, port, datadir, postProcessing, iridiumHost, iridiumPort):
+        help='External shell command, or Python callable as module:function,'
+             ' to run on received messages.')
+@click.option(
+        '--post-processing-mode', 'postProcessingMode',
+        type=click.Choice(['thread', 'process']), default='thread',
+        help='Pool used to run the post-processing.')
+@click.option(
+        '--post-processing-workers', 'postProcessingWorkers',
+        type=click.INT, default=4,
+        help='Maximum number of concurrent post-processing tasks.')
+@click.option(
+        '--post-processing-timeout', 'postProcessingTimeout',
+        type=click.FLOAT, default=60,
+        help='Timeout, in seconds, for each post-processing attempt.')
+@click.option(
+        '--post-processing-retries', 'postProcessingRetries',
+        type=click.INT, default=2,
+        help='Retries, with exponential backoff, after a failure.')
+@click.option(
+        '--backend', type=click.Choice(['threaded', 'asyncio']),
+        default='threaded',
+        help='Server implementation: one thread per connection (threaded)'
+             ' or a single event loop (asyncio).')
+@click.option(
+        '--queue-size', 'queue_size', type=click.INT, default=1024,
+        help='Maximum number of messages waiting to be saved.')
+@click.option(
+        '--queue-policy', 'queue_policy',
+        type=click.Choice(['block', 'reject', 'inline']), default='block',
+        help='What to do when the queue of messages to save is full.')
+@click.option(
+        '--writers', type=click.INT, default=1,
+        help='Number of threads saving messages.')
+@click.option(
+        '--storage', type=click.Choice(['files', 'segments', 'postgres']),
+        default='files',
+        help='Save one file per message (files), append to rotating'
+             ' segment files (segments) or insert into PostgreSQL'
+             ' (postgres).')
+@click.option(
+        '--segment-size', 'segment_size', type=click.INT,
+        default=64 * 1024**2,
+        help='Maximum size, in bytes, of each segment file.')
+@click.option(
+        '--fsync', type=click.Choice(['always', 'batch', 'interval', 'never']),
+        default='batch',
+        help='When to fsync the segment files.')
+@click.option(
+        '--postgres-dsn', 'postgres_dsn', type=click.STRING,
+        help='PostgreSQL connection string, like'
+             ' "dbname=isbd host=localhost".')
+@click.option(
+        '--postgres-table', 'postgres_table', type=click.STRING,
+        default='isbd_messages',
+        help='PostgreSQL table, created if it does not exist.')
+@click.option(
+        '--linger', type=click.FLOAT, default=0,
+        help='Seconds to wait for another message on the same connection.')
+@click.option(
+        '--metrics-port', 'metrics_port', type=click.INT, default=None,
+        help='Expose metrics over HTTP on this port (localhost only).')
+@click.option(
+        '--metrics-file', 'metrics_file', type=click.STRING, default=None,
+        help='Write metrics to this file every 15 seconds.')
+@click.option(
+        '--relay-from', 'relay_from', type=click.STRING, multiple=True,
+        help='Client IP address allowed to send MT messages to be forwarded'
+             ' to the Iridium Gateway. Can be repeated, none by default.')
+@click.option(
+        '--mt-rate', 'mt_rate', type=click.FLOAT, default=1.0,
+        help='Maximum MT messages per second sent from the MT queue.')
+@click.option(
+        '--mt-concurrency', 'mt_concurrency', type=click.INT, default=4,
+        help='Maximum MT messages from the queue waiting for confirmation.')
+@click.option(
+        '--dedup-size', 'dedup_size', type=click.INT, default=100000,
+        help='Recent messages remembered to skip the copies retransmitted'
+             ' by the gateway (0 to disable).')
+@click.option(
+        '--dedup-ttl', 'dedup_ttl', type=click.FLOAT, default=86400,
+        help='Seconds a message is remembered to detect copies.')
+@click.option(
+        '--index/--no-index', 'index', default=True,
+        help='Index the messages saved by IMEI and session time, for the'
+             ' query command (not available with postgres).')
+@click.option(
+        '--workers', type=click.INT, default=1,
+        help='Number of server processes sharing the port (SO_REUSEPORT).')
+@click.option(
+        '--read-timeout', 'read_timeout', type=click.FLOAT, default=10,
+        help='Seconds without receiving anything before closing a'
+             ' connection (0 for no limit).')
+@click.option(
+        '--session-timeout', 'session_timeout', type=click.FLOAT, default=60,
+        help='Maximum seconds of a connection (0 for no limit).')
+@click.option(
+        '--max-connections', 'max_connections', type=click.INT, default=None,
+        help='Maximum simultaneous connections of each process. No limit by'
+             ' default.')
+@click.option(
+        '--connection-policy', 'connection_policy',
+        type=click.Choice(['refuse', 'wait']), default='refuse',
+        help='Above --max-connections, close new connections right away'
+             ' or hold them until one finishes.')
+@click.option(
+        '--durable-ack/--no-durable-ack', 'durable_ack', default=False,
+        help='Sync each message to a journal before acknowledging it.')
+@click.option(
+        '--commit-interval', 'commit_interval', type=click.FLOAT,
+        default=0.002,
+        help='Maximum seconds a message waits for the journal to be synced.')
+@click.option(
+        '--commit-batch', 'commit_batch', type=click.INT, default=64,
+        help='Messages that trigger a sync of the journal right away.')
+@click.option(
+        '--publish', type=click.STRING, default=None,
+        help='Push the messages to subscribers on this Unix socket path, or'
+             ' host:port (a port alone is on 127.0.0.1).')
+@click.option(
+        '--subscriber-buffer', 'subscriber_buffer', type=click.INT,
+        default=1024,
+        help='Maximum messages waiting to be sent to each subscriber.')
+@click.option(
+        '--slow-subscriber', 'slow_subscriber',
+        type=click.Choice(['drop', 'disconnect']), default='drop',
+        help='With a full buffer, drop the oldest message or disconnect'
+             ' the subscriber.')
+def listen(host, port, datadir, postProcessing, iridiumHost, iridiumPort,
+           postProcessingMode, postProcessingWorkers, postProcessingTimeout,
+           postProcessingRetries, backend, queue_size, queue_policy, writers,
+           storage, segment_size, fsync, postgres_dsn, postgres_table,
+           linger, metrics_port, metrics_file, relay_from, mt_rate,
+           mt_concurrency,
+           dedup_size, dedup_ttl, index, workers, read_timeout,
+           session_timeout, max_connections, connection_policy,
+           durable_ack, commit_interval, commit_batch, publish,
+           subscriber_buffer, slow_subscriber):
     """ Run server to listen for transmissions
     """
     logger = logging.getLogger('DirectIP')
@@ -76,14 +225,148 @@ def listen(host, port, datadir, postProcessing, iridiumHost, iridiumPort):
         datadir = os.getcwd()
         logger.warn('Missing --datadir. Will use current directory.')
 
-    logger.debug('Calling server.')
+    # Postgres gives no location to index
+    index = index and (storage != 'postgres')
+    if (storage == 'postgres') and (postgres_dsn is None):
+        logger.critical('Missing --postgres-dsn.')
+        assert postgres_dsn is not None
+    # The journal is released once saved, but Postgres only buffers the rows
+    if durable_ack and (storage == 'postgres'):
+        logger.critical('--durable-ack is not available with Postgres.')
+        assert storage != 'postgres'
+    outbound_address = None
     if (iridiumHost is not None) and (iridiumPort is not None):
         logger.debug('Iridium server at %s:%s' % (iridiumHost, iridiumPort))
-        runserver(host, port, datadir, postProcessing,
-                  outbound_address=(iridiumHost, iridiumPort))
+        outbound_address = (iridiumHost, iridiumPort)
     else:
         logger.warn('Missing Iridium address to forward outbound messages!')
-        runserver(host, port, datadir, postProcessing)
+
+    def setup(worker):
+        """Server components that each worker process creates for itself"""
+        # Files that can't be shared by the workers get their number
+        suffix = '' if workers == 1 else '-{}'.format(worker)
+        options = {}
+        if postProcessing is not None:
+            options['postProcessing'] = make_postprocessing(
+                    postProcessing,
+                    mode=postProcessingMode,
+                    workers=postProcessingWorkers,
+                    timeout=postProcessingTimeout,
+                    retries=postProcessingRetries)
+
+        if storage == 'segments':
+            options['storage'] = SegmentStorage(
+                    datadir,
+                    worker=None if workers == 1 else worker,
+                    segment_size=segment_size,
+                    fsync=fsync)
+        elif storage == 'postgres':
+            from .directip.postgres import PostgresStorage
+            options['storage'] = PostgresStorage(
+                    postgres_dsn,
+                    table=postgres_table,
+                    spill=os.path.join(
+                        datadir, 'postgres_spill{}.csv'.format(suffix)),
+                    quarantine=os.path.join(
+                        datadir, 'postgres_rejected{}.csv'.format(suffix)))
+        else:
+            options['storage'] = InboxStorage(datadir)
+        if index:
+            options['storage'] = IndexedStorage(
+                    options['storage'],
+                    MessageIndex(os.path.join(datadir, 'index.sqlite')))
+
+        # A retransmission can reach any worker, so they share the cache
+        if (dedup_size > 0) and (workers > 1):
+            options['dedup'] = SharedDedupCache(
+                    os.path.join(datadir, 'dedup.sqlite'),
+                    dedup_size,
+                    ttl=dedup_ttl)
+        elif dedup_size > 0:
+            options['dedup'] = DedupCache(
+                    dedup_size,
+                    ttl=dedup_ttl,
+                    path=os.path.join(datadir, 'dedup.json'))
+        if durable_ack:
+            journal = os.path.join(datadir, 'journal')
+            if workers > 1:
+                journal = os.path.join(journal, 'worker{}'.format(worker))
+            options['journal'] = GroupCommitLog(
+                    journal, interval=commit_interval, max_batch=commit_batch)
+        if publish is not None:
+            address = parse_address(publish)
+            # Each worker publishes on its own socket, or the next ports
+            if (workers > 1) and isinstance(address, str):
+                address = address + suffix
+            elif workers > 1:
+                address = (address[0], address[1] + worker)
+            options['publisher'] = Publisher(
+                    address, buffer_size=subscriber_buffer,
+                    policy=slow_subscriber)
+        # A single process drains the MT queue
+        if (outbound_address is not None) and (worker == 0):
+            options['mt_queue'] = MTQueue(
+                    os.path.join(datadir, 'mt_queue.sqlite'),
+                    max_concurrent=mt_concurrency,
+                    rate=mt_rate)
+        return options
+
+    logger.debug('Calling server.')
+    options = dict(backend=backend,
+                   queue_size=queue_size,
+                   queue_policy=queue_policy,
+                   writers=writers,
+                   linger=linger,
+                   outbound_address=outbound_address,
+                   relay_from=relay_from,
+                   read_timeout=read_timeout or None,
+                   session_timeout=session_timeout or None,
+                   max_connections=max_connections,
+                   connection_policy=connection_policy)
+    if workers > 1:
+        registry = AggregateRegistry()
+        options.update(workers=workers, setup=setup, registry=registry)
+    else:
+        registry = REGISTRY
+        options.update(setup(0))
+    if metrics_port is not None:
+        serve_metrics(('127.0.0.1', metrics_port), registry)
+    if metrics_file is not None:
+        metrics_file = TextfileExporter(metrics_file, registry=registry)
+    try:
+        runserver(host, port, datadir, **options)
+    finally:
+        if metrics_file is not None:
+            metrics_file.close()
+
+
+@main.command(name='mt-send')
+@click.option(
+        '--datadir', type=click.STRING, required=True,
+        help='Data directory of the server that sends the MT queue.')
+@click.option(
+        '--hex', 'is_hex', is_flag=True,
+        help='PAYLOAD is given in hexadecimal.')
+@click.option(
+        '--priority', type=click.IntRange(1, 5), default=None,
+        help='MT priority level, 1 is the highest.')
+@click.option(
+        '--client-msg-id', 'client_msg_id', type=click.INT, default=0,
+        help='Reference returned by the gateway in the confirmation.')
+@click.argument('imei', nargs=-1, required=True)
+@click.argument('payload', type=click.STRING)
+def mt_send(datadir, is_hex, priority, client_msg_id, imei, payload):
+    """ Queue an MT message to one or more IMEIs
+    """
+    payload = bytes.fromhex(payload) if is_hex else payload.encode()
+    queue = MTQueue(os.path.join(datadir, 'mt_queue.sqlite'))
+    try:
+        for i in imei:
+            queue.put(i, payload, client_msg_id, priority=priority)
+        click.echo('Queued {} MT message(s), {} pending'.format(
+            len(imei), len(queue)))
+    finally:
+        queue.close()
 
 
 @main.command(name='dump')
@@ -95,5 +378,184 @@ def isbddump(file, imei):
     return dump(file, imei)
 
 
+@main.command(name='migrate')
+@click.option(
+        '--datadir', type=click.STRING, required=True,
+        help='Directory with the inbox/ and corrupted/ subdirectories.')
+@click.option(
+        '--segment-size', 'segment_size', type=click.INT,
+        default=64 * 1024**2,
+        help='Maximum size, in bytes, of each segment file.')
+def migrate(datadir, segment_size):
+    """ Import messages saved one per file into segment files
+    """
+    logger = logging.getLogger('DirectIP')
+    for name in ('inbox', 'corrupted'):
+        source = os.path.join(datadir, name)
+        if not os.path.isdir(source):
+            continue
+        store = SegmentStore(os.path.join(datadir, 'segments', name),
+                             segment_size=segment_size)
+        n = import_inbox(source, store)
+        store.close()
+        logger.info('Imported {} messages from {}'.format(n, source))
+
+
+@main.command(name='query')
+@click.option(
+        '--datadir', type=click.STRING, required=True,
+        help='Data directory of the server, with index.sqlite.')
+@click.option('--imei', type=click.STRING, help='IMEI of the messages.')
+@click.option('--since', type=click.DateTime(),
+              help='Session at or after this time (UTC).')
+@click.option('--until', type=click.DateTime(),
+              help='Session before this time (UTC).')
+@click.option('--limit', type=click.INT, help='Maximum number of messages.')
+def query(datadir, imei, since, until, limit):
+    """ List the location of saved messages by IMEI and session time
+    """
+    index = MessageIndex(os.path.join(datadir, 'index.sqlite'))
+    try:
+        for location, session_datetime, i, momsn in index.query(
+                imei=imei, since=since, until=until, limit=limit):
+            click.echo('{}\t{}\t{}\t{}'.format(
+                location, session_datetime, i, momsn))
+    finally:
+        index.close()
+
+
+@main.command(name='subscribe')
+@click.argument('address', type=click.STRING)
+@click.option('--imei', type=click.STRING, multiple=True,
+              help='IMEI of the messages, can be given several times.')
+def isbdsubscribe(address, imei):
+    """ Print the messages published by a server at ADDRESS as JSON lines
+
+    ADDRESS is the one given to listen --publish.
+    """
+    try:
+        for event in subscribe(parse_address(address), imeis=imei):
+            click.echo(json.dumps(event))
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command(name='watch')
+@click.option(
+        '--datadir', type=click.STRING, required=True,
+        help='Data directory of the server, with the inbox.')
+@click.option(
+        '--handler', type=click.STRING, default=None,
+        help='Command, or Python callable as module:function, for each new'
+             ' message. By default they are printed as JSON lines.')
+@click.option(
+        '--checkpoint', type=click.STRING, default=None,
+        help='Where to keep the messages already handled (default:'
+             ' DATADIR/watch.json), one for each consumer.')
+@click.option('--workers', type=click.INT, default=None,
+              help='Processes to catch up, default is one per CPU.')
+@click.option('--poll/--inotify', 'poll', default=False,
+              help='Scan the inbox every --poll-interval seconds instead of'
+                   ' using inotify.')
+@click.option('--poll-interval', 'poll_interval', type=click.FLOAT,
+              default=1.0, help='Seconds between scans when polling.')
+def isbdwatch(datadir, handler, checkpoint, workers, poll, poll_interval):
+    """ Handle each new message saved in the inbox, once
+    """
+    if handler is None:
+        def handler(isbd, filename):
+            click.echo(json.dumps(as_text(message_row(isbd, filename))))
+    else:
+        handler = make_handler(handler)
+    watcher = InboxWatcher(datadir, handler, checkpoint=checkpoint,
+                           workers=workers, poll_interval=poll_interval,
+                           use_inotify=not poll)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logging.getLogger('DirectIP').warning('User terminated watch')
+
+
+@main.command(name='reindex')
+@click.option(
+        '--datadir', type=click.STRING, required=True,
+        help='Data directory of the server.')
+@click.option('--workers', type=click.INT, default=None,
+              help='Number of processes, default is one per CPU.')
+def reindex(datadir, workers):
+    """ Rebuild the index of the messages saved in a datadir
+    """
+    index = MessageIndex(os.path.join(datadir, 'index.sqlite'))
+    try:
+        n = rebuild(datadir, index, workers=workers)
+    finally:
+        index.close()
+    click.echo('Indexed {} messages'.format(n))
+
+
+@main.command(name='bench')
+@click.option('--host', type=click.STRING,
+              help='Server to benchmark, default is to start a local one.')
+@click.option('--port', type=click.INT, default=10800)
+@click.option('--backend', type=click.Choice(['threaded', 'asyncio']),
+              default='threaded', help='Backend of the local server.')
+@click.option('--messages', '-n', type=click.INT, default=1000,
+              help='Number of messages.')
+@click.option('--connections', '-c', type=click.INT, default=10,
+              help='Number of concurrent clients.')
+@click.option('--payload-size', 'payload_size', type=click.INT, default=30,
+              help='Payload of each message, in bytes.')
+@click.option('--location-ratio', 'location_ratio', type=click.FLOAT,
+              default=1.0, help='Fraction of the messages with a location.')
+@click.option('--mode', type=click.Choice(MODES), default='normal',
+              help='Send each message at once, in chunks (fragmented) or'
+                   ' trickling the chunks (slow).')
+@click.option('--chunk-size', 'chunk_size', type=click.INT, default=8,
+              help='Bytes per send() for the fragmented and slow modes.')
+@click.option('--delay', type=click.FLOAT, default=0.001,
+              help='Seconds between chunks in the slow mode.')
+@click.option('--commit-interval', 'commit_interval', type=click.FLOAT,
+              default=None,
+              help='Run the local server with durable acknowledgments,'
+                   ' syncing the journal at this interval (seconds).')
+def isbdbench(host, port, backend, messages, connections, payload_size,
+              location_ratio, mode, chunk_size, delay, commit_interval):
+    """ Measure throughput and latency of a Direct-IP server
+    """
+    data = make_messages(messages, payload_size, location_ratio)
+    options = dict(connections=connections, mode=mode,
+                   chunk_size=chunk_size, delay=delay)
+    if host is not None:
+        result = run((host, port), data, **options)
+    else:
+        with TemporaryDirectory() as datadir:
+            server_options = {}
+            if commit_interval is not None:
+                server_options['journal'] = GroupCommitLog(
+                        os.path.join(datadir, 'journal'),
+                        interval=commit_interval)
+            with local_server(datadir, backend, **server_options) as address:
+                result = run(address, data, **options)
+    click.echo(report(result))
+
+
+@main.command(name='export')
+@click.argument('datadir', type=click.Path(exists=True, file_okay=False))
+@click.option('--output', '-o', type=click.STRING, required=True,
+              help='Output filename.')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv')
+@click.option('--workers', type=click.INT, default=None,
+              help='Number of processes, default is one per CPU.')
+@click.option('--chunksize', type=click.INT, default=1000,
+              help='Number of files parsed by each task.')
+@click.option('--ordered/--unordered', default=True,
+              help='Keep the output in the order of the files.')
+def isbdexport(datadir, output, fmt, workers, chunksize, ordered):
+    """ Parse all messages saved in DATADIR into a single file
+    """
+    export(datadir, output, fmt=fmt, workers=workers, chunksize=chunksize,
+           ordered=ordered)
+
+
 if __name__ == '__main__':
     main()
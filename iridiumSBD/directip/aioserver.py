@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio based server to communicate Direct-IP messages.
+
+An alternative to ThreadedDirectIPServer where all the gateway connections
+are served by a single event loop instead of one OS thread per connection.
+The framing (StreamParser) and the acknowledgment are the same used by
+DirectIPHandler, so both servers behave identically from the gateway point
+of view.
+
+Memory is bounded by design: each connection buffers at most one message
+(2K bytes plus the reader limit), and above max_connections, if given, new
+calls are refused right away, so the gateway retries it later, or with the
+'wait' policy not accepted until a connection finishes (see
+AcceptWhenFree). Saving and
+post-processing are done by the write-behind queue, out of the event loop.
+
+Latency target: the acknowledgment should leave the server in less than
+5 ms after the last byte of a message is received, with thousands of
+concurrent connections on a single core. Disk and post-processing time are
+not part of that budget since those happen after the socket is closed.
+"""
+
+import asyncio
+from datetime import datetime
+import functools
+import logging
+import os.path
+import signal
+import socket
+import time
+
+from .. import __version__
+from ..iridiumSBD import StreamParser, is_outbound
+from . import metrics
+from .server import ACK, CONNECTION_POLICIES, InboxStorage, persist_batch, \
+        init_postprocessing, check_duplicate, next_timeout, timed_out, \
+        replay_journal, relay_allowed, start_mt_client
+from .writer import WriteBehindQueue
+
+
+module_logger = logging.getLogger('DirectIP')
+
+# Largest message that an Iridium can send (1960 bytes) plus header
+MAX_MSG_SIZE = 2048
+
+# Connections waiting in the accept queue of the kernel
+BACKLOG = 4096
+
+
+class AcceptWhenFree(object):
+    """Listening socket accepting a connection only once a slot is free
+
+    An asyncio.Server accepts every connection right away, thus those
+    waiting for a slot would hold a file descriptor and the buffers of a
+    StreamReader. Instead, they are left in the accept queue of the kernel,
+    like with ThreadedDirectIPServer. Provides the parts of asyncio.Server
+    used by AsyncDirectIPServer.
+
+    Args:
+        handle (coroutine function): Called as handle(reader, writer) for
+            each connection, releasing its slot when done.
+        slots (asyncio.Semaphore): Free slots for connections.
+        sock (socket.socket): Listening socket.
+    """
+    def __init__(self, handle, slots, sock):
+        self.logger = logging.getLogger('DirectIP.AsyncServer')
+        self.handle = handle
+        self.slots = slots
+        self.sockets = [sock]
+        sock.setblocking(False)
+        self.accepting = asyncio.ensure_future(self._accept())
+
+    async def _accept(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.slots.acquire()
+            try:
+                conn, address = await loop.sock_accept(self.sockets[0])
+            except OSError as e:
+                # Like running out of file descriptors, try again later
+                self.slots.release()
+                self.logger.error('Failed to accept: {}'.format(e))
+                await asyncio.sleep(0.1)
+                continue
+            except BaseException:
+                self.slots.release()
+                raise
+            try:
+                reader, writer = await asyncio.open_connection(
+                    sock=conn, limit=MAX_MSG_SIZE)
+            except BaseException:
+                conn.close()
+                self.slots.release()
+                raise
+            asyncio.ensure_future(self.handle(reader, writer))
+
+    def close(self):
+        self.accepting.cancel()
+
+    async def wait_closed(self):
+        try:
+            await self.accepting
+        except asyncio.CancelledError:
+            pass
+        self.sockets[0].close()
+
+    async def serve_forever(self):
+        await self.accepting
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await self.wait_closed()
+
+
+class AsyncDirectIPServer(object):
+    """A Direct-IP server running on a single asyncio event loop.
+
+    Args:
+        server_address (tuple): (host, port) to listen on.
+        datadir (str): Directory where incomming messages are saved.
+        postProcessing (str): Optional post-processing to run on each
+            message, see runserver().
+        max_connections (int): Maximum number of simultaneous connections,
+            None (default) for no limit. Above that, see connection_policy.
+        queue_size (int): Maximum number of messages waiting to be saved.
+        queue_policy (str): Backpressure policy of the WriteBehindQueue.
+        writers (int): Threads used to save and post-process messages.
+        storage: Where to save the messages, InboxStorage by default.
+        linger (float): Seconds to wait for another message on the same
+            connection after a complete one.
+        outbound_address (tuple): (host, port) of the Iridium Gateway, to
+            forward MT messages.
+        relay_from (list): Client IP addresses allowed to send MT messages
+            to be forwarded, none by default.
+        relay_timeout (float): Seconds waiting for the gateway confirmation
+            of a forwarded MT message.
+        mt_queue (MTQueue): Durable queue of MT messages to be sent to the
+            gateway at outbound_address.
+        dedup (DedupCache): Recently received messages, whose copies are
+            acknowledged but not saved again.
+        reuse_port (bool): Set SO_REUSEPORT, so several processes can
+            listen on the same port.
+        read_timeout (float): Seconds without receiving anything before
+            closing a connection, None for no limit.
+        session_timeout (float): Maximum seconds of a connection, None for
+            no limit.
+        connection_policy (str): Above max_connections, close the new
+            connections right away ('refuse') or hold them until another
+            one finishes ('wait').
+        journal (GroupCommitLog): Messages are synced to it before being
+            acknowledged (durable acknowledgments).
+        publisher (Publisher): Pushes the messages saved to subscribers.
+    """
+    def __init__(self,
+                 server_address,
+                 datadir,
+                 postProcessing=None,
+                 max_connections=None,
+                 queue_size=1024,
+                 queue_policy='block',
+                 writers=1,
+                 storage=None,
+                 linger=0,
+                 outbound_address=None,
+                 mt_queue=None,
+                 dedup=None,
+                 reuse_port=False,
+                 read_timeout=10,
+                 session_timeout=60,
+                 connection_policy='refuse',
+                 journal=None,
+                 publisher=None,
+                 relay_from=None,
+                 relay_timeout=30):
+        self.logger = logging.getLogger('DirectIP.AsyncServer')
+        self.logger.info(
+            'Initializing AsyncDirectIPServer version: {}'.format(
+                __version__))
+
+        if not os.path.exists(datadir):
+            self.logger.critical('Invalid datadir: {}'.format(datadir))
+            assert os.path.exists(datadir)
+        self.datadir = datadir
+        self.logger.info('Data directory: {}'.format(datadir))
+
+        self.postProcessing = init_postprocessing(postProcessing)
+
+        if storage is None:
+            storage = InboxStorage(datadir)
+        self.storage = storage
+
+        self.server_address = server_address
+        self.max_connections = max_connections
+        self.linger = linger
+        self.outbound_address = outbound_address
+        self.mt_client = None
+        self.relay_from = frozenset(relay_from or ())
+        self.relay_timeout = relay_timeout
+        self.mt_queue = mt_queue
+        self.dedup = dedup
+        self.reuse_port = reuse_port
+        self.read_timeout = read_timeout
+        self.session_timeout = session_timeout
+        assert connection_policy in CONNECTION_POLICIES, \
+            "Invalid connection_policy: {}".format(connection_policy)
+        self.connection_policy = connection_policy
+        self.slots = None
+        self.active_connections = 0
+        self.journal = journal
+        self.publisher = publisher
+        self.writer = WriteBehindQueue(
+            functools.partial(persist_batch,
+                              self.storage,
+                              postProcessing=self.postProcessing,
+                              journal=journal,
+                              publisher=publisher),
+            maxsize=queue_size,
+            policy=queue_policy,
+            workers=writers)
+        replay_journal(journal, self.writer)
+        self.server = None
+
+    async def start(self):
+        """Bind the socket and start accepting connections"""
+        host, port = self.server_address
+        if self.max_connections is not None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        if (self.slots is not None) and (self.connection_policy == 'wait'):
+            family, _, _, _, address = socket.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM,
+                flags=socket.AI_PASSIVE)[0]
+            sock = socket.create_server(address, family=family,
+                                        backlog=BACKLOG,
+                                        reuse_port=self.reuse_port)
+            self.server = AcceptWhenFree(
+                functools.partial(self.handle, acquired=True), self.slots,
+                sock)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle, host, port, limit=MAX_MSG_SIZE,
+                backlog=BACKLOG, reuse_port=self.reuse_port)
+        self.server_address = self.server.sockets[0].getsockname()[:2]
+        self.logger.info('Listening as %s:%s' % self.server_address)
+        self.mt_client = start_mt_client(
+            self.logger, self.outbound_address, self.mt_queue)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.shutdown()
+
+    def shutdown(self):
+        """Flush the messages still in memory and stop the workers"""
+        self.writer.close()
+        self.storage.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.postProcessing is not None:
+            self.postProcessing.close()
+        if self.mt_queue is not None:
+            self.mt_queue.close()
+        if self.mt_client is not None:
+            self.mt_client.close()
+        if self.dedup is not None:
+            self.dedup.close()
+
+    async def enqueue(self, client_address, data, t0, corrupted=False,
+                      journal=None):
+        """Push a message to the writers without blocking the event loop"""
+        if self.writer.try_put(client_address, data, t0, corrupted, journal):
+            return True
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(self.writer.put,
+                              client_address, data, t0, corrupted, journal))
+
+    async def queue_message(self, client_address, data, t0):
+        """Queue a valid message, first syncing it to the journal if any
+
+        Returns:
+            bool: False if the message should not be acknowledged.
+        """
+        ticket = None
+        if self.journal is not None:
+            try:
+                ticket = await asyncio.wrap_future(
+                    self.journal.submit(client_address, data, t0))
+            except Exception as e:
+                self.logger.error('Failed to journal message: {}'.format(e))
+                return False
+        if not await self.enqueue(client_address, data, t0, journal=ticket):
+            self.logger.error('Write-behind queue is full, not acknowledging')
+            if ticket is not None:
+                self.journal.release(ticket)
+            return False
+        return True
+
+    async def relay(self, data, client_address):
+        """Forward an MT message, returning the gateway confirmation"""
+        if not relay_allowed(self.logger, self.mt_client, self.relay_from,
+                             client_address):
+            return None
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(self.mt_client.submit(data)),
+                self.relay_timeout)
+        except asyncio.TimeoutError:
+            self.logger.error('Timed out forwarding MT message')
+            return None
+        except Exception as e:
+            self.logger.error('Failed to forward MT message: {}'.format(e))
+            return None
+
+    async def read(self, reader, parser, started, deadline, client_address):
+        """Next chunk of a connection, or b'' if there is nothing else
+
+        Keeps waiting while a message is incomplete. Once a message is
+        complete and the parser has nothing pending, waits at most linger
+        seconds for another message. Gives b'' as well after read_timeout
+        seconds without receiving anything or past the deadline of the
+        session.
+        """
+        if len(parser) > 0:
+            self.logger.debug('Message incomplete. Waiting for the rest')
+        elif started:
+            linger = self.linger
+            if deadline is not None:
+                linger = min(linger, deadline - time.monotonic())
+            if linger <= 0:
+                return b''
+            try:
+                return await asyncio.wait_for(
+                    reader.read(MAX_MSG_SIZE), linger)
+            except asyncio.TimeoutError:
+                return b''
+        timeout, session = next_timeout(self.read_timeout, deadline)
+        if session and (timeout <= 0):
+            timed_out(self.logger, client_address, session)
+            return b''
+        try:
+            return await asyncio.wait_for(reader.read(MAX_MSG_SIZE), timeout)
+        except asyncio.TimeoutError:
+            timed_out(self.logger, client_address, session)
+            return b''
+
+    async def handle(self, reader, writer, acquired=False):
+        """Deal with one transmission, equivalent to DirectIPHandler.handle
+
+        The slot of the connection is taken here, unless already acquired
+        before accepting it (see AcceptWhenFree).
+        """
+        client_address = writer.get_extra_info('peername')
+        if (self.slots is not None) and not acquired:
+            if self.slots.locked() and (self.connection_policy == 'refuse'):
+                self.logger.warning(
+                    'Too many connections, refusing %s' % client_address[0])
+                metrics.refused.inc()
+                writer.close()
+                return
+            await self.slots.acquire()
+        self.active_connections += 1
+        try:
+            self.logger.debug('Receiving a call from %s' % client_address[0])
+            t0 = datetime.utcnow()
+            accepted = time.monotonic()
+            deadline = None
+            if self.session_timeout is not None:
+                deadline = accepted + self.session_timeout
+            recv_calls = 0
+            parser = StreamParser()
+            started = False
+            while not parser.corrupted:
+                chunk = await self.read(reader, parser, started, deadline,
+                                        client_address)
+                if not chunk:
+                    break
+                started = True
+                recv_calls += 1
+                self.logger.debug('Received %s bytes' % (len(chunk)))
+                for data in parser.feed(chunk):
+                    if is_outbound(data):
+                        confirmation = await self.relay(data, client_address)
+                        if confirmation is None:
+                            writer.close()
+                            return
+                        writer.write(confirmation)
+                        continue
+                    metrics.received.inc()
+                    metrics.message_bytes.observe(len(data))
+                    metrics.recv_calls.observe(recv_calls)
+                    recv_calls = 0
+                    key = check_duplicate(self.dedup, data)
+                    if key is False:
+                        self.logger.info(
+                            'Duplicated message, acknowledging only.')
+                    elif not await self.queue_message(
+                            client_address, data, t0):
+                        if key:
+                            self.dedup.discard(key)
+                        writer.close()
+                        return
+                    self.logger.debug('Acknowledging message received.')
+                    writer.write(ACK)
+                    now = time.monotonic()
+                    metrics.accept_to_ack.observe(now - accepted)
+                    metrics.acked.inc()
+                    accepted = now
+                    t0 = datetime.utcnow()
+                await writer.drain()
+
+            writer.close()
+            if len(parser) > 0:
+                self.logger.error('Invalid message.')
+                metrics.corrupted.inc()
+                await self.enqueue(
+                    client_address, parser.pending(), t0, corrupted=True)
+        except (ConnectionError, OSError) as e:
+            self.logger.warning(
+                'Connection with {} failed: {}'.format(client_address[0], e))
+            writer.close()
+        finally:
+            self.active_connections -= 1
+            if self.slots is not None:
+                self.slots.release()
+
+
+def runaioserver(host, port, datadir, postProcessing=None, **kwargs):
+    """Runs an asyncio Direct-IP server to listen for messages.
+
+    Equivalent to runserver(), but using AsyncDirectIPServer. Extra keyword
+    arguments are passed to AsyncDirectIPServer.
+    """
+    module_logger.debug('Initializing runaioserver().')
+    server = AsyncDirectIPServer((host, port),
+                                 datadir=datadir,
+                                 postProcessing=postProcessing,
+                                 **kwargs)
+    module_logger.info('Listening as %s:%s' % (host, port))
+
+    async def serve():
+        # Stopped by kill or systemd, still flush the messages acknowledged
+        task = asyncio.ensure_future(server.serve_forever())
+        asyncio.get_event_loop().add_signal_handler(
+            signal.SIGTERM, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            module_logger.warn('Server terminated')
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        module_logger.warn('User terminated server')
+        module_logger.debug('=====================')
+    finally:
+        server.shutdown()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""Load generator and end-to-end benchmark of the DirectIP server.
+
+Behaves like the Iridium Gateway: each message is sent on its own
+connection, and the connection is only closed after the acknowledgment.
+Several clients run at once, each one on its own thread, and for every
+message the time from the connection being accepted until the
+acknowledgment arrives is recorded.
+
+Clients can send each message at once (normal), in small pieces
+(fragmented), or trickle the pieces with a delay like a slow link (slow),
+which exercises the framing of the server and how it copes with connections
+that take a long time.
+
+The target is either a server already running, or a local one started by
+local_server(), with any of the backends.
+"""
+
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+from ..iridiumSBD import encode_sections
+from .server import ACK, ThreadedDirectIPServer
+
+
+module_logger = logging.getLogger('DirectIP')
+
+MODES = ('normal', 'fragmented', 'slow')
+
+
+def make_messages(n, payload_size=30, location_ratio=1.0, imeis=100):
+    """Valid and distinct MO messages
+
+    Args:
+        n (int): Number of messages.
+        payload_size (int): Bytes of payload, 0 for no payload IE.
+        location_ratio (float): Fraction of the messages with a location IE.
+        imeis (int): Number of different IMEIs, used in turns.
+    """
+    now = datetime.utcnow()
+    payload = {'data': os.urandom(payload_size)} if payload_size else None
+    messages = []
+    with_location = 0
+    for i in range(n):
+        sections = {
+            'header': {'CDR_reference': i,
+                       'IMEI': '300234010{:06d}'.format(i % imeis),
+                       'session_status': 0,
+                       'MOMSN': (i // imeis) % 65536,
+                       'MTMSN': 0,
+                       'session_datetime': now},
+            'payload': payload,
+            }
+        # Spread evenly, like 1 in every 4 for 0.25
+        if with_location < location_ratio * (i + 1):
+            sections['location'] = {'latitude': 32.87, 'longitude': -117.25,
+                                    'CEP_radius': 5}
+            with_location += 1
+        messages.append(encode_sections('MO', sections))
+    return messages
+
+
+def send_message(address, data, mode='normal', chunk_size=8, delay=0.001,
+                 timeout=10):
+    """Deliver one message like the gateway, waiting for the ack
+
+    Args:
+        mode (str): 'normal' sends it at once, 'fragmented' in chunks of
+            chunk_size bytes, and 'slow' also waits delay seconds between
+            the chunks.
+
+    Returns:
+        float: Seconds from the connection being accepted until the ack.
+    """
+    sock = socket.create_connection(address, timeout)
+    try:
+        started = time.monotonic()
+        if mode == 'normal':
+            sock.sendall(data)
+        else:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for i in range(0, len(data), chunk_size):
+                if (mode == 'slow') and (i > 0):
+                    time.sleep(delay)
+                sock.sendall(data[i:i + chunk_size])
+        response = b''
+        while len(response) < len(ACK):
+            chunk = sock.recv(len(ACK) - len(response))
+            if not chunk:
+                break
+            response += chunk
+        latency = time.monotonic() - started
+    finally:
+        sock.close()
+    if response != ACK:
+        raise ValueError('Invalid acknowledgment: {!r}'.format(response))
+    return latency
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q from 0 to 100) of sorted values"""
+    if not values:
+        return None
+    # Rounded first, so that 99.9% of 1000 is 999 and not 999.0000000001
+    rank = int(math.ceil(round(q / 100. * len(values), 9)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def run(address, messages, connections=10, mode='normal', chunk_size=8,
+        delay=0.001, timeout=10):
+    """Send all messages from concurrent clients
+
+    Args:
+        address (tuple): (host, port) of the server.
+        messages (list): Binary messages, see make_messages().
+        connections (int): Number of concurrent clients.
+
+    Returns:
+        dict: messages, errors, seconds, throughput (messages acknowledged
+            per second), and the p50, p99 and p999 latencies in seconds.
+    """
+    assert mode in MODES, "Invalid mode: {}".format(mode)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(share):
+        for data in share:
+            try:
+                latency = send_message(address, data, mode, chunk_size,
+                                       delay, timeout)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+            else:
+                with lock:
+                    latencies.append(latency)
+
+    threads = [threading.Thread(target=client,
+                                args=(messages[i::connections],))
+               for i in range(connections)]
+    t0 = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - t0
+
+    if errors:
+        module_logger.warning('{} failed, like: {}'.format(
+            len(errors), errors[0]))
+    latencies.sort()
+    return {'messages': len(latencies),
+            'errors': len(errors),
+            'seconds': elapsed,
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'p999': percentile(latencies, 99.9)}
+
+
+def report(result):
+    """Text summary of the result of run()"""
+    lines = ['{messages} messages ({errors} errors) in {seconds:.2f} s:'
+             ' {throughput:.0f} msg/s'.format(**result)]
+    if result['messages']:
+        lines.append('accept to ack: p50 {:.2f} ms, p99 {:.2f} ms,'
+                     ' p99.9 {:.2f} ms'.format(result['p50'] * 1e3,
+                                               result['p99'] * 1e3,
+                                               result['p999'] * 1e3))
+    return '\n'.join(lines)
+
+
+def _serve_asyncio(server, started, stopped):
+    async def main():
+        await server.start()
+        started.set()
+        await asyncio.get_event_loop().run_in_executor(None, stopped.wait)
+        await server.close()
+    asyncio.run(main())
+
+
+@contextmanager
+def local_server(datadir, backend='threaded', **kwargs):
+    """Run a server on a free local port, on a background thread
+
+    Extra keyword arguments are passed to the server.
+
+    Yields:
+        tuple: (host, port) of the server.
+    """
+    if backend == 'asyncio':
+        from .aioserver import AsyncDirectIPServer
+        server = AsyncDirectIPServer(('127.0.0.1', 0), datadir, **kwargs)
+        started = threading.Event()
+        stopped = threading.Event()
+        thread = threading.Thread(target=_serve_asyncio,
+                                  args=(server, started, stopped))
+        thread.start()
+        started.wait()
+        try:
+            yield server.server_address
+        finally:
+            stopped.set()
+            thread.join()
+        return
+
+    assert backend == 'threaded', "Unknown backend: {}".format(backend)
+    server = ThreadedDirectIPServer(('127.0.0.1', 0), datadir, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
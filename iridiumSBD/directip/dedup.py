@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""Detection of MO messages delivered more than once by the Iridium Gateway.
+
+The gateway sends a message again whenever it misses the acknowledgment, so
+during a retry storm the same message can arrive several times. Each MO
+message is identified by (IMEI, MOMSN, CDR_reference) from its header, and
+DedupCache remembers the recent ones: a duplicate is still acknowledged, so
+the gateway stops retrying, but it is not saved nor post-processed again.
+
+The cache is bounded both in size (least recently seen keys are dropped
+first) and in time (keys not seen for ttl seconds are forgotten). It can be
+saved to a file on close and loaded again on start, thus a restart in the
+middle of a retry storm does not let the duplicates through.
+
+With several server processes (see workers.py), a retransmission can reach
+any of them, thus they share a SharedDedupCache instead, kept in a SQLite
+database.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ..iridiumSBD import IridiumSBD
+from . import metrics
+
+
+module_logger = logging.getLogger('DirectIP')
+
+
+def message_key(data):
+    """(IMEI, MOMSN, CDR_reference) of an MO message, or None
+
+    Only the header is decoded. Messages without an MO header, like MT
+    messages, have no key and are never considered duplicates.
+    """
+    try:
+        header = IridiumSBD(data, lazy=True).header
+    except Exception:
+        return None
+    if header['IEI'] != b'\x01':
+        return None
+    return (header['IMEI'], header['MOMSN'], header['CDR_reference'])
+
+
+class DedupCache(object):
+    """Bounded LRU cache, with expiration, of the MO messages already seen
+
+    Args:
+        maxsize (int): Maximum number of keys remembered.
+        ttl (float): Seconds a key is remembered after it was last seen.
+        path (str): Optional file to save the cache on close() and load it
+            from on start.
+    """
+    def __init__(self, maxsize=100000, ttl=86400, path=None):
+        self.logger = logging.getLogger('DirectIP.DedupCache')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        # key -> last time (time.time(), so it survives restarts) it was
+        # seen, the least recent first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if (path is not None) and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._fresh(key, time.time())
+
+    def _fresh(self, key, now):
+        seen = self.entries.get(key)
+        if seen is None:
+            return False
+        if now - seen > self.ttl:
+            del self.entries[key]
+            return False
+        return True
+
+    def _expire(self, now):
+        # Oldest first, so stop at the first one still valid
+        while self.entries:
+            key, seen = next(iter(self.entries.items()))
+            if now - seen <= self.ttl:
+                break
+            del self.entries[key]
+
+    def add(self, key):
+        """Record a key, returning False if it was already there
+
+        The check and the insertion are atomic, thus of two copies of the
+        same message arriving at once on different connections, only one
+        is taken as new.
+        """
+        now = time.time()
+        with self.lock:
+            if self._fresh(key, now):
+                # Retries keep it alive, and the oldest remain first
+                self.entries[key] = now
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.dedup_hits.inc()
+                return False
+            self.entries[key] = now
+            self._expire(now)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            self.misses += 1
+            metrics.dedup_misses.inc()
+            return True
+
+    def discard(self, key):
+        """Forget a key, like when its message could not be queued"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def load(self):
+        """Load the keys saved by save(), except the expired ones"""
+        now = time.time()
+        with open(self.path) as fid:
+            entries = json.load(fid)
+        with self.lock:
+            for imei, momsn, cdr_reference, seen in entries:
+                if now - seen <= self.ttl:
+                    self.entries[(imei, momsn, cdr_reference)] = seen
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        self.logger.debug('Loaded {} keys from {}'.format(
+            len(self.entries), self.path))
+
+    def save(self):
+        """Save the keys, atomically replacing the previous file"""
+        with self.lock:
+            entries = [list(key) + [seen]
+                       for key, seen in self.entries.items()]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fid:
+            json.dump(entries, fid)
+        os.replace(tmp, self.path)
+        self.logger.debug('Saved {} keys in {}'.format(
+            len(entries), self.path))
+
+    def close(self):
+        if self.path is not None:
+            self.save()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    key TEXT PRIMARY KEY,
+    seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS seen_time ON seen (seen);
+"""
+
+
+class SharedDedupCache(object):
+    """DedupCache shared by several processes, in a SQLite database
+
+    Same interface as DedupCache. Each process opens its own instance on
+    the same path, and add() is atomic among all of them.
+
+    Args:
+        path (str): SQLite database, created if missing.
+        maxsize (int): Maximum number of keys remembered, enforced every
+            prune_every additions.
+        ttl (float): Seconds a key is remembered after it was last seen.
+        prune_every (int): Additions between removals of the extra keys.
+    """
+    def __init__(self, path, maxsize=100000, ttl=86400, prune_every=1000):
+        self.logger = logging.getLogger('DirectIP.SharedDedupCache')
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.prune_every = prune_every
+        # Transactions are explicit, see add()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        # Losing the last keys on a power failure only lets a few copies
+        # through, no need to sync every addition
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.added = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT count(*) FROM seen').fetchone()[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT seen FROM seen WHERE key = ?',
+                                  (json.dumps(key),)).fetchone()
+        return (row is not None) and (time.time() - row[0] <= self.ttl)
+
+    def add(self, key):
+        """Record a key, returning False if it was already there"""
+        now = time.time()
+        key = json.dumps(key)
+        with self.lock:
+            # Write lock right away, so no other process checks in between
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT seen FROM seen WHERE key = ?',
+                                      (key,)).fetchone()
+                self.db.execute(
+                    'INSERT OR REPLACE INTO seen (key, seen) VALUES (?, ?)',
+                    (key, now))
+                fresh = (row is not None) and (now - row[0] <= self.ttl)
+                if not fresh:
+                    self.added += 1
+                    if self.added % self.prune_every == 0:
+                        self._prune(now)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        if fresh:
+            self.hits += 1
+            metrics.dedup_hits.inc()
+            return False
+        self.misses += 1
+        metrics.dedup_misses.inc()
+        return True
+
+    def _prune(self, now):
+        self.db.execute('DELETE FROM seen WHERE seen < ?', (now - self.ttl,))
+        self.db.execute(
+            'DELETE FROM seen WHERE key IN (SELECT key FROM seen'
+            ' ORDER BY seen DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def discard(self, key):
+        """Forget a key, like when its message could not be queued"""
+        with self.lock:
+            self.db.execute('DELETE FROM seen WHERE key = ?',
+                            (json.dumps(key),))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
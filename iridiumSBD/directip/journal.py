@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Durable acknowledgments with a group-committed journal.
+
+The servers acknowledge a message once it is in the write-behind queue,
+which is in memory, so a crash can lose messages that the gateway believes
+were delivered. With a GroupCommitLog, each message is first appended to a
+journal on disk, and only acknowledged once the journal was fsynced.
+
+Syncing each message on its own would limit the server to a few hundred
+messages per second. Instead, the handlers only submit their message and
+wait, while a single committer thread writes everything pending and syncs
+it at once, every interval seconds or as soon as max_batch messages are
+waiting, releasing all of those handlers together (group commit). The
+handlers then acknowledge and queue their messages as usual.
+
+The journal is a SegmentStore. Each message carries the segment it was
+journaled in (its ticket) through the write-behind queue, and once the
+storage saved it, the ticket is released. A segment whose messages were all
+released, and which is not being appended to, is deleted by a background
+thread, after syncing what the storage saved. Whatever is left
+in the journal when the server starts was acknowledged but maybe not saved
+before a crash, and is queued again (see replay()). Releases are not kept
+on disk, thus after a crash up to a segment of messages may be saved twice,
+but none is lost.
+"""
+
+from concurrent.futures import Future
+from datetime import timedelta
+import logging
+import os
+import os.path
+import queue
+import threading
+import time
+
+from ..store import EPOCH, SegmentStore, StoredMessage, iter_records
+from . import metrics
+
+
+module_logger = logging.getLogger('DirectIP')
+
+
+class GroupCommitLog(object):
+    """Journal of messages synced in groups before being acknowledged
+
+    Args:
+        path (str): Directory of the journal, created if missing.
+        interval (float): Maximum seconds a message waits for its group to
+            be synced.
+        max_batch (int): A group is synced right away once it has this many
+            messages.
+        segment_size (int): Size of the journal segments, in bytes. Smaller
+            segments are deleted sooner, and fewer messages are saved again
+            after a crash.
+    """
+    def __init__(self,
+                 path,
+                 interval=0.002,
+                 max_batch=64,
+                 segment_size=256 * 1024):
+        self.logger = logging.getLogger('DirectIP.GroupCommitLog')
+        self.path = path
+        self.interval = interval
+        self.max_batch = max_batch
+
+        self.store = SegmentStore(path, segment_size=segment_size,
+                                  fsync='batch')
+        # Messages of segments left by a previous run, still to be saved
+        self.outstanding = {}
+        self.recovered = []
+        for segment in self.store.segments():
+            with open(segment, 'rb') as f:
+                content = f.read()
+            n = 0
+            for end, t, address, data in iter_records(content):
+                self.recovered.append((
+                    (address.decode('ascii'), 0), data,
+                    EPOCH + timedelta(seconds=t), segment))
+                n += 1
+            self.outstanding[segment] = n
+        if self.recovered:
+            self.logger.warning(
+                'Recovered {} message(s) from the journal'.format(
+                    len(self.recovered)))
+        # Segment being appended to, as far as the tickets are concerned
+        self.current = self.store.segment_name(self.store.segment_id)
+        self._remove(self._obsolete())
+
+        self.lock = threading.Lock()
+        self.pending = threading.Condition(self.lock)
+        self.queue = []
+        self.closed = False
+        self.committer = threading.Thread(
+            target=self._commit, name='DirectIP-committer')
+        self.committer.daemon = True
+        self.committer.start()
+        # Segments released, to be removed off the commit path
+        self.removals = queue.Queue()
+        self.remover = threading.Thread(
+            target=self._remove_released, name='DirectIP-journal-remover')
+        self.remover.daemon = True
+        self.remover.start()
+
+    def submit(self, client_address, data, t0):
+        """Journal a message
+
+        Returns:
+            Future: Gives the ticket of the message once it is on disk, to
+                be released after the message is saved.
+        """
+        future = Future()
+        with self.pending:
+            assert not self.closed, "Journal already closed"
+            self.queue.append((StoredMessage(client_address, data, t0),
+                               time.monotonic(), future))
+            if len(self.queue) == 1 or len(self.queue) >= self.max_batch:
+                self.pending.notify()
+        return future
+
+    def commit(self, client_address, data, t0):
+        """Journal a message, waiting until it is on disk"""
+        return self.submit(client_address, data, t0).result()
+
+    def replay(self):
+        """Messages left by a previous run, removing them from here
+
+        Returns:
+            list: (client_address, data, t0, ticket) of each message.
+        """
+        recovered, self.recovered = self.recovered, []
+        return recovered
+
+    def release(self, ticket):
+        """A journaled message was saved, thus it is not needed anymore"""
+        with self.lock:
+            self.outstanding[ticket] -= 1
+            obsolete = self._obsolete()
+        if obsolete:
+            self.removals.put(obsolete)
+
+    def _obsolete(self):
+        """Forget the segments already released, returning them"""
+        obsolete = [segment for segment, n in self.outstanding.items()
+                    if (n == 0) and (segment != self.current)]
+        for segment in obsolete:
+            del self.outstanding[segment]
+        return obsolete
+
+    def _remove_released(self):
+        while True:
+            segments = self.removals.get()
+            if segments is None:
+                return
+            # Everything released meanwhile, with a single sync
+            while not self.removals.empty():
+                more = self.removals.get()
+                if more is None:
+                    self._remove(segments)
+                    return
+                segments.extend(more)
+            self._remove(segments)
+
+    def _remove(self, segments):
+        if not segments:
+            return
+        # The storage may not fsync its files, like InboxStorage. Slow, thus
+        # never on the commit path.
+        os.sync()
+        for segment in segments:
+            self.logger.debug(
+                'Removing journal segment: {}'.format(segment))
+            os.remove(segment)
+            os.remove(segment[:-4] + '.idx')
+
+    def _commit(self):
+        while True:
+            with self.pending:
+                while not (self.queue or self.closed):
+                    self.pending.wait()
+                if self.queue and not self.closed:
+                    deadline = self.queue[0][1] + self.interval
+                    while len(self.queue) < self.max_batch:
+                        remaining = deadline - time.monotonic()
+                        if (remaining <= 0) or self.closed:
+                            break
+                        self.pending.wait(remaining)
+                batch, self.queue = self.queue, []
+                if not batch:
+                    return
+
+            try:
+                locations = self.store.save_batch([b[0] for b in batch])
+            except Exception:
+                self.logger.exception(
+                    'Failed to sync the journal, retrying one at a time')
+                locations = self._save_each(batch)
+
+            metrics.journal_syncs.inc()
+            metrics.journal_group_size.observe(len(batch))
+            now = time.monotonic()
+            with self.lock:
+                for location in locations:
+                    if location is None:
+                        continue
+                    ticket = location.rsplit(':', 1)[0]
+                    self.outstanding[ticket] = \
+                        self.outstanding.get(ticket, 0) + 1
+                self.current = self.store.segment_name(self.store.segment_id)
+                obsolete = self._obsolete()
+            if obsolete:
+                self.removals.put(obsolete)
+            for (message, submitted, future), location in zip(batch,
+                                                              locations):
+                if location is None:
+                    continue
+                metrics.journal_commit.observe(now - submitted)
+                future.set_result(location.rsplit(':', 1)[0])
+
+    def _save_each(self, batch):
+        """Save a group one message at a time, None for those that failed
+
+        So a message that can't be journaled fails only its own handler.
+        """
+        locations = []
+        for message, submitted, future in batch:
+            try:
+                locations.append(self.store.save_batch([message])[0])
+            except Exception as e:
+                self.logger.error('Failed to journal message: {}'.format(e))
+                future.set_exception(e)
+                locations.append(None)
+        return locations
+
+    def close(self):
+        """Sync what is pending and stop the committer
+
+        The journal is left on disk if any message was not released, to be
+        replayed on the next start.
+        """
+        with self.pending:
+            if self.closed:
+                return
+            self.closed = True
+            self.pending.notify()
+        self.committer.join()
+        self.removals.put(None)
+        self.remover.join()
+        self.store.close()
+        with self.lock:
+            if any(self.outstanding.values()):
+                self.logger.warning(
+                    '{} journaled message(s) not saved'.format(
+                        sum(self.outstanding.values())))
+                return
+            self.outstanding.clear()
+        self._remove(self.store.segments())
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""Metrics of the DirectIP server, in the Prometheus text format.
+
+The servers count every message and record, as histograms, where the time
+goes between the gateway connecting and the message being on disk:
+
+    - isbd_accept_to_ack_seconds: from the connection (or the previous
+      acknowledgment on the same connection) until the acknowledgment is
+      sent. This is the time holding the gateway;
+    - isbd_ack_to_persist_seconds: from the acknowledgment until the
+      storage saved the message (the delay of the write-behind queue);
+    - isbd_recv_calls_per_message: recv() calls needed for each message;
+    - isbd_message_bytes: size of each message;
+    - isbd_postprocessing_seconds: duration of each post-processing attempt.
+
+With a DedupCache, isbd_dedup_hits_total counts the copies of messages
+already received, retransmitted by the gateway. With durable
+acknowledgments (see journal.GroupCommitLog), isbd_journal_commit_seconds
+is the part of the accept-to-ack time waiting for the disk, and
+isbd_journal_group_size the number of messages synced together.
+
+The metrics can be exposed on a local HTTP endpoint (serve_metrics) or
+written periodically to a file (TextfileExporter), for instance for the
+textfile collector of the Prometheus node exporter. There are no external
+dependencies, only the standard library.
+"""
+
+import bisect
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+module_logger = logging.getLogger('DirectIP')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """Monotonically increasing value"""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+    def state(self):
+        return self.value
+
+    def merge(self, state):
+        """Add the state of the same counter from another process"""
+        self.inc(state)
+
+    def empty(self):
+        return Counter(self.name, self.help)
+
+    def reset(self):
+        with self.lock:
+            self.value = 0
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for le, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            yield '{}_bucket{{le="{}"}}'.format(
+                self.name, '+Inf' if le == float('inf') else repr(le)), \
+                cumulative
+        yield self.name + '_sum', total
+        yield self.name + '_count', cumulative
+
+    def state(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+    def merge(self, state):
+        """Add the state of the same histogram from another process"""
+        counts, total = state
+        with self.lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.sum += total
+
+    def empty(self):
+        return Histogram(self.name, self.help, self.buckets)
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * len(self.counts)
+            self.sum = 0.0
+
+
+class Registry(object):
+    """Collection of metrics, rendered together"""
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """State of every metric, to be sent to another process"""
+        return {metric.name: metric.state() for metric in self.metrics}
+
+    def empty(self):
+        """Registry with the same metrics, all zeroed"""
+        registry = Registry()
+        for metric in self.metrics:
+            registry.register(metric.empty())
+        return registry
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def merge(self, snapshot):
+        for metric in self.metrics:
+            if metric.name in snapshot:
+                metric.merge(snapshot[metric.name])
+
+
+REGISTRY = Registry()
+
+received = REGISTRY.counter(
+    'isbd_messages_received_total', 'Complete messages received.')
+corrupted = REGISTRY.counter(
+    'isbd_messages_corrupted_total', 'Invalid or truncated messages.')
+acked = REGISTRY.counter(
+    'isbd_messages_acked_total', 'Messages acknowledged to the gateway.')
+persisted = REGISTRY.counter(
+    'isbd_messages_persisted_total', 'Messages saved by the storage.')
+persist_failed = REGISTRY.counter(
+    'isbd_persist_failures_total',
+    'Messages acknowledged but not saved, after all retries.')
+postprocessed = REGISTRY.counter(
+    'isbd_messages_postprocessed_total',
+    'Messages post-processed successfully.')
+postprocessing_failed = REGISTRY.counter(
+    'isbd_postprocessing_failures_total',
+    'Messages that failed post-processing after all retries.')
+refused = REGISTRY.counter(
+    'isbd_connections_refused_total',
+    'Connections closed right away, above the maximum of connections.')
+read_timeouts = REGISTRY.counter(
+    'isbd_connections_read_timeout_total',
+    'Connections closed after too long without receiving anything.')
+session_timeouts = REGISTRY.counter(
+    'isbd_connections_session_timeout_total',
+    'Connections closed after the maximum duration of a session.')
+relay_refused = REGISTRY.counter(
+    'isbd_relay_refused_total',
+    'MT messages from clients not allowed to relay them.')
+dedup_hits = REGISTRY.counter(
+    'isbd_dedup_hits_total',
+    'Duplicated messages, acknowledged but not saved again.')
+dedup_misses = REGISTRY.counter(
+    'isbd_dedup_misses_total', 'Messages checked and not seen before.')
+published = REGISTRY.counter(
+    'isbd_published_total', 'Messages queued to be sent to subscribers.')
+published_dropped = REGISTRY.counter(
+    'isbd_published_dropped_total',
+    'Messages dropped for subscribers that did not keep up.')
+slow_subscribers = REGISTRY.counter(
+    'isbd_slow_subscribers_total',
+    'Subscribers disconnected for not keeping up.')
+journal_syncs = REGISTRY.counter(
+    'isbd_journal_syncs_total', 'Groups of messages synced to the journal.')
+
+accept_to_ack = REGISTRY.histogram(
+    'isbd_accept_to_ack_seconds',
+    'Time from the connection (or previous ack) until the ack is sent.')
+ack_to_persist = REGISTRY.histogram(
+    'isbd_ack_to_persist_seconds',
+    'Time from the ack until the message is saved.')
+recv_calls = REGISTRY.histogram(
+    'isbd_recv_calls_per_message', 'Number of recv() calls per message.',
+    buckets=(1, 2, 3, 4, 5, 10, 20))
+message_bytes = REGISTRY.histogram(
+    'isbd_message_bytes', 'Size of each message, in bytes.',
+    buckets=(64, 128, 256, 512, 1024, 2048))
+journal_commit = REGISTRY.histogram(
+    'isbd_journal_commit_seconds',
+    'Time from submitting a message to the journal until it is synced.')
+journal_group_size = REGISTRY.histogram(
+    'isbd_journal_group_size', 'Number of messages synced at once.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+postprocessing_duration = REGISTRY.histogram(
+    'isbd_postprocessing_seconds',
+    'Duration of each post-processing attempt.',
+    buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0))
+
+
+class AggregateRegistry(object):
+    """Sum of the metrics of several processes, like the server workers
+
+    Each process sends its Registry.snapshot() from time to time, and the
+    last one of each process is kept. The counts of a process that ended
+    are retired, but still included, so the totals never go back.
+    """
+    def __init__(self, registry=REGISTRY):
+        self.retired = registry.empty()
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, snapshot):
+        with self.lock:
+            self.snapshots[key] = snapshot
+
+    def retire(self, key):
+        with self.lock:
+            snapshot = self.snapshots.pop(key, None)
+            if snapshot is not None:
+                self.retired.merge(snapshot)
+
+    def render(self):
+        with self.lock:
+            total = self.retired.empty()
+            total.merge(self.retired.snapshot())
+            for snapshot in self.snapshots.values():
+                total.merge(snapshot)
+        return total.render()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        output = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        module_logger.debug('Metrics request: ' + format % args)
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(address, registry=REGISTRY):
+    """Expose the metrics over HTTP on a background thread
+
+    Args:
+        address (tuple): (host, port) to listen on. Prefer a local address,
+            like ('127.0.0.1', 9108).
+
+    Returns:
+        The HTTP server, call shutdown() on it to stop.
+    """
+    server = MetricsHTTPServer(address, MetricsHandler)
+    server.registry = registry
+    t = threading.Thread(target=server.serve_forever, name='DirectIP-metrics')
+    t.daemon = True
+    t.start()
+    module_logger.info('Metrics on http://%s:%s/metrics' % address)
+    return server
+
+
+class TextfileExporter(object):
+    """Write the metrics to a file every interval seconds
+
+    The file is replaced atomically, so readers never see it half written.
+    """
+    def __init__(self, filename, interval=15, registry=REGISTRY):
+        self.filename = filename
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='DirectIP-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.registry.render())
+        os.replace(tmp, self.filename)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""Client to send MT (mobile terminated) messages to the Iridium Gateway.
+
+MTClient keeps a single connection to the gateway open and reuses it for
+every message, instead of connecting once per message. Messages are queued
+with submit() and a sender thread pipelines them: up to max_in_flight
+messages are written back-to-back before waiting for their confirmations
+(0x44), which are matched to the messages in the order they were sent.
+
+If the gateway closes the connection, or it times out, the client reconnects
+and sends again everything not confirmed yet. Gateways that close the
+connection after each confirmation still work, with a new connection for
+the next message, but then use max_in_flight=1 to avoid sending messages
+that are dropped and sent again.
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from itertools import islice
+import logging
+import queue
+import socket
+import threading
+import time
+
+from ..iridiumSBD import IridiumSBD, StreamParser, encode_MT
+from ..iridiumSBD import MT_CONFIRMATION_STATUS
+
+
+module_logger = logging.getLogger('DirectIP')
+
+_STOP = object()
+
+
+class MTError(Exception):
+    """The gateway refused an MT message (negative confirmation status)"""
+    def __init__(self, confirmation):
+        self.confirmation = confirmation
+        self.status = confirmation['status']
+        Exception.__init__(self, 'MT message refused ({}): {}'.format(
+            self.status, MT_CONFIRMATION_STATUS.get(self.status, 'Unknown')))
+
+
+class MTClient(object):
+    """Persistent, pipelined connection to the Iridium Gateway
+
+    Args:
+        address (tuple): (host, port) of the gateway.
+        timeout (float): Seconds to connect, and to wait for a confirmation
+            before giving up on the connection.
+        max_in_flight (int): Maximum number of messages sent and not
+            confirmed yet.
+        retries (int): Attempts on new connections before failing a
+            message.
+        reconnect_delay (float): Seconds to wait before reconnecting.
+    """
+    def __init__(self,
+                 address,
+                 timeout=10,
+                 max_in_flight=8,
+                 retries=3,
+                 reconnect_delay=1.0):
+        self.logger = logging.getLogger('DirectIP.MTClient')
+        self.address = address
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.reconnect_delay = reconnect_delay
+        self.sock = None
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self._work, name='DirectIP-mtclient')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __repr__(self):
+        return 'MTClient({}:{})'.format(*self.address)
+
+    def submit(self, data):
+        """Queue a binary MT message
+
+        Returns:
+            Future: Resolves to the binary confirmation from the gateway.
+        """
+        assert not self.closed, "MTClient already closed"
+        future = Future()
+        # Running, thus a caller giving up can't cancel it under the sender
+        future.set_running_or_notify_cancel()
+        self.queue.put([data, future, 0])
+        return future
+
+    def send(self, imei, payload, unique_client_msg_id=0,
+             disposition_flags=0, priority=None, timeout=None):
+        """Send an MT message and wait for its confirmation
+
+        Returns:
+            dict: The confirmation, as parsed by parse_MT_confirmation().
+                The status is the position in the gateway MT queue.
+
+        Raises:
+            MTError: If the gateway refused the message.
+        """
+        data = encode_MT(imei, payload, unique_client_msg_id,
+                         disposition_flags, priority)
+        confirmation = IridiumSBD(
+            self.submit(data).result(timeout)).attributes['confirmation']
+        if confirmation['status'] < 0:
+            raise MTError(confirmation)
+        return confirmation
+
+    def close(self):
+        """Send everything queued and close the connection"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _connect(self):
+        self.logger.debug('Connecting to gateway at %s:%s' % self.address)
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.parser = StreamParser()
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def _receive(self, inflight, sent):
+        """Wait for confirmations, at least one, of the messages in flight
+
+        A confirmation without a message sent waiting for it is a protocol
+        error, handled like an invalid response.
+
+        Returns:
+            int: Number of messages confirmed.
+        """
+        while True:
+            chunk = self.sock.recv(2048)
+            if not chunk:
+                raise ConnectionError('Connection closed by the gateway')
+            confirmations = self.parser.feed(chunk)
+            if self.parser.corrupted:
+                raise ConnectionError('Invalid response from the gateway')
+            if len(confirmations) > sent:
+                raise ConnectionError('Unexpected confirmation')
+            for data in confirmations:
+                data_sent, future, attempts = inflight.popleft()
+                future.set_result(data)
+            if confirmations:
+                return len(confirmations)
+
+    def _work(self):
+        # Each item is [data, future, attempts], in the order queued. The
+        # first ones (sent) were already written on the current connection.
+        inflight = deque()
+        sent = confirmed = 0
+        stop = False
+        while not (stop and not inflight):
+            while not stop and (len(inflight) < self.max_in_flight):
+                try:
+                    item = self.queue.get(block=not inflight)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                else:
+                    inflight.append(item)
+            if not inflight:
+                continue
+
+            try:
+                if self.sock is None:
+                    sent = confirmed = 0
+                    self._connect()
+                if sent < len(inflight):
+                    self.sock.sendall(b''.join(
+                        item[0] for item in islice(inflight, sent, None)))
+                    sent = len(inflight)
+                n = self._receive(inflight, sent)
+                sent -= n
+                confirmed += n
+            except (OSError, ConnectionError) as e:
+                self._disconnect()
+                if confirmed > 0:
+                    # A gateway that closes after the confirmation(s)
+                    self.logger.debug('Gateway closed the connection')
+                    continue
+                self.logger.warning(
+                    'Connection with the gateway failed: {}'.format(e))
+                # Only the oldest message is blamed, the others might not
+                # even have been read by the gateway
+                head = inflight[0]
+                head[2] += 1
+                if head[2] > self.retries:
+                    self.logger.error('Giving up an MT message')
+                    inflight.popleft()
+                    head[1].set_exception(e)
+                time.sleep(self.reconnect_delay)
+        self._disconnect()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""Durable queue of MT messages waiting to be sent to the Iridium Gateway.
+
+Messages are kept in a SQLite database, thus they survive restarts and can
+be queued by other processes (like the mt-send command) while the server is
+running. The server drains the queue through its MTClient:
+
+    - FIFO for each IMEI: only the oldest pending message of an IMEI is
+      sent, and only after the previous one was confirmed;
+    - at most max_concurrent messages waiting for a confirmation at once;
+    - a token bucket limits the rate (messages per second, with bursts),
+      so a broadcast to the whole fleet does not flood the gateway;
+    - messages refused with a temporary error (like a full MT queue on the
+      gateway) or that failed to be delivered are retried with exponential
+      backoff, up to retries times. Permanent errors (like an unknown IMEI)
+      are not retried.
+
+A message is only removed from the pending ones after its confirmation, so
+if the server stops while one is in flight, it is sent again on restart.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from ..iridiumSBD import IridiumSBD, encode_MT, MT_CONFIRMATION_STATUS
+
+
+module_logger = logging.getLogger('DirectIP')
+
+# Confirmation status worth trying again later: MT queue full, resources
+# unavailable and IMEI not attached
+RETRY_STATUS = (-5, -6, -9)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mt_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    imei TEXT NOT NULL,
+    data BLOB NOT NULL,
+    created REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    status INTEGER
+);
+CREATE INDEX IF NOT EXISTS mt_queue_pending ON mt_queue (state, imei, id);
+"""
+
+
+class TokenBucket(object):
+    """Rate limit of rate events per second, with bursts up to burst"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self):
+        """Take a token if available, otherwise seconds until the next one
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class MTQueue(object):
+    """On-disk queue of MT messages, drained toward the gateway
+
+    Args:
+        path (str): SQLite database, created if it doesn't exist.
+        max_concurrent (int): Maximum number of messages waiting for a
+            confirmation.
+        rate (float): Maximum messages per second sent to the gateway.
+        burst (int): Messages that can be sent at once above the rate.
+        retries (int): Attempts after the first one before giving up.
+        backoff (float): Seconds before the first retry, doubled on each
+            following one.
+        poll_interval (float): Seconds between checks for messages queued
+            by other processes.
+    """
+    def __init__(self,
+                 path,
+                 max_concurrent=4,
+                 rate=1.0,
+                 burst=10,
+                 retries=5,
+                 backoff=30.0,
+                 poll_interval=1.0):
+        self.logger = logging.getLogger('DirectIP.MTQueue')
+        self.path = path
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # IMEIs with a message waiting for a confirmation
+        self.inflight = set()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __len__(self):
+        """Number of pending messages"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT count(*) FROM mt_queue WHERE state = 'pending'"
+                ).fetchone()[0]
+
+    def put(self, imei, payload, unique_client_msg_id=0, disposition_flags=0,
+            priority=None):
+        """Queue an MT message, see encode_MT(), returning its id"""
+        data = encode_MT(imei, payload, unique_client_msg_id,
+                         disposition_flags, priority)
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO mt_queue (imei, data, created) VALUES (?, ?, ?)",
+                (imei, data, time.time()))
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def get(self, id):
+        """(state, attempts, status) of a queued message"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT state, attempts, status FROM mt_queue WHERE id = ?",
+                (id,)).fetchone()
+
+    def ready(self, limit):
+        """Oldest pending message of each IMEI not in flight nor waiting
+
+        Returns:
+            list: (id, imei, data, attempts), at most limit of them.
+        """
+        if limit <= 0:
+            return []
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, imei, data, attempts, next_attempt FROM mt_queue"
+                " WHERE id IN (SELECT min(id) FROM mt_queue"
+                "              WHERE state = 'pending' GROUP BY imei)"
+                " ORDER BY id").fetchall()
+        now = time.time()
+        output = []
+        for id, imei, data, attempts, next_attempt in rows:
+            if (imei not in self.inflight) and (next_attempt <= now):
+                output.append((id, imei, data, attempts))
+                if len(output) >= limit:
+                    break
+        return output
+
+    def _update(self, id, state, attempts, status, next_attempt=0):
+        with self.lock:
+            if self.db is None:
+                # Closed, it remains pending and is sent again on restart
+                return
+            with self.db:
+                self.db.execute(
+                    "UPDATE mt_queue SET state = ?, attempts = ?, status = ?,"
+                    " next_attempt = ? WHERE id = ?",
+                    (state, attempts, status, next_attempt, id))
+
+    def done(self, id, imei, attempts, future):
+        """Record the outcome of an attempt to send a message"""
+        try:
+            confirmation = IridiumSBD(
+                future.result()).attributes['confirmation']
+        except Exception as e:
+            self.logger.warning('Failed to send MT to {}: {}'.format(imei, e))
+            status = None
+        else:
+            status = confirmation['status']
+
+        attempts += 1
+        if (status is not None) and (status >= 0):
+            self.logger.debug('MT to {} confirmed, queue position: {}'.format(
+                imei, status))
+            self._update(id, 'sent', attempts, status)
+        elif (status is not None) and (status not in RETRY_STATUS):
+            self.logger.error('MT to {} refused: {}'.format(
+                imei, MT_CONFIRMATION_STATUS.get(status, status)))
+            self._update(id, 'failed', attempts, status)
+        elif attempts > self.retries:
+            self.logger.error('Giving up MT to {} after {} attempts'.format(
+                imei, attempts))
+            self._update(id, 'failed', attempts, status)
+        else:
+            delay = self.backoff * 2 ** (attempts - 1)
+            self.logger.warning('MT to {} will be retried in {} s'.format(
+                imei, delay))
+            self._update(id, 'pending', attempts, status, time.time() + delay)
+        self.inflight.discard(imei)
+        self.wakeup.set()
+
+    def start(self, client):
+        """Drain the queue through an MTClient on a background thread"""
+        self.thread = threading.Thread(
+            target=self._work, args=(client,), name='DirectIP-mtqueue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _work(self, client):
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            wait = self.poll_interval
+            available = self.max_concurrent - len(self.inflight)
+            for id, imei, data, attempts in self.ready(max(available, 0)):
+                wait = self.bucket.take()
+                if wait > 0:
+                    break
+                self.inflight.add(imei)
+                future = client.submit(data)
+                future.add_done_callback(
+                    lambda f, id=id, imei=imei, attempts=attempts:
+                        self.done(id, imei, attempts, f))
+            self.wakeup.wait(wait)
+
+    def close(self, timeout=10):
+        """Stop draining, messages not sent yet remain in the queue
+
+        Waits up to timeout seconds for the confirmations of the messages
+        in flight.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        deadline = time.monotonic() + timeout
+        while self.inflight and (time.monotonic() < deadline):
+            time.sleep(0.01)
+        with self.lock:
+            self.db.close()
+            self.db = None
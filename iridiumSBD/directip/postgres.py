@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""PostgreSQL storage for the DirectIP server.
+
+Instead of (or before) any external post-processing opening its own
+connection for each message, the server itself can write the parsed
+messages into PostgreSQL. PostgresStorage is used as the storage of the
+DirectIP servers: each message becomes one row with the header, location,
+payload and the original binary message.
+
+Rows are accumulated in memory and sent with a single COPY once there are
+batch_size rows or flush_interval seconds passed, using connections from a
+pool. If the database is unavailable, the rows are appended to a local spill
+file (CSV, in the same format used by COPY), which is loaded on the next
+successful flush. If the database rejects a batch because of its content
+(a DataError or an IntegrityError), the rows are sent again one at a time,
+and the ones rejected are moved to a quarantine file, so a single bad row
+doesn't block everything after it.
+
+Note that rows waiting in memory are lost on a crash, so keep the
+thresholds small. This module requires psycopg2.
+"""
+
+import csv
+import io
+import logging
+import os
+import threading
+
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+from ..iridiumSBD import IridiumSBD
+
+
+module_logger = logging.getLogger('DirectIP')
+
+# Errors of the connection, and not of the rows sent
+UNAVAILABLE = (psycopg2.OperationalError, psycopg2.InterfaceError) \
+    if psycopg2 is not None else ()
+
+COLUMNS = ('received', 'client_address', 'corrupted', 'mtype',
+           'cdr_reference', 'imei', 'session_status', 'momsn', 'mtmsn',
+           'session_datetime', 'latitude', 'longitude', 'cep_radius',
+           'payload', 'raw')
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id bigserial PRIMARY KEY,
+    received timestamp NOT NULL,
+    client_address text,
+    corrupted boolean NOT NULL,
+    mtype text,
+    cdr_reference bigint,
+    imei text,
+    session_status smallint,
+    momsn integer,
+    mtmsn integer,
+    session_datetime timestamp,
+    latitude double precision,
+    longitude double precision,
+    cep_radius bigint,
+    payload bytea,
+    raw bytea NOT NULL
+);
+CREATE INDEX IF NOT EXISTS {table}_imei_idx
+    ON {table} (imei, session_datetime);
+"""
+
+
+def _bytea(data):
+    return '\\x' + bytes(data).hex()
+
+
+def as_row(item):
+    """CSV row, for COPY, of a queued message
+
+    Messages that can't be parsed are kept with only the raw content.
+    """
+    row = dict.fromkeys(COLUMNS)
+    row['received'] = item.t0.isoformat()
+    row['client_address'] = item.client_address[0]
+    row['corrupted'] = 't' if item.corrupted else 'f'
+    row['raw'] = _bytea(item.data)
+    if not item.corrupted:
+        try:
+            msg = IridiumSBD(item.data)
+        except Exception as e:
+            module_logger.warning('Failed to parse message: {}'.format(e))
+        else:
+            row['mtype'] = msg.mtype
+            header = msg.attributes.get('header', {})
+            row['cdr_reference'] = header.get('CDR_reference')
+            row['imei'] = header.get('IMEI')
+            row['session_status'] = header.get('session_status')
+            row['momsn'] = header.get('MOMSN')
+            row['mtmsn'] = header.get('MTMSN')
+            if 'session_datetime' in header:
+                row['session_datetime'] = \
+                    header['session_datetime'].isoformat()
+            location = msg.attributes.get('location', {})
+            row['latitude'] = location.get('latitude')
+            row['longitude'] = location.get('longitude')
+            row['cep_radius'] = location.get('CEP_radius')
+            if hasattr(msg, 'payload'):
+                row['payload'] = _bytea(msg.payload['data'])
+    return [row[c] for c in COLUMNS]
+
+
+class PostgresStorage(object):
+    """Storage of parsed messages in a PostgreSQL table.
+
+    Args:
+        dsn (str): libpq connection string, like
+            'dbname=isbd user=isbd host=localhost'.
+        table (str): Table name, created if it doesn't exist.
+        spill (str): Local file to keep the rows while the database is
+            unavailable.
+        quarantine (str): Local file where the rows rejected by the
+            database are moved.
+        batch_size (int): Flush once there are this many rows waiting.
+        flush_interval (float): Flush at least every this many seconds.
+        pool_size (int): Maximum number of connections in the pool.
+    """
+    def __init__(self,
+                 dsn,
+                 table='isbd_messages',
+                 spill='isbd_spill.csv',
+                 quarantine='isbd_rejected.csv',
+                 batch_size=500,
+                 flush_interval=1.0,
+                 pool_size=2):
+        if psycopg2 is None:
+            raise ImportError("PostgresStorage requires psycopg2")
+        self.logger = logging.getLogger('DirectIP.PostgresStorage')
+        self.table = table
+        self.spill = spill
+        self.quarantine = quarantine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            0, pool_size, dsn)
+        self.table_ready = False
+
+        self.rows = []
+        self.condition = threading.Condition()
+        # Only one flush at a time, so rows are sent in order
+        self.flush_lock = threading.Lock()
+        self.closed = False
+        self.flusher = threading.Thread(
+            target=self._flush_periodically, name='DirectIP-postgres')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def __repr__(self):
+        return 'PostgresStorage(table={!r})'.format(self.table)
+
+    def save_batch(self, batch):
+        """Queue rows for the next COPY
+
+        There is no file for each message, so the locations given to the
+        post-processing are None.
+        """
+        rows = [as_row(item) for item in batch]
+        with self.condition:
+            self.rows.extend(rows)
+            if len(self.rows) >= self.batch_size:
+                self.condition.notify()
+        return [None] * len(batch)
+
+    def _flush_periodically(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.rows) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return
+
+    def flush(self):
+        """Send everything waiting, including any spilled rows"""
+        with self.flush_lock:
+            with self.condition:
+                rows, self.rows = self.rows, []
+            spilled = os.path.exists(self.spill)
+            if not rows and not spilled:
+                return
+            if spilled:
+                with open(self.spill, newline='') as f:
+                    rows = [[v or None for v in row]
+                            for row in csv.reader(f)] + rows
+
+            try:
+                self.copy_rows(rows)
+            except UNAVAILABLE as e:
+                self.logger.error(
+                    'Failed to write {} rows, spilling to {}: {}'.format(
+                        len(rows), self.spill, e))
+                self.write_spill(rows)
+                return
+            except psycopg2.Error as e:
+                self.logger.error(
+                    'Rejected batch of {} rows, retrying one at a time: '
+                    '{}'.format(len(rows), e))
+                self.copy_each(rows)
+                return
+            self.logger.debug('Copied {} rows into {}'.format(
+                len(rows), self.table))
+            if spilled:
+                self.logger.info('Loaded spilled rows from {}'.format(
+                    self.spill))
+                os.remove(self.spill)
+
+    def copy_each(self, rows):
+        """COPY rows one at a time, moving the rejected ones to quarantine"""
+        rejected = []
+        for i, row in enumerate(rows):
+            try:
+                self.copy_rows([row])
+            except UNAVAILABLE as e:
+                self.logger.error(
+                    'Failed to write {} rows, spilling to {}: {}'.format(
+                        len(rows) - i, self.spill, e))
+                self.write_spill(rows[i:])
+                break
+            except psycopg2.Error as e:
+                self.logger.error('Row rejected, moved to {}: {}'.format(
+                    self.quarantine, e))
+                rejected.append(row)
+        else:
+            self.write_spill([])
+        if rejected:
+            with open(self.quarantine, 'a', newline='') as f:
+                csv.writer(f).writerows(rejected)
+
+    def write_spill(self, rows):
+        """Replace the spill file with rows, removing it if there are none"""
+        if not rows:
+            if os.path.exists(self.spill):
+                os.remove(self.spill)
+            return
+        tmp = self.spill + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        os.replace(tmp, self.spill)
+
+    def copy_rows(self, rows):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        self.copy(buf)
+
+    def copy(self, buf):
+        """COPY the CSV content of buf into the table"""
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                if not self.table_ready:
+                    cur.execute(CREATE_TABLE.format(table=self.table))
+                buf.seek(0)
+                cur.copy_expert(
+                    'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                        self.table, ', '.join(COLUMNS)),
+                    buf)
+            conn.commit()
+            self.table_ready = True
+        except psycopg2.Error:
+            # Discard the connection, it might be broken
+            self.pool.putconn(conn, close=True)
+            raise
+        else:
+            self.pool.putconn(conn)
+
+    def close(self):
+        """Flush everything and close the connections"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.flusher.join()
+        self.pool.closeall()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""Post-processing of messages received by the DirectIP server.
+
+There are two kinds of post-processing:
+
+    - A Python callable, given as 'module:function' or as the name of an
+      entry point in the group 'iridiumSBD.postprocessing'. It is loaded only
+      once and called with each message already parsed as an IridiumSBD
+      object;
+    - An external command (the original behavior), called with the filename
+      of each saved message as its single argument.
+
+Either way, tasks run in a PostProcessingPool, with a limited number of
+concurrent tasks, a timeout for each attempt, and retries with exponential
+backoff.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+import functools
+import importlib
+import logging
+import os.path
+import shutil
+import subprocess
+import threading
+import time
+
+from ..iridiumSBD import IridiumSBD
+from . import metrics
+
+
+module_logger = logging.getLogger('DirectIP')
+
+ENTRY_POINT_GROUP = 'iridiumSBD.postprocessing'
+
+
+def load_callable(spec):
+    """Load a post-processing function
+
+    Args:
+        spec (str): Either 'module:function', like 'mypackage.tools:ingest',
+            or the name of an entry point registered in the group
+            'iridiumSBD.postprocessing'.
+    """
+    if ':' in spec:
+        modulename, attr = spec.split(':', 1)
+        func = importlib.import_module(modulename)
+        for name in attr.split('.'):
+            func = getattr(func, name)
+        return func
+
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, spec):
+            return ep.load()
+    else:
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP, name=spec)
+        else:
+            eps = [ep for ep in eps.get(ENTRY_POINT_GROUP, [])
+                   if ep.name == spec]
+        for ep in eps:
+            return ep.load()
+    raise ValueError("Unknown post-processing: {}".format(spec))
+
+
+class ExternalCommand(object):
+    """Run an external command on the saved message
+
+    The command is called with the message filename as the single argument,
+    and fails if it does not finish within timeout seconds or returns a
+    non-zero status.
+    """
+    def __init__(self, command, timeout=60):
+        self.command = command
+        self.timeout = timeout
+
+    def __repr__(self):
+        return 'ExternalCommand({!r})'.format(self.command)
+
+    def __call__(self, data, filename):
+        cmd = (self.command, filename)
+        module_logger.debug("Running: {}".format(cmd))
+        output = subprocess.run(cmd,
+                                timeout=self.timeout,
+                                check=True,
+                                stdout=subprocess.PIPE)
+        module_logger.debug('Post-processing output: {}'.format(output.stdout))
+        return output.returncode
+
+
+def call_with_isbd(func, data, filename):
+    """Parse the message, unless already an IridiumSBD, and call func with it
+
+    Module level, so it can be pickled into a process pool together with a
+    module level func.
+    """
+    if not isinstance(data, IridiumSBD):
+        data = IridiumSBD(data)
+    return func(data)
+
+
+class PostProcessingPool(object):
+    """Persistent pool of workers running post-processing tasks.
+
+    Args:
+        task (callable): Called as task(data, filename), see ExternalCommand
+            and call_with_isbd.
+        mode (str): 'thread' or 'process' pool.
+        workers (int): Maximum number of concurrent tasks.
+        timeout (float): Maximum time, in seconds, waiting for each attempt.
+            An attempt that times out is abandoned, not interrupted, so it
+            keeps one worker busy until it finishes.
+        retries (int): Extra attempts after a failure.
+        backoff (float): Delay before the first retry, doubled on each
+            following one.
+        max_pending (int): Maximum number of tasks waiting, beyond that
+            submit() blocks.
+    """
+    def __init__(self,
+                 task,
+                 mode='thread',
+                 workers=4,
+                 timeout=60,
+                 retries=2,
+                 backoff=1.0,
+                 max_pending=1024):
+        self.logger = logging.getLogger('DirectIP.PostProcessingPool')
+        assert mode in ('thread', 'process'), \
+            "Invalid mode: {}".format(mode)
+        self.task = task
+        self.mode = mode
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        if mode == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Supervise each task: wait for it, retry, give up
+        self.supervisor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.logger.debug('Post-processing {} with {} {} worker(s)'.format(
+            task, workers, mode))
+
+    def submit(self, data, filename=None):
+        """Schedule post-processing of a message"""
+        self.pending.acquire()
+        future = self.supervisor.submit(self._run, data, filename)
+        future.add_done_callback(lambda f: self.pending.release())
+        return future
+
+    def _run(self, data, filename):
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            started = time.monotonic()
+            future = self.executor.submit(self.task, data, filename)
+            try:
+                result = future.result(timeout=self.timeout)
+            except TimeoutError:
+                self.logger.warning(
+                    'Post-processing of {} timed out (attempt {})'.format(
+                        filename, attempt + 1))
+            except Exception as e:
+                self.logger.warning(
+                    'Post-processing of {} failed (attempt {}): {}'.format(
+                        filename, attempt + 1, e))
+            else:
+                metrics.postprocessed.inc()
+                return result
+            finally:
+                metrics.postprocessing_duration.observe(
+                    time.monotonic() - started)
+        metrics.postprocessing_failed.inc()
+        self.logger.error('Giving up post-processing of {}'.format(filename))
+
+    def close(self, wait=True):
+        """Wait for the scheduled tasks and stop the workers"""
+        self.supervisor.shutdown(wait=wait)
+        self.executor.shutdown(wait=wait)
+
+
+def make_task(spec, timeout=60):
+    """Post-processing task from the --post-processing option
+
+    An existing file, or a command found in the PATH, is taken as an
+    external command, otherwise spec is loaded as a Python callable (see
+    load_callable).
+    """
+    if os.path.exists(spec):
+        return ExternalCommand(spec, timeout=timeout)
+    command = shutil.which(spec)
+    if command is not None:
+        return ExternalCommand(command, timeout=timeout)
+    return functools.partial(call_with_isbd, load_callable(spec))
+
+
+def make_postprocessing(spec, mode='thread', **kwargs):
+    """Create a PostProcessingPool from the --post-processing option
+
+    See make_task. Extra keyword arguments are passed to
+    PostProcessingPool.
+    """
+    task = make_task(spec, timeout=kwargs.get('timeout', 60))
+    return PostProcessingPool(task, mode=mode, **kwargs)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+"""Live fan-out of the messages received to local subscribers.
+
+The post-processing runs a command, or a function, for each message. To
+react to new messages from long-lived programs (dashboards, alarms,
+bridges to other systems), a Publisher pushes every message saved to any
+number of subscribers connected to a Unix-domain socket or a TCP port.
+
+The protocol is line based. A subscriber connects and sends one line with
+the IMEIs it is interested in, separated by spaces, or an empty line for
+all of them. From then on it receives one JSON object per line for each
+message, with the same fields as the JSON Lines export (the filename is
+where the message was saved), plus the receiving time, the client address
+and the original binary message in hexadecimal (data).
+
+Each subscriber has a bounded buffer, written to its socket by its own
+thread, so publishing never waits for a subscriber. When a subscriber
+doesn't keep up and its buffer is full, the policy defines what happens:
+
+    - drop: the oldest message in the buffer is dropped;
+    - disconnect: the subscriber is disconnected.
+"""
+
+import binascii
+from collections import deque
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+from ..export import message_row, as_text
+from ..iridiumSBD import IridiumSBD
+from . import metrics
+
+
+module_logger = logging.getLogger('DirectIP')
+
+POLICIES = ('drop', 'disconnect')
+
+# Longest subscription line accepted, about 250 IMEIs
+MAX_SUBSCRIPTION = 4096
+
+
+def parse_address(address):
+    """A Unix socket path, or (host, port) from 'host:port' or 'port'"""
+    host, sep, port = address.rpartition(':')
+    if port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def remove_socket(path):
+    """Remove a Unix socket left by a previous run, but nothing else"""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(
+            'Not a socket, refusing to replace it: {}'.format(path))
+    os.remove(path)
+
+
+def message_event(data, filename=None, client_address=None, t0=None):
+    """The line published for a message, and its IMEI"""
+    row = as_text(message_row(IridiumSBD(data), filename))
+    row['received'] = t0.isoformat() if t0 is not None else None
+    row['client_address'] = client_address[0] if client_address else None
+    row['data'] = binascii.hexlify(data).decode()
+    return (json.dumps(row) + '\n').encode('utf-8'), row['IMEI']
+
+
+class Subscriber(object):
+    """Buffer of the messages waiting to be sent to one subscriber
+
+    Args:
+        connection (socket): Connected to the subscriber.
+        imeis (frozenset): IMEIs to receive, None for all.
+        buffer_size (int): Maximum number of messages in the buffer.
+    """
+    def __init__(self, connection, imeis=None, buffer_size=1024):
+        self.connection = connection
+        self.imeis = imeis
+        self.buffer = deque(maxlen=buffer_size)
+        self.ready = threading.Condition()
+        self.closed = False
+
+    def wants(self, imei):
+        return (self.imeis is None) or (imei in self.imeis)
+
+    def push(self, event):
+        """Buffer an event, returning False if the buffer was full"""
+        with self.ready:
+            full = len(self.buffer) == self.buffer.maxlen
+            # A full deque discards the oldest event
+            self.buffer.append(event)
+            self.ready.notify()
+        return not full
+
+    def take(self):
+        """Wait for the buffered events, an empty list once closed"""
+        with self.ready:
+            while not (self.buffer or self.closed):
+                self.ready.wait()
+            if self.closed:
+                return []
+            events = list(self.buffer)
+            self.buffer.clear()
+        return events
+
+    def close(self):
+        """Stop sending, even if blocked writing to a slow subscriber"""
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class SubscriberHandler(socketserver.StreamRequestHandler):
+    # A subscriber must say what it wants right after connecting
+    timeout = 10
+
+    def handle(self):
+        logger = logging.getLogger('DirectIP.Publisher')
+        try:
+            line = self.rfile.readline(MAX_SUBSCRIPTION)
+        except socket.timeout:
+            logger.warning('Subscriber sent no subscription')
+            return
+        imeis = frozenset(line.decode('ascii', 'replace').split()) or None
+        self.request.settimeout(None)
+        publisher = self.server.publisher
+        subscriber = Subscriber(self.request, imeis, publisher.buffer_size)
+        logger.info('New subscriber for {}'.format(
+            'all IMEIs' if imeis is None else ', '.join(sorted(imeis))))
+        publisher.add(subscriber)
+        try:
+            while True:
+                events = subscriber.take()
+                if not events:
+                    break
+                self.wfile.write(b''.join(events))
+        except OSError as e:
+            logger.info('Subscriber disconnected: {}'.format(e))
+        finally:
+            publisher.remove(subscriber)
+
+
+class PublisherTCPServer(socketserver.ThreadingMixIn,
+                         socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class PublisherUnixServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Publisher(object):
+    """Push the messages saved to the connected subscribers
+
+    Args:
+        address: Path of a Unix-domain socket, or (host, port) to listen on
+            TCP. Prefer a local address, there is no authentication.
+        buffer_size (int): Maximum number of messages waiting to be sent
+            to each subscriber.
+        policy (str): What to do with a subscriber whose buffer is full,
+            one of POLICIES.
+    """
+    def __init__(self, address, buffer_size=1024, policy='drop'):
+        self.logger = logging.getLogger('DirectIP.Publisher')
+        assert policy in POLICIES, "Invalid policy: {}".format(policy)
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+        if isinstance(address, str):
+            remove_socket(address)
+            self.server = PublisherUnixServer(address, SubscriberHandler)
+            self.address = address
+        else:
+            self.server = PublisherTCPServer(address, SubscriberHandler)
+            self.address = self.server.server_address[:2]
+        self.server.publisher = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name='DirectIP-publisher')
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('Publishing messages on {}'.format(self.address))
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def add(self, subscriber):
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+    def remove(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, data, filename=None, client_address=None, t0=None):
+        """Send a message to the subscribers interested in its IMEI"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        # Nobody is listening, don't even parse it
+        if not subscribers:
+            return
+        try:
+            event, imei = message_event(data, filename, client_address, t0)
+        except Exception as e:
+            self.logger.warning('Failed to publish a message: {}'.format(e))
+            return
+        for subscriber in subscribers:
+            if not subscriber.wants(imei):
+                continue
+            metrics.published.inc()
+            if subscriber.push(event):
+                continue
+            if self.policy == 'drop':
+                metrics.published_dropped.inc()
+            else:
+                self.logger.warning('Disconnecting slow subscriber')
+                metrics.slow_subscribers.inc()
+                self.remove(subscriber)
+                subscriber.close()
+
+    def close(self):
+        """Stop listening and disconnect all subscribers"""
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+        if isinstance(self.address, str):
+            remove_socket(self.address)
+
+
+def subscribe(address, imeis=None, timeout=None):
+    """Receive the messages published, as dicts (see Publisher)
+
+    Args:
+        address: Path of the Unix-domain socket, or (host, port).
+        imeis (list): IMEIs to receive, all of them by default.
+        timeout (float): Seconds waiting for a message before giving up
+            with socket.timeout, None to wait forever.
+
+    Yields:
+        dict: Fields of each message, as in the JSON Lines export.
+    """
+    if isinstance(address, str):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(address)
+    else:
+        connection = socket.create_connection(address, timeout)
+    try:
+        connection.sendall(' '.join(imeis or []).encode('ascii') + b'\n')
+        with connection.makefile('rb') as lines:
+            for line in lines:
+                yield json.loads(line.decode('utf-8'))
+    finally:
+        connection.close()
@@ -7,24 +7,42 @@ and transmitting binary messages.
 """
 
 from datetime import datetime
+import concurrent.futures
+import functools
 import json
+import signal
 import socket
 from io import open
 import os.path
 import logging
 import re
-import subprocess
+import select
+import sys
+import threading
+import time
 try:
     import socketserver
 except:
     import SocketServer as socketserver
 
 from .. import __version__
-from ..iridiumSBD import valid_isbd, is_truncated
+from ..iridiumSBD import StreamParser, is_outbound
+from . import metrics
+from .dedup import message_key
+from .mtclient import MTClient
+from .postprocessing import make_postprocessing
+from .writer import WriteBehindQueue
 
 
 module_logger = logging.getLogger('DirectIP')
 
+# Acknowledgment sent back to the gateway for every valid MO message
+#ACK = struct.pack('>cHcHb', b'1', 4, b'\x05', 1, 1)
+ACK = b'1\x00\x04\x05\x00\x01\x01'
+
+# What to do with new connections above max_connections
+CONNECTION_POLICIES = ('refuse', 'wait')
+
 
 def save_isbd_msg(outputdir, client_address, data, t0):
     if not os.path.isdir(os.path.join(outputdir, 'inbox')):
@@ -39,6 +57,28 @@ def save_isbd_msg(outputdir, client_address, data, t0):
     return filename
 
 
+def save_isbd_batch(outputdir, batch):
+    """Save a sequence of messages, each one in its own file
+
+    Equivalent to save_isbd_msg() on each item of the batch (anything with
+    client_address, data and t0 attributes), but checking the inbox only once.
+    """
+    inbox = os.path.join(outputdir, 'inbox')
+    if not os.path.isdir(inbox):
+        os.mkdir(inbox)
+    filenames = []
+    for item in batch:
+        filename = os.path.join(
+                inbox, "%s_%s.isbd" % (
+                    item.t0.strftime('%Y%m%d%H%M%S%f'),
+                    item.client_address[0]))
+        with open(filename, 'wb') as fid:
+            fid.write(item.data)
+        filenames.append(filename)
+    module_logger.debug("Saved {} message(s)".format(len(filenames)))
+    return filenames
+
+
 def save_corrupted_msg(outputdir, client_address, data, t0):
     if not os.path.isdir(os.path.join(outputdir, 'corrupted')):
         os.mkdir(os.path.join(outputdir, 'corrupted'))
@@ -49,6 +89,186 @@ def save_corrupted_msg(outputdir, client_address, data, t0):
     with open(filename, 'wb') as fid:
         fid.write(data)
     module_logger.debug("Saved: {}".format(filename))
+    return filename
+
+
+class InboxStorage(object):
+    """Storage of one file per message (the original layout)
+
+    Valid messages are saved in datadir/inbox and the corrupted ones in
+    datadir/corrupted. See store.SegmentStorage for an alternative.
+    """
+    def __init__(self, datadir):
+        self.datadir = datadir
+
+    def save_batch(self, batch):
+        """Save queued messages, returning the filename of each one"""
+        filenames = iter(save_isbd_batch(
+                self.datadir, [item for item in batch if not item.corrupted]))
+        output = []
+        for item in batch:
+            if item.corrupted:
+                output.append(save_corrupted_msg(
+                    self.datadir, item.client_address, item.data, item.t0))
+            else:
+                output.append(next(filenames))
+        return output
+
+    def close(self):
+        pass
+
+
+def persist_batch(storage, batch, postProcessing=None, journal=None,
+                  publisher=None):
+    """Persist a batch of queued messages, used by the WriteBehindQueue
+
+    Corrupted messages are only saved, while the valid ones are saved and
+    then submitted to the post-processing pool, together with their location
+    in the storage (a filename for InboxStorage), and to the subscribers of
+    the publisher. Messages that came through the journal (a GroupCommitLog)
+    are then released from it, so the storage must have saved them when
+    save_batch returns.
+    """
+    locations = storage.save_batch(batch)
+    if journal is not None:
+        for item in batch:
+            if item.journal is not None:
+                journal.release(item.journal)
+
+    now = time.monotonic()
+    for item in batch:
+        if item.queued is not None:
+            metrics.ack_to_persist.observe(now - item.queued)
+    metrics.persisted.inc(len(batch))
+
+    if postProcessing is not None:
+        for item, location in zip(batch, locations):
+            if not item.corrupted:
+                postProcessing.submit(item.data, location)
+    if publisher is not None:
+        for item, location in zip(batch, locations):
+            if not item.corrupted:
+                publisher.publish(
+                    item.data, location, item.client_address, item.t0)
+    return locations
+
+
+def check_duplicate(dedup, data):
+    """Record a message in a DedupCache, returning False if already there
+
+    Otherwise returns its key (None if there is no cache or the message has
+    no key), to be removed if the message is not queued after all.
+    """
+    if dedup is None:
+        return None
+    key = message_key(data)
+    if key is None:
+        return None
+    return key if dedup.add(key) else False
+
+
+def replay_journal(journal, writer):
+    """Queue again the messages left in the journal by a previous run"""
+    if journal is None:
+        return
+    for client_address, data, t0, ticket in journal.replay():
+        if not writer.put(client_address, data, t0, journal=ticket):
+            module_logger.error(
+                'Write-behind queue is full, message left in the journal')
+
+
+def next_timeout(read_timeout, deadline):
+    """Timeout for the next read of a connection
+
+    The smallest of read_timeout (seconds without receiving anything) and
+    the time left until the deadline of the session (time.monotonic()),
+    any of them can be None for no limit.
+
+    Returns:
+        (timeout, session): session is True if the timeout is the deadline
+            of the session, and then timeout can be negative if it passed.
+    """
+    if deadline is None:
+        return read_timeout, False
+    remaining = deadline - time.monotonic()
+    if (read_timeout is None) or (remaining < read_timeout):
+        return remaining, True
+    return read_timeout, False
+
+
+def readable(sock, timeout):
+    """Whether sock has something to read within timeout seconds
+
+    Uses poll(), since select() fails on descriptors above FD_SETSIZE
+    (1024), which a server with thousands of connections reaches.
+    """
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(timeout * 1000))
+
+
+def timed_out(logger, client_address, session):
+    """Log and count a connection closed on a timeout"""
+    if session:
+        logger.warning('Session deadline expired, closing connection'
+                       ' from {}'.format(client_address[0]))
+        metrics.session_timeouts.inc()
+    else:
+        logger.warning('Read timeout, closing connection from {}'.format(
+            client_address[0]))
+        metrics.read_timeouts.inc()
+
+
+def relay_allowed(logger, mt_client, relay_from, client_address):
+    """Whether an MT message from client_address can be forwarded
+
+    Anyone reaching the port could otherwise send commands to the devices
+    through the gateway, thus only the addresses in relay_from can.
+    """
+    if client_address[0] not in relay_from:
+        logger.warning('MT message from {}, not allowed to relay'.format(
+            client_address[0]))
+        metrics.relay_refused.inc()
+        return False
+    if mt_client is None:
+        logger.error('Missing Iridium address, can not forward MT message')
+        return False
+    return True
+
+
+def start_mt_client(logger, outbound_address, mt_queue):
+    """MTClient to the gateway, draining mt_queue as well, or None
+
+    Called once the server socket is bound, so nothing is left running if
+    that fails.
+    """
+    if outbound_address is None:
+        if mt_queue is not None:
+            logger.warning(
+                'Missing Iridium address, the MT queue is not sent.')
+        return None
+    mt_client = MTClient(outbound_address)
+    if mt_queue is not None:
+        mt_queue.start(mt_client)
+    return mt_client
+
+
+def init_postprocessing(postProcessing):
+    """Load the post-processing, if given as a string
+
+    Returns a PostProcessingPool (or None), so it is loaded only once and
+    not for each message.
+    """
+    if isinstance(postProcessing, str):
+        try:
+            postProcessing = make_postprocessing(postProcessing)
+        except Exception:
+            module_logger.critical(
+                    "Invalid postProcessing: %s" % postProcessing)
+            raise
+    if postProcessing is not None:
+        module_logger.info('Post-processing: {}'.format(postProcessing.task))
+    return postProcessing
 
 
 class DirectIPHandler(socketserver.BaseRequestHandler):
@@ -74,65 +294,177 @@ class DirectIPHandler(socketserver.BaseRequestHandler):
         multiple recv() until gets a newline character.
         It is OK to use a buffer of 2048, since the largest message that an
         Iridium can send is 1960 bytes (9522A/B) plus a header of 51 bytes.
+
+        The bytes received are pushed into a StreamParser, which gives each
+        message as soon as it is complete. Several messages may come
+        back-to-back on the same connection, and each one is acknowledged.
+
+        A client can't hold the thread forever: the connection is closed
+        after read_timeout seconds without receiving anything, or once
+        session_timeout seconds passed since it was accepted. Whatever was
+        received of an incomplete message is saved as corrupted.
         """
-        #self.request.settimeout(1)
         self.logger.debug('Receiving a call from %s' % self.client_address[0])
         t0 = datetime.utcnow()
-        # self.request is the TCP socket connected to the client
-        self.data = self.request.recv(2048)
-        self.logger.debug('Message received, %s bytes' % (len(self.data)))
-
-        for i in range(10):
-            if not is_truncated(self.data):
+        self.started = time.monotonic()
+        self.recv_calls = 0
+        deadline = None
+        if self.server.session_timeout is not None:
+            deadline = self.started + self.server.session_timeout
+        parser = StreamParser()
+        while True:
+            chunk = self.receive(deadline)
+            if not chunk:
+                break
+            self.recv_calls += 1
+            self.logger.debug('Received %s bytes' % (len(chunk)))
+            for data in parser.feed(chunk):
+                if is_outbound(data):
+                    if not self.relay(data):
+                        return
+                elif not self.acknowledge(data, t0):
+                    return
+                t0 = datetime.utcnow()
+            if parser.corrupted:
+                break
+            if len(parser) > 0:
+                self.logger.debug('Message incomplete. Waiting for the rest')
+            elif not readable(self.request, self.linger(deadline)):
                 break
-            self.logger.debug('Message incomplete. Waiting for the rest')
-            self.data += self.request.recv(2048)
-            self.logger.debug(
-                    'Extending message to %s bytes' % (len(self.data)))
 
-        if not valid_isbd(self.data):
+        if len(parser) > 0:
             self.logger.error('Invalid message.')
-            save_corrupted_msg(
-                    self.server.datadir, self.client_address, self.data, t0)
-            return
+            metrics.corrupted.inc()
+            self.server.writer.put(
+                    self.client_address, parser.pending(), t0, corrupted=True)
+
+    def linger(self, deadline):
+        """Seconds to wait for another message, within the session"""
+        linger = self.server.linger
+        if deadline is not None:
+            linger = min(linger, deadline - time.monotonic())
+        return max(linger, 0)
+
+    def receive(self, deadline):
+        """Next chunk from the client, b'' if closed or on a timeout"""
+        timeout, session = next_timeout(self.server.read_timeout, deadline)
+        if session and (timeout <= 0):
+            timed_out(self.logger, self.client_address, session)
+            return b''
+        # self.request is the TCP socket connected to the client
+        self.request.settimeout(timeout)
+        try:
+            return self.request.recv(2048)
+        except socket.timeout:
+            timed_out(self.logger, self.client_address, session)
+            return b''
+
+    def acknowledge(self, data, t0):
+        """Queue a complete message to be saved and acknowledge it
+
+        Saving and post-processing are done later by the writer threads,
+        thus the gateway is released without waiting for the disk. Copies
+        of a message already received (see DedupCache) are acknowledged but
+        not queued.
+        """
+        metrics.received.inc()
+        metrics.message_bytes.observe(len(data))
+        metrics.recv_calls.observe(self.recv_calls)
+        self.recv_calls = 0
+        key = check_duplicate(self.server.dedup, data)
+        if key is False:
+            self.logger.info('Duplicated message, acknowledging only.')
+        elif not self.queue_message(data, t0):
+            if key:
+                self.server.dedup.discard(key)
+            return False
 
         # Acknowledgment message
         self.logger.debug('Acknowledging message received.')
-        #ack = struct.pack('>cHcHb', b'1', 4, b'\x05', 1, 1)
-        ack = b'1\x00\x04\x05\x00\x01\x01'
-        s = self.request.send(ack)
-
-        #self.data = self.request.recv(1024).strip()
-        # self.rfile is a file-like object created by the handler;
-        # we can now use e.g. readline() instead of raw recv() calls
-        #self.data = self.rfile.readline().strip()
-        filename = save_isbd_msg(self.server.datadir, self.client_address,
-                                 self.data, t0)
-
-        if self.server.postProcessing is not None:
-            postProcessing = self.server.postProcessing
-            self.logger.debug('External post-processing: {}'.format(
-                postProcessing))
-            cmd = (postProcessing, filename)
-            self.logger.debug("Running: {}".format(cmd))
+        self.request.send(ACK)
+        now = time.monotonic()
+        metrics.accept_to_ack.observe(now - self.started)
+        metrics.acked.inc()
+        self.started = now
+        return True
+
+    def queue_message(self, data, t0):
+        """Queue a valid message, first syncing it to the journal if any
+
+        With a journal (durable acknowledgments), this waits until the
+        message is on disk, synced together with the messages of the other
+        connections (see GroupCommitLog).
+
+        Returns:
+            bool: False if the message should not be acknowledged.
+        """
+        journal = self.server.journal
+        ticket = None
+        if journal is not None:
             try:
-                output = subprocess.run(cmd,
-                                        timeout=60,
-                                        check=True,
-                                        stdout=subprocess.PIPE)
-                self.logger.debug(
-                    'Post-processing output: {}'.format(output.stdout))
-            except:
-                self.logger.warn('Failed to run external post-processing')
+                ticket = journal.commit(self.client_address, data, t0)
+            except Exception as e:
+                self.logger.error('Failed to journal message: {}'.format(e))
+                return False
+        if not self.server.writer.put(
+                self.client_address, data, t0, journal=ticket):
+            self.logger.error('Write-behind queue is full, not acknowledging')
+            if ticket is not None:
+                journal.release(ticket)
+            return False
+        return True
+
+    def relay(self, data):
+        """Forward an MT message to the Iridium Gateway
+
+        The client that sent the MT message receives back the confirmation
+        given by the gateway. Only clients in the server relay_from are
+        allowed.
+        """
+        if not self.server.relay_allowed(self.client_address):
+            return False
+        self.logger.debug('Forwarding MT message to the Iridium Gateway.')
+        try:
+            confirmation = self.server.mt_client.submit(data).result(
+                    self.server.relay_timeout)
+        except concurrent.futures.TimeoutError:
+            self.logger.error('Timed out forwarding MT message')
+            return False
+        except Exception as e:
+            self.logger.error('Failed to forward MT message: {}'.format(e))
+            return False
+        self.request.send(confirmation)
+        return True
 
 
 class DirectIPServer(socketserver.TCPServer):
     """A TCPServer modified for Direct-IP communication.
     """
+    # The default backlog, 5, overflows on bursts of connections from the
+    # gateway, which are then reset
+    request_queue_size = 128
+
     def __init__(self,
                  server_address,
                  datadir,
-                 postProcessing=None):
+                 postProcessing=None,
+                 queue_size=1024,
+                 queue_policy='block',
+                 writers=1,
+                 storage=None,
+                 linger=0,
+                 outbound_address=None,
+                 mt_queue=None,
+                 dedup=None,
+                 reuse_port=False,
+                 read_timeout=10,
+                 session_timeout=60,
+                 max_connections=None,
+                 connection_policy='refuse',
+                 journal=None,
+                 publisher=None,
+                 relay_from=None,
+                 relay_timeout=30):
         self.logger = logging.getLogger('DirectIP.Server')
         self.logger.info(
                 'Initializing DirectIPServer version: {}'.format(__version__))
@@ -143,13 +475,94 @@ class DirectIPServer(socketserver.TCPServer):
         self.datadir = datadir
         self.logger.info('Data directory: {}'.format(datadir))
 
-        if (postProcessing != None) and (not os.path.exists(postProcessing)):
-            self.logger.error(
-                    "Invalid postProcessing: %s" % postProcessing)
-        self.postProcessing = postProcessing
-
+        self.postProcessing = init_postprocessing(postProcessing)
+
+        if storage is None:
+            storage = InboxStorage(datadir)
+        self.storage = storage
+        # Time waiting for another message on the same connection
+        self.linger = linger
+        # Started once the socket is bound, see start_mt_client()
+        self.outbound_address = outbound_address
+        self.mt_client = None
+        self.relay_from = frozenset(relay_from or ())
+        # Seconds waiting for the gateway confirmation of a relayed message
+        self.relay_timeout = relay_timeout
+        self.mt_queue = mt_queue
+        self.dedup = dedup
+        # Several processes listening on the same port (see workers.py)
+        self.reuse_port = reuse_port
+        self.read_timeout = read_timeout
+        self.session_timeout = session_timeout
+        assert connection_policy in CONNECTION_POLICIES, \
+            "Invalid connection_policy: {}".format(connection_policy)
+        self.max_connections = max_connections
+        self.connection_policy = connection_policy
+        # No limit by default
+        self.slots = None
+        if max_connections is not None:
+            self.slots = threading.BoundedSemaphore(max_connections)
+        # Set by shutdown(), for a connection waiting for a slot
+        self.stopping = threading.Event()
+        # Durable acknowledgments (see journal.py)
+        self.journal = journal
+        self.publisher = publisher
+
+        # If binding fails, server_close() is called before the writer exists
+        self.writer = None
         socketserver.TCPServer.__init__(
                 self, server_address, RequestHandlerClass=DirectIPHandler)
+        self.mt_client = start_mt_client(
+                self.logger, outbound_address, mt_queue)
+
+        self.writer = WriteBehindQueue(
+                functools.partial(persist_batch,
+                                  self.storage,
+                                  postProcessing=self.postProcessing,
+                                  journal=journal,
+                                  publisher=publisher),
+                maxsize=queue_size,
+                policy=queue_policy,
+                workers=writers)
+        replay_journal(journal, self.writer)
+
+    def server_close(self):
+        """Stop listening and flush the messages still in memory
+
+        The connections still being handled finish first, so whatever they
+        acknowledge is queued before the writer is closed.
+        """
+        socketserver.TCPServer.server_close(self)
+        self.join_handlers()
+        if self.writer is not None:
+            self.writer.close()
+        self.storage.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.postProcessing is not None:
+            self.postProcessing.close()
+        if self.mt_queue is not None:
+            self.mt_queue.close()
+        if self.mt_client is not None:
+            self.mt_client.close()
+        if self.dedup is not None:
+            self.dedup.close()
+
+    def join_handlers(self):
+        """Wait for the connections being handled, if in other threads"""
+        pass
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socketserver.TCPServer.server_bind(self)
+
+    def relay_allowed(self, client_address):
+        return relay_allowed(self.logger, self.mt_client, self.relay_from,
+                             client_address)
 
     def verify_request(self, request, client_address):
         self.logger.debug('verify_request(%s, %s)', request, client_address)
@@ -158,10 +571,76 @@ class DirectIPServer(socketserver.TCPServer):
 
 
 class ThreadedDirectIPServer(socketserver.ThreadingMixIn, DirectIPServer):
-    pass
+    """DirectIPServer with one thread per connection
 
-
-def runserver(host, port, datadir, postProcessing=None):
+    At most max_connections, if given, are served at once. Above that, new
+    connections are closed right away ('refuse'), so the gateway tries again
+    later, or left waiting in the accept queue of the kernel until a thread
+    is free ('wait').
+    """
+    def process_request(self, request, client_address):
+        if not self.acquire_slot():
+            if not self.stopping.is_set():
+                self.logger.warning(
+                    'Too many connections, refusing %s' % client_address[0])
+                metrics.refused.inc()
+            self.shutdown_request(request)
+            return
+        try:
+            socketserver.ThreadingMixIn.process_request(
+                    self, request, client_address)
+        except Exception:
+            self.release_slot()
+            raise
+
+    def acquire_slot(self):
+        """Take a slot for a new connection, False if there is none
+
+        With the 'wait' policy, this blocks the serve_forever() loop, thus
+        the next connections stay in the accept queue, but still gives up
+        once shutdown() is called.
+        """
+        if self.slots is None:
+            return True
+        if self.connection_policy != 'wait':
+            return self.slots.acquire(blocking=False)
+        while not self.slots.acquire(timeout=0.1):
+            if self.stopping.is_set():
+                return False
+        return True
+
+    def release_slot(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    def shutdown(self):
+        self.stopping.set()
+        DirectIPServer.shutdown(self)
+
+    def join_handlers(self):
+        # ThreadingMixIn only joins its threads after server_close()
+        threads = getattr(self, '_threads', None)
+        if hasattr(threads, 'join'):
+            threads.join()
+        else:
+            for thread in list(threads or ()):
+                thread.join()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                    self, request, client_address)
+        finally:
+            self.release_slot()
+
+
+def runserver(host, port, datadir, postProcessing=None, backend='threaded',
+              queue_size=1024, queue_policy='block', writers=1,
+              storage=None, linger=0, outbound_address=None, mt_queue=None,
+              dedup=None, workers=1, setup=None, registry=None,
+              read_timeout=10, session_timeout=60, max_connections=None,
+              connection_policy='refuse', journal=None, publisher=None,
+              relay_from=None):
     """Runs a Direct-IP server to listen for messages.
 
     Initiate DirectIPServer and keep it alive listening for calls.
@@ -172,15 +651,97 @@ def runserver(host, port, datadir, postProcessing=None):
         postProcessing (str): Optional command or script to be called for each
             mesage received.  It's better to use a absolute path. A filename
             with the message just received will be the single argument.
+            It can also be a Python callable as 'module:function', or an
+            already configured PostProcessingPool.
+        backend (str): Server implementation, 'threaded' (one thread per
+            connection) or 'asyncio' (single event loop, see
+            AsyncDirectIPServer).
+        queue_size (int): Maximum number of messages waiting to be saved.
+        queue_policy (str): What to do when the queue is full: 'block',
+            'reject' or 'inline' (see WriteBehindQueue).
+        writers (int): Number of threads saving messages.
+        storage: Where to save the messages. Default is InboxStorage, one
+            file per message. See also store.SegmentStorage.
+        linger (float): Seconds to wait for another message on the same
+            connection after a complete one. With the default, 0, only
+            messages already received back-to-back are handled.
+        outbound_address (tuple): (host, port) of the Iridium Gateway. MT
+            messages received from relay_from are forwarded to it (see
+            MTClient), and the gateway confirmation is given back to the
+            sender.
+        mt_queue (MTQueue): Durable queue of MT messages, drained toward
+            the gateway at outbound_address.
+        dedup (DedupCache): Recently received messages. Copies of them,
+            retransmitted by the gateway, are acknowledged but neither saved
+            nor post-processed.
+        workers (int): Number of server processes sharing the port (see
+            workers.runworkers). With more than one, anything that can't be
+            shared among processes, like storage, mt_queue, dedup or an
+            already created PostProcessingPool, must be given by setup.
+        setup (callable): Called in each worker process with its number,
+            returning extra keyword arguments for its server.
+        registry (AggregateRegistry): Receives the metrics of the workers.
+        read_timeout (float): Seconds without receiving anything before
+            closing a connection, None for no limit.
+        session_timeout (float): Maximum seconds of a connection, however
+            fast it trickles in, None for no limit.
+        max_connections (int): Maximum number of simultaneous connections
+            of each process, None (default) for no limit.
+        connection_policy (str): Above max_connections, 'refuse' closes the
+            new connections right away and 'wait' holds them until a slot
+            is free.
+        journal (GroupCommitLog): Sync each message to this journal before
+            acknowledging it, so no acknowledged message is lost in a crash.
+            Like storage, each worker must have its own.
+        publisher (Publisher): Pushes each message saved to the connected
+            subscribers (see pubsub.py). Each worker must have its own.
+        relay_from (list): Client IP addresses allowed to send MT messages
+            to be forwarded to outbound_address. By default none is, and MT
+            messages received are refused.
     """
     module_logger.debug('Initializing runserver().')
+    options = dict(queue_size=queue_size,
+                   queue_policy=queue_policy,
+                   writers=writers,
+                   storage=storage,
+                   linger=linger,
+                   outbound_address=outbound_address,
+                   mt_queue=mt_queue,
+                   dedup=dedup,
+                   read_timeout=read_timeout,
+                   session_timeout=session_timeout,
+                   max_connections=max_connections,
+                   connection_policy=connection_policy,
+                   journal=journal,
+                   publisher=publisher,
+                   relay_from=relay_from)
+    if workers > 1:
+        from .workers import runworkers
+        return runworkers(host, port, datadir, workers, setup=setup,
+                          backend=backend, registry=registry,
+                          postProcessing=postProcessing, **options)
+    if backend == 'asyncio':
+        from .aioserver import runaioserver
+        return runaioserver(host, port, datadir, postProcessing, **options)
+    assert backend == 'threaded', "Unknown backend: {}".format(backend)
+
     server = ThreadedDirectIPServer((host, port),
                                     datadir=datadir,
-                                    postProcessing=postProcessing)
+                                    postProcessing=postProcessing,
+                                    **options)
     module_logger.info('Listening as %s:%s' % (host, port))
+
+    # Stopped by kill or systemd, still flush the messages acknowledged
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
     try:
         server.serve_forever()
         module_logger.info('Server activated. To interrupt it: Ctrl-C')
     except KeyboardInterrupt:
         module_logger.warn('User terminated server')
         module_logger.debug('=====================')
+    except SystemExit:
+        module_logger.warn('Server terminated')
+    finally:
+        server.server_close()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""Several server processes listening on the same port.
+
+A single Python process uses about one core, however many threads it has.
+runworkers() forks workers processes, each one a complete server (threaded
+or asyncio) bound to the same port with SO_REUSEPORT, so the kernel spreads
+the connections among them.
+
+Anything that can't be shared by processes (post-processing pool, storage,
+dedup cache, MT queue) is created by each worker, after the fork, calling
+setup(worker) with its number. Every worker periodically sends the snapshot
+of its metrics to the supervisor, which adds them up in an
+AggregateRegistry to be exposed.
+
+The supervisor restarts any worker that dies, and on SIGTERM or Ctrl-C
+stops all of them, each one flushing its queue before exiting.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+
+from . import metrics
+
+
+module_logger = logging.getLogger('DirectIP')
+
+
+def _send_metrics(stats, worker, stopped, interval):
+    while not stopped.wait(interval):
+        stats.put((worker, metrics.REGISTRY.snapshot()))
+
+
+def _serve(host, port, datadir, backend, options):
+    """Run a server until SIGTERM, closing it before returning"""
+    if backend == 'asyncio':
+        from .aioserver import AsyncDirectIPServer
+
+        async def main():
+            server = AsyncDirectIPServer((host, port), datadir, **options)
+            await server.start()
+            stop = asyncio.Event()
+            asyncio.get_event_loop().add_signal_handler(
+                signal.SIGTERM, stop.set)
+            await stop.wait()
+            await server.close()
+        asyncio.run(main())
+        return
+
+    from .server import ThreadedDirectIPServer
+
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    server = ThreadedDirectIPServer((host, port), datadir, **options)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        server.server_close()
+
+
+def _worker(worker, host, port, datadir, backend, setup, options, stats,
+            stats_interval):
+    # Only the supervisor handles Ctrl-C, and then stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logger = logging.getLogger('DirectIP.Worker')
+    logger.info('Starting worker {}'.format(worker))
+    # Counted by this process only, not what was inherited from the fork
+    metrics.REGISTRY.reset()
+    options = dict(options, reuse_port=True)
+    if setup is not None:
+        options.update(setup(worker))
+
+    stopped = threading.Event()
+    sender = threading.Thread(
+        target=_send_metrics, args=(stats, worker, stopped, stats_interval))
+    sender.daemon = True
+    sender.start()
+    try:
+        _serve(host, port, datadir, backend, options)
+    finally:
+        stopped.set()
+        stats.put((worker, metrics.REGISTRY.snapshot()))
+        stats.close()
+        stats.join_thread()
+    logger.info('Worker {} stopped'.format(worker))
+
+
+class Supervisor(object):
+    """Start, watch and restart the server worker processes
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port shared by the workers, 0 for any free port.
+        datadir (str): Data directory.
+        workers (int): Number of worker processes.
+        backend (str): 'threaded' or 'asyncio'.
+        setup (callable): Called in each worker with its number (0 to
+            workers - 1), returning extra keyword arguments for the server.
+        stats_interval (float): Seconds between metrics from the workers.
+        restart_delay (float): Minimum seconds between starts of a worker,
+            so one that crashes on start doesn't restart in a tight loop.
+        registry (AggregateRegistry): Where the metrics of the workers are
+            added up, a new one by default.
+        **options: Keyword arguments for the server in every worker.
+    """
+    def __init__(self,
+                 host,
+                 port,
+                 datadir,
+                 workers,
+                 backend='threaded',
+                 setup=None,
+                 stats_interval=1.0,
+                 restart_delay=1.0,
+                 registry=None,
+                 **options):
+        assert hasattr(socket, 'SO_REUSEPORT'), \
+            "SO_REUSEPORT is not available, run a single worker"
+        self.logger = logging.getLogger('DirectIP.Supervisor')
+        self.datadir = datadir
+        self.workers = workers
+        self.backend = backend
+        self.setup = setup
+        self.options = options
+        self.stats_interval = stats_interval
+        self.restart_delay = restart_delay
+        if registry is None:
+            registry = metrics.AggregateRegistry()
+        self.registry = registry
+        self.restarts = 0
+
+        # Reserves the port, and resolves port 0, for the workers. It never
+        # listens, so the kernel gives it no connections.
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((host, port))
+        self.server_address = self.socket.getsockname()[:2]
+
+        self.context = multiprocessing.get_context('fork')
+        self.stats = self.context.Queue()
+        self.processes = {}
+        self.started = {}
+        self.stopped = threading.Event()
+
+    def start(self, worker):
+        host, port = self.server_address
+        process = self.context.Process(
+            target=_worker,
+            args=(worker, host, port, self.datadir, self.backend,
+                  self.setup, self.options, self.stats, self.stats_interval),
+            name='DirectIP-worker-{}'.format(worker))
+        process.start()
+        self.processes[worker] = process
+        self.started[worker] = time.monotonic()
+
+    def collect(self, timeout=0):
+        """Receive the metrics sent by the workers"""
+        try:
+            while True:
+                worker, snapshot = self.stats.get(timeout=timeout)
+                self.registry.update(worker, snapshot)
+                timeout = 0
+        except queue.Empty:
+            pass
+
+    def check(self):
+        """Restart the workers that died"""
+        for worker, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            self.logger.error(
+                'Worker {} died (exit code {}), restarting'.format(
+                    worker, process.exitcode))
+            process.join()
+            self.collect()
+            self.registry.retire(worker)
+            wait = self.started[worker] + self.restart_delay - \
+                time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.restarts += 1
+            self.start(worker)
+
+    def serve_forever(self):
+        for worker in range(self.workers):
+            self.start(worker)
+        self.logger.info('Listening as {}:{} with {} workers'.format(
+            self.server_address[0], self.server_address[1], self.workers))
+        while not self.stopped.is_set():
+            self.collect(timeout=self.stats_interval)
+            if not self.stopped.is_set():
+                self.check()
+
+    def shutdown(self, timeout=30):
+        """Stop the workers, waiting up to timeout seconds for each one"""
+        self.stopped.set()
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for worker, process in self.processes.items():
+            process.join(timeout)
+            if process.is_alive():
+                self.logger.error('Killing worker {}'.format(worker))
+                process.kill()
+                process.join()
+        self.collect()
+        self.socket.close()
+
+
+def runworkers(host, port, datadir, workers, setup=None, backend='threaded',
+               registry=None, **options):
+    """Run the Direct-IP server in several processes until interrupted
+
+    See Supervisor for the arguments.
+
+    Returns:
+        Supervisor: After it stopped, with the metrics of all the workers.
+    """
+    supervisor = Supervisor(host, port, datadir, workers, backend=backend,
+                            setup=setup, registry=registry, **options)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        supervisor.serve_forever()
+    except KeyboardInterrupt:
+        module_logger.warn('User terminated server')
+    finally:
+        supervisor.shutdown()
+    return supervisor
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Write-behind stage for the DirectIP servers.
+
+Saving a message (and running its post-processing) used to happen while
+holding the connection with the Iridium Gateway, so the time to release the
+gateway depended on disk latency. Instead, the handlers push each message
+into a bounded in-memory queue and dedicated writer threads drain it,
+persisting messages in batches.
+
+When the queue is full, the behavior is defined by a backpressure policy:
+
+    - block: the handler waits until there is room in the queue;
+    - reject: the message is not acknowledged, so the gateway retransmits it
+      later;
+    - inline: the handler persists the message itself (caller runs).
+
+On close() everything still in the queue is flushed before returning.
+
+A batch that fails to be persisted is tried again a few times, with an
+exponential backoff, before being dropped. Since those messages were already
+acknowledged, they are counted in metrics.persist_failed.
+
+Each QueuedMessage carries the time it was queued (time.monotonic()), which
+is right before the acknowledgment, so the delay until it is persisted can be
+measured (see metrics.ack_to_persist). With durable acknowledgments it also
+carries the ticket of the message in the journal (see
+journal.GroupCommitLog), released once the message is saved.
+"""
+
+from collections import namedtuple
+import logging
+import queue
+import threading
+import time
+
+from . import metrics
+
+
+module_logger = logging.getLogger('DirectIP')
+
+POLICIES = ('block', 'reject', 'inline')
+
+QueuedMessage = namedtuple(
+    'QueuedMessage',
+    ['client_address', 'data', 't0', 'corrupted', 'queued', 'journal'])
+QueuedMessage.__new__.__defaults__ = (None, None)
+
+_STOP = object()
+
+
+class WriteBehindQueue(object):
+    """Bounded queue of messages to be persisted by writer threads.
+
+    Args:
+        persist (callable): Called by the writers with a list of
+            QueuedMessage to be saved, for instance server.persist_batch.
+        maxsize (int): Maximum number of messages waiting in memory.
+        policy (str): Backpressure policy, one of POLICIES.
+        workers (int): Number of writer threads.
+        batch_size (int): Maximum number of messages persisted at once.
+        retries (int): Extra attempts to persist a batch after a failure.
+        backoff (float): Delay before the first retry, doubled on each
+            following one.
+    """
+    def __init__(self,
+                 persist,
+                 maxsize=1024,
+                 policy='block',
+                 workers=1,
+                 batch_size=64,
+                 retries=3,
+                 backoff=0.1):
+        self.logger = logging.getLogger('DirectIP.WriteBehindQueue')
+        assert policy in POLICIES, "Invalid policy: {}".format(policy)
+        assert maxsize > 0, "The queue must be bounded"
+        self.persist = persist
+        self.policy = policy
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+        self.workers = []
+        for i in range(workers):
+            t = threading.Thread(
+                target=self._work, name='DirectIP-writer-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        self.logger.debug('Started {} writer(s), queue size: {}'.format(
+            workers, maxsize))
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def try_put(self, client_address, data, t0, corrupted=False,
+                journal=None):
+        """Queue a message only if there is room for it right now"""
+        assert not self.closed, "Queue already closed"
+        try:
+            self.queue.put_nowait(QueuedMessage(
+                client_address, data, t0, corrupted, time.monotonic(),
+                journal))
+        except queue.Full:
+            return False
+        return True
+
+    def put(self, client_address, data, t0, corrupted=False, journal=None):
+        """Queue a message applying the backpressure policy
+
+        Returns:
+            bool: False if the message was rejected, thus it should not be
+                acknowledged to the gateway.
+        """
+        if self.try_put(client_address, data, t0, corrupted, journal):
+            return True
+
+        self.logger.warning('Write-behind queue is full ({} policy)'.format(
+            self.policy))
+        item = QueuedMessage(
+            client_address, data, t0, corrupted, time.monotonic(), journal)
+        if self.policy == 'block':
+            self.queue.put(item)
+        elif self.policy == 'inline':
+            self.persist([item])
+        elif self.policy == 'reject':
+            return False
+        return True
+
+    def close(self):
+        """Flush everything still queued and stop the writers"""
+        if self.closed:
+            return
+        self.closed = True
+        self.logger.debug('Flushing {} queued message(s)'.format(len(self)))
+        for t in self.workers:
+            self.queue.put(_STOP)
+        for t in self.workers:
+            t.join()
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            while (len(batch) < self.batch_size) and (batch[-1] is not _STOP):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self._persist(batch)
+            if stop:
+                return
+
+    def _persist(self, batch):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.persist(batch)
+                return
+            except Exception:
+                self.logger.exception(
+                    'Failed to persist {} message(s)'.format(len(batch)))
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        self.logger.error('Giving up {} acknowledged message(s)'.format(
+            len(batch)))
+        metrics.persist_failed.inc(len(batch))
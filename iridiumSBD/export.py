@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""Bulk export of saved ISBD messages into a single table.
+
+Walks a datadir (the inbox/ tree written by save_isbd_msg), parses the
+messages in parallel with a process pool and writes one consolidated
+output as CSV, JSON Lines or Parquet, one row per message.
+
+Parquet requires pyarrow, which is an optional dependency.
+"""
+
+import binascii
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from .iridiumSBD import IridiumSBD
+
+
+module_logger = logging.getLogger('DirectIP')
+
+COLUMNS = ['filename', 'mtype', 'CDR_reference', 'IMEI', 'session_status',
+           'MOMSN', 'MTMSN', 'session_datetime', 'latitude', 'longitude',
+           'CEP_radius', 'confirmation_status', 'payload_length', 'payload']
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+def list_messages(datadir):
+    """Sorted list of all .isbd files under datadir/inbox (or datadir)"""
+    inbox = os.path.join(datadir, 'inbox')
+    if not os.path.isdir(inbox):
+        inbox = datadir
+    filenames = []
+    for root, dirs, files in os.walk(inbox):
+        filenames.extend(
+            os.path.join(root, f) for f in files if f.endswith('.isbd'))
+    return sorted(filenames)
+
+
+def parse_file(filename):
+    """One row, as a dict with COLUMNS, for a saved message"""
+    with open(filename, 'rb') as f:
+        return message_row(IridiumSBD(f.read()), filename)
+
+
+def message_row(msg, filename=None):
+    """One row, as a dict with COLUMNS, for a parsed message"""
+    row = dict.fromkeys(COLUMNS)
+    row['filename'] = filename
+    row['mtype'] = msg.mtype
+    header = msg.attributes.get('header')
+    if header is not None:
+        for v in ('CDR_reference', 'IMEI', 'session_status', 'MOMSN',
+                  'MTMSN', 'session_datetime'):
+            row[v] = header.get(v)
+    location = msg.attributes.get('location')
+    if location is not None:
+        for v in ('latitude', 'longitude', 'CEP_radius'):
+            row[v] = location[v]
+    confirmation = msg.attributes.get('confirmation')
+    if confirmation is not None:
+        row['confirmation_status'] = confirmation['status']
+    if hasattr(msg, 'payload'):
+        row['payload_length'] = msg.payload['length']
+        row['payload'] = bytes(msg.payload['data'])
+    return row
+
+
+def parse_chunk(filenames):
+    """Parse a list of files, skipping (and logging) the invalid ones"""
+    rows = []
+    for filename in filenames:
+        try:
+            rows.append(parse_file(filename))
+        except Exception as e:
+            module_logger.warning(
+                'Failed to parse {}: {}'.format(filename, e))
+    return len(filenames), rows
+
+
+def as_text(row):
+    """Row with payload as hexadecimal and datetime in ISO format"""
+    row = dict(row)
+    if row['payload'] is not None:
+        row['payload'] = binascii.hexlify(row['payload']).decode()
+    if row['session_datetime'] is not None:
+        row['session_datetime'] = row['session_datetime'].isoformat()
+    return row
+
+
+class CSVWriter(object):
+    def __init__(self, output):
+        self.f = open(output, 'w', newline='')
+        self.writer = csv.DictWriter(self.f, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow(as_text(row))
+
+    def close(self):
+        self.f.close()
+
+
+class JSONLinesWriter(object):
+    def __init__(self, output):
+        self.f = open(output, 'w')
+
+    def write(self, rows):
+        for row in rows:
+            self.f.write(json.dumps(as_text(row)))
+            self.f.write('\n')
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter(object):
+    def __init__(self, output):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([
+            ('filename', pa.string()),
+            ('mtype', pa.string()),
+            ('CDR_reference', pa.uint32()),
+            ('IMEI', pa.string()),
+            ('session_status', pa.uint8()),
+            ('MOMSN', pa.uint16()),
+            ('MTMSN', pa.uint16()),
+            ('session_datetime', pa.timestamp('s')),
+            ('latitude', pa.float64()),
+            ('longitude', pa.float64()),
+            ('CEP_radius', pa.uint32()),
+            ('confirmation_status', pa.int16()),
+            ('payload_length', pa.uint16()),
+            ('payload', pa.binary()),
+            ])
+        self.writer = pq.ParquetWriter(output, self.schema)
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_table(
+                self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'csv': CSVWriter, 'jsonl': JSONLinesWriter,
+           'parquet': ParquetWriter}
+
+
+def export(datadir, output, fmt='csv', workers=None, chunksize=1000,
+           ordered=True, report_interval=5):
+    """Parse all messages in datadir into a single output file
+
+    Args:
+        datadir (str): Directory with the saved messages.
+        output (str): Output filename.
+        fmt (str): One of FORMATS.
+        workers (int): Number of processes, default is one per CPU.
+        chunksize (int): Number of files parsed by each task.
+        ordered (bool): Keep the rows in the same order of the files
+            (sorted by name, thus by receiving time). Unordered is faster
+            when some chunks take longer than others.
+        report_interval (float): Seconds between progress reports.
+
+    Returns:
+        int: Number of rows written.
+    """
+    assert fmt in FORMATS, "Invalid format: {}".format(fmt)
+    filenames = list_messages(datadir)
+    total = len(filenames)
+    module_logger.info('Exporting {} messages from {}'.format(total, datadir))
+    chunks = [filenames[i:i + chunksize]
+              for i in range(0, total, chunksize)]
+
+    writer = WRITERS[fmt](output)
+    t0 = last_report = time.time()
+    done = nrows = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for n, rows in imap(parse_chunk, chunks):
+            writer.write(rows)
+            done += n
+            nrows += len(rows)
+            now = time.time()
+            if now - last_report >= report_interval:
+                last_report = now
+                module_logger.info(
+                    'Exported {}/{} messages ({:.0f} msg/s)'.format(
+                        done, total, done / (now - t0)))
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+    elapsed = time.time() - t0
+    module_logger.info(
+        'Exported {} rows ({} failed) in {:.1f} s ({:.0f} msg/s)'.format(
+            nrows, done - nrows, elapsed, done / max(elapsed, 1e-9)))
+    return nrows
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""Secondary index of the saved messages by IMEI and session time.
+
+The filenames written by save_isbd_msg() only have the receiving time and
+the client address, and the segment index only the IMEI and the receiving
+time, so finding the messages of an IMEI in a period of time means parsing
+everything. MessageIndex keeps, in a SQLite database, one row per message
+with its IMEI, session time and MOMSN, together with its location (a
+filename or segment_filename:offset), indexed by (IMEI, session time).
+
+The server maintains the index as messages are saved (see IndexedStorage),
+and rebuild() indexes an existing archive, parsing it in parallel.
+"""
+
+from datetime import datetime, timedelta
+from glob import glob
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from .iridiumSBD import IridiumSBD
+from .store import SEGMENT_MAGIC, INBOX_FILENAME, iter_records, _timestamp
+from .export import list_messages
+
+
+module_logger = logging.getLogger('DirectIP')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    location TEXT PRIMARY KEY,
+    imei TEXT,
+    session_time INTEGER,
+    momsn INTEGER,
+    received REAL
+);
+CREATE INDEX IF NOT EXISTS messages_imei ON messages (imei, session_time);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (session_time);
+"""
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def index_row(location, data, t0=None):
+    """Row of the index for a message: only its header is decoded
+
+    Returns:
+        tuple: (location, imei, session_time, momsn, received), where
+            session_time is in seconds since 1970 and received is the
+            timestamp of t0. Messages without an MO header have None for
+            imei, session_time and momsn.
+    """
+    imei = session_time = momsn = None
+    try:
+        header = IridiumSBD(data, lazy=True).header
+    except Exception:
+        pass
+    else:
+        if header['IEI'] == b'\x01':
+            imei = header['IMEI']
+            session_time = int(_timestamp(header['session_datetime']))
+            momsn = header['MOMSN']
+    received = None if t0 is None else _timestamp(t0)
+    return (location, imei, session_time, momsn, received)
+
+
+class MessageIndex(object):
+    """SQLite index of messages by IMEI and session time
+
+    Args:
+        path (str): SQLite database, created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger('DirectIP.MessageIndex')
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # It can always be rebuilt from the messages, no need to sync it
+        # on every batch
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT count(*) FROM messages').fetchone()[0]
+
+    def add(self, rows):
+        """Insert rows given by index_row(), replacing the same location"""
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)',
+                rows)
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM messages')
+
+    def query(self, imei=None, since=None, until=None, limit=None):
+        """Messages of an IMEI and/or in a period, by session time
+
+        Args:
+            imei (str): IMEI of the messages.
+            since (datetime): Session at or after this time.
+            until (datetime): Session before this time.
+            limit (int): Maximum number of messages.
+
+        Returns:
+            list: (location, session_datetime, imei, MOMSN), sorted by
+                session time.
+        """
+        conditions = []
+        args = []
+        if imei is not None:
+            conditions.append('imei = ?')
+            args.append(imei)
+        if since is not None:
+            conditions.append('session_time >= ?')
+            args.append(int(_timestamp(since)))
+        if until is not None:
+            conditions.append('session_time < ?')
+            args.append(int(_timestamp(until)))
+        sql = 'SELECT location, session_time, imei, momsn FROM messages'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY session_time, location'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [(location,
+                 None if t is None else EPOCH + timedelta(seconds=t),
+                 imei, momsn)
+                for location, t, imei, momsn in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class IndexedStorage(object):
+    """Storage backend that indexes the valid messages of another one
+
+    Args:
+        storage: InboxStorage or SegmentStorage, anything that gives the
+            location of each message saved.
+        index (MessageIndex): Where the messages are indexed.
+    """
+    def __init__(self, storage, index):
+        self.storage = storage
+        self.index = index
+
+    def save_batch(self, batch):
+        locations = self.storage.save_batch(batch)
+        self.index.add([
+            index_row(location, item.data, item.t0)
+            for item, location in zip(batch, locations)
+            if not item.corrupted and location is not None])
+        return locations
+
+    def close(self):
+        self.storage.close()
+        self.index.close()
+
+
+def index_files(filenames):
+    """Rows for messages saved one per file"""
+    rows = []
+    for filename in filenames:
+        m = INBOX_FILENAME.match(os.path.basename(filename))
+        t0 = None
+        if m is not None:
+            t0 = datetime.strptime(m.group(1), '%Y%m%d%H%M%S%f')
+        with open(filename, 'rb') as f:
+            rows.append(index_row(filename, f.read(), t0))
+    return rows
+
+
+def index_segment(segname):
+    """Rows for all the valid records of a segment"""
+    with open(segname, 'rb') as f:
+        content = f.read()
+    rows = []
+    offset = len(SEGMENT_MAGIC)
+    for end, t, client_address, data in iter_records(content, offset):
+        rows.append(index_row('{}:{}'.format(segname, offset), data,
+                              EPOCH + timedelta(seconds=t)))
+        offset = end
+    return rows
+
+
+def _index_task(task):
+    kind, arg = task
+    if kind == 'segment':
+        return index_segment(arg)
+    return index_files(arg)
+
+
+def rebuild(datadir, index, workers=None, chunksize=1000):
+    """Index again every valid message saved in datadir
+
+    Both layouts are indexed: one file per message (datadir/inbox) and
+    segments (datadir/segments/inbox, or datadir/segments/workerN/inbox).
+    Files are parsed in chunks and segments one at a time, in parallel by a
+    pool of processes.
+
+    Args:
+        datadir (str): Data directory of the server.
+        index (MessageIndex): Index to rebuild, its previous content is
+            removed.
+        workers (int): Number of processes, default is one per CPU.
+        chunksize (int): Number of files parsed by each task.
+
+    Returns:
+        int: Number of messages indexed.
+    """
+    tasks = []
+    if os.path.isdir(os.path.join(datadir, 'inbox')):
+        filenames = list_messages(datadir)
+        tasks.extend(('files', filenames[i:i + chunksize])
+                     for i in range(0, len(filenames), chunksize))
+    # Segments of a single server, or of each one of its workers
+    for segments in [os.path.join(datadir, 'segments', 'inbox')] + sorted(
+            glob(os.path.join(datadir, 'segments', 'worker*', 'inbox'))):
+        tasks.extend(('segment', s) for s in sorted(
+            glob(os.path.join(segments, '[0-9]' * 8 + '.seg'))))
+
+    t0 = time.time()
+    index.clear()
+    n = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        for rows in pool.imap_unordered(_index_task, tasks):
+            index.add(rows)
+            n += len(rows)
+    finally:
+        pool.close()
+        pool.join()
+    module_logger.info('Indexed {} messages in {:.1f} s'.format(
+        n, time.time() - t0))
+    return n
@@ -3,11 +3,33 @@
 import struct
 from struct import calcsize, unpack_from
 import binascii
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 from datetime import datetime, timedelta
-from collections import OrderedDict
+
+
+EPOCH = datetime(1970, 1, 1, 0, 0, 0)
+
+# Binary layout of each information element (IE), big endian. The variable
+# size payloads (0x02 and 0x42) only have the IEI and length in the layout.
+IE_HEADER = struct.Struct('>cH')
+MO_HEADER = struct.Struct('>cHI15sBHHI')            # 0x01
+MO_LOCATION = struct.Struct('>cHBBHBHI')            # 0x03
+MO_CONFIRMATION = struct.Struct('>cHb')             # 0x05
+MT_HEADER = struct.Struct('>cHI15sH')               # 0x41
+MT_CONFIRMATION = struct.Struct('>cHI15sIh')        # 0x44
+MT_PRIORITY = struct.Struct('>cHH')                 # 0x46
 
 
 class Message(object):
+    """A binary message being consumed from the start
+
+    Indexing and slicing are relative to the current offset. The content
+    (bytes or a memoryview) is never copied as a whole, only the slices
+    requested, and unpacking (consume) is done directly on it.
+    """
     def __init__(self, content):
         self.content = content
         self.offset = 0
@@ -23,13 +45,39 @@ class Message(object):
             Avoids to convert to string when requesting only 1 item,
               like msg[0]
         """
-        if (type(item) is int) and (item != -1):
+        if type(item) is int:
+            if item == -1:
+                return self.content[-1]
             item = slice(item, item+1)
-        return self.content[self.offset:][item]
+        start, stop = item.start or 0, item.stop
+        if (start >= 0) and (item.step is None):
+            if stop is None:
+                return self.content[self.offset + start:]
+            elif stop >= 0:
+                return self.content[self.offset + start:self.offset + stop]
+        start, stop, step = item.indices(len(self.content) - self.offset)
+        return self.content[self.offset + start:self.offset + stop:step]
+
+    def remaining(self):
+        """Number of bytes not consumed yet"""
+        return len(self.content) - self.offset
+
+    def peek(self):
+        """Next byte, as an integer, without consuming it"""
+        return self.content[self.offset]
 
     def consume(self, fmt):
-        size = calcsize(fmt)
-        output = unpack_from(fmt, self.content, offset=self.offset)
+        """Unpack from the current offset and move forward
+
+        Args:
+            fmt: A struct format string or, faster, a struct.Struct.
+        """
+        if isinstance(fmt, struct.Struct):
+            size = fmt.size
+            output = fmt.unpack_from(self.content, self.offset)
+        else:
+            size = calcsize(fmt)
+            output = unpack_from(fmt, self.content, offset=self.offset)
         self.offset += size
         if len(output) == 1:
             return output[0]
@@ -37,127 +85,518 @@ class Message(object):
             return output
 
 
-def parse_MO_header(msg):
-    assert msg[0:1] == b'\x01'
-    cfg = OrderedDict([
-        ('IEI', '>c'),
-        ('length', '>H'),
-        ('CDR_reference', '>I'),
-        ('IMEI', '>15s'),
-        ('session_status', '>B'),
-        ('MOMSN', '>H'),
-        ('MTMSN', '>H'),
-        ('session_epoch', '>I')
-        ])
-
-    header = {}
-    for v in cfg:
-        header[v] = msg.consume(cfg[v])
-
-    header['IMEI'] = header['IMEI'].decode()
-    header['session_datetime'] = \
-        datetime(1970, 1, 1, 0, 0, 0) + \
-        timedelta(seconds=header['session_epoch'])
-    return header
+class Record(MutableMapping):
+    """Base of the compact records returned by the parse_* functions
 
+    Each section of a message is an object with __slots__, much smaller
+    than a dict, but which still behaves as a dict with the same keys as
+    before, thus section['IMEI'], section.get('IMEI'), 'IMEI' in section,
+    dict(section) and iterating over the keys all work. Derived values (like
+    latitude) are computed on access instead of stored.
 
-def parse_MO_location(msg):
-        assert msg[0:1] == b'\x03'
-
-        packformat = '>cHBBHBHI'
-        #block_len = struct.calcsize(packformat)
-        #if block_len > len(msg):
-        #    return
-        m = msg.consume(packformat)
-        #m = struct.unpack_from(packformat, msg)
-        assert m[0] == b'\x03'
-
-        location = {}
-        location['IEI'] = m[0]
-        location['length'] = m[1]
+    Subclasses define __slots__, the stored fields which can be changed,
+    and derived, the names of the computed ones.
+    """
+    __slots__ = ()
+    stored = ()
+    field_names = ()
+    keys_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self.keys_set:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.stored:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError("Can't remove a field from a {}".format(
+            type(self).__name__))
+
+    def __iter__(self):
+        return iter(self.field_names)
+
+    def __len__(self):
+        return len(self.field_names)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(k, getattr(self, k)) for k in self.field_names))
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, k) for k in self.stored))
+
+
+def _record(cls):
+    """Complete a Record subclass from its __slots__ and derived fields"""
+    stored = ()
+    for base in reversed(cls.__mro__):
+        stored += tuple(getattr(base, '__slots__', ()))
+    cls.stored = stored
+    cls.field_names = stored + tuple(cls.derived)
+    cls.keys_set = frozenset(cls.field_names)
+    return cls
+
+
+@_record
+class MOHeader(Record):
+    __slots__ = ('IEI', 'length', 'CDR_reference', 'IMEI', 'session_status',
+                 'MOMSN', 'MTMSN', 'session_epoch')
+    derived = ('session_datetime',)
+
+    def __init__(self, IEI, length, CDR_reference, IMEI, session_status,
+                 MOMSN, MTMSN, session_epoch):
+        self.IEI = IEI
+        self.length = length
+        self.CDR_reference = CDR_reference
+        self.IMEI = IMEI
+        self.session_status = session_status
+        self.MOMSN = MOMSN
+        self.MTMSN = MTMSN
+        self.session_epoch = session_epoch
+
+    @property
+    def session_datetime(self):
+        return EPOCH + timedelta(seconds=self.session_epoch)
+
+
+@_record
+class MOLocation(Record):
+    __slots__ = ('IEI', 'length', 'orient', 'lat_deg', 'lat_min', 'lon_deg',
+                 'lon_min', 'CEP_radius')
+    derived = ('latitude', 'longitude')
+
+    def __init__(self, IEI, length, orient, lat_deg, lat_min, lon_deg,
+                 lon_min, CEP_radius):
+        self.IEI = IEI
+        self.length = length
         # 0=N,E; 1=N,W; 2=S,E; 3=S,W
-        location['orient'] = m[2]
-        location['lat_deg'] = m[3]
-        location['lat_min'] = m[4] * 1e-3
-        location['lon_deg'] = m[5]
-        location['lon_min'] = m[6] * 1e-3
-        location['CEP_radius'] = m[7]
+        self.orient = orient
+        self.lat_deg = lat_deg
+        self.lat_min = lat_min
+        self.lon_deg = lon_deg
+        self.lon_min = lon_min
+        self.CEP_radius = CEP_radius
+
+    @property
+    def latitude(self):
+        latitude = self.lat_deg + self.lat_min / 60.
+        if self.orient in (2, 3):
+            latitude *= -1
+        return latitude
+
+    @property
+    def longitude(self):
+        longitude = self.lon_deg + self.lon_min / 60.
+        if self.orient in (1, 3):
+            longitude *= -1
+        return longitude
+
+
+@_record
+class MOPayload(Record):
+    __slots__ = ('IEI', 'length', 'data')
+    derived = ()
+
+    def __init__(self, IEI, length, data):
+        self.IEI = IEI
+        self.length = length
+        self.data = data
+
+
+@_record
+class MOConfirmation(Record):
+    __slots__ = ('IEI', 'length', 'status')
+    derived = ()
+
+    def __init__(self, IEI, length, status):
+        self.IEI = IEI
+        self.length = length
+        self.status = status
+
+
+@_record
+class MTHeader(Record):
+    __slots__ = ('IEI', 'length', 'unique_client_msg_id', 'IMEI',
+                 'disposition_flags')
+    derived = ()
+
+    def __init__(self, IEI, length, unique_client_msg_id, IMEI,
+                 disposition_flags):
+        self.IEI = IEI
+        self.length = length
+        self.unique_client_msg_id = unique_client_msg_id
+        self.IMEI = IMEI
+        self.disposition_flags = disposition_flags
+
+
+@_record
+class MTPayload(MOPayload):
+    """Identical to MOPayload, but size is limited to 1890 bytes"""
+    __slots__ = ()
+    derived = ()
+
+
+@_record
+class MTConfirmation(Record):
+    __slots__ = ('IEI', 'length', 'unique_client_msg_id', 'IMEI',
+                 'auto_id_reference', 'status')
+    derived = ()
+
+    def __init__(self, IEI, length, unique_client_msg_id, IMEI,
+                 auto_id_reference, status):
+        self.IEI = IEI
+        self.length = length
+        self.unique_client_msg_id = unique_client_msg_id
+        self.IMEI = IMEI
+        self.auto_id_reference = auto_id_reference
+        self.status = status
+
+
+@_record
+class MTPriority(Record):
+    __slots__ = ('IEI', 'length', 'level')
+    derived = ()
+
+    def __init__(self, IEI, length, level):
+        self.IEI = IEI
+        self.length = length
+        self.level = level
 
-        location['latitude'] = location['lat_deg'] + location['lat_min'] / 60.
-        if location['orient'] in (2, 3):
-            location['latitude'] *= -1
-        location['longitude'] = location['lon_deg'] + location['lon_min'] / 60.
-        if location['orient'] in (1, 3):
-            location['longitude'] *= -1
 
-        return location
+def parse_MO_header(msg):
+    assert msg.peek() == 0x01
+    (iei, length, cdr_reference, imei, session_status, momsn, mtmsn,
+     session_epoch) = msg.consume(MO_HEADER)
+    return MOHeader(iei, length, cdr_reference, imei.decode(),
+                    session_status, momsn, mtmsn, session_epoch)
 
 
-def parse_MO_payload(msg):
-    assert msg[0:1] == b'\x02'
-    cfg = OrderedDict([
-        ('IEI', '>c'),
-        ('length', '>H')
-        ])
-    payload = {}
-    for v in cfg:
-        payload[v] = msg.consume(cfg[v])
-
-    #packformat= '>cH'
-    #block_len = struct.calcsize(packformat)
-    #if block_len > len(msg):
-    #    return
-    #m = struct.unpack_from(packformat, msg)
-    #self.msg.offset = offset
-    #m = self.msg.consume('>cH')
-    #assert m[0] == b'\x02'
-
-    #payload = {}
-    #payload['IEI'] = m[0]
-    #payload['length'] = m[1]
-    #payload['data'] = msg[3:3+m[1]]
-    payload['data'] = msg[:payload['length']]
-    msg.offset += payload['length']
+def parse_MO_location(msg):
+    assert msg.peek() == 0x03
+    m = msg.consume(MO_LOCATION)
+    return MOLocation(m[0], m[1], m[2], m[3], m[4] * 1e-3, m[5],
+                      m[6] * 1e-3, m[7])
+
 
+def parse_MO_payload(msg):
+    assert msg.peek() == 0x02
+    iei, length = msg.consume(IE_HEADER)
+    payload = MOPayload(iei, length, msg[:length])
+    msg.offset += length
     return payload
 
 
 def parse_MO_confirmation(msg):
-        assert msg[0:1] == b'\x05'
-        packformat = '>cHb'
-        block_len = struct.calcsize(packformat)
-        if block_len > len(msg):
-            return
-        m = msg.consume(packformat)
+    assert msg.peek() == 0x05
+    if MO_CONFIRMATION.size > len(msg):
+        return
+    return MOConfirmation(*msg.consume(MO_CONFIRMATION))
 
-        confirmation = {}
-        confirmation['IEI'] = m[0]
-        confirmation['length'] = m[1]
-        confirmation['status'] = m[2]
 
-        return confirmation
+def parse_MT_header(msg):
+    assert msg.peek() == 0x41
+    iei, length, unique_client_msg_id, imei, disposition_flags = \
+        msg.consume(MT_HEADER)
+    return MTHeader(iei, length, unique_client_msg_id, imei.decode(),
+                    disposition_flags)
+
+
+def parse_MT_payload(msg):
+    """Identical to MO payload, but size is limited to 1890 bytes"""
+    assert msg.peek() == 0x42
+    iei, length = msg.consume(IE_HEADER)
+    payload = MTPayload(iei, length, msg[:length])
+    msg.offset += length
+    return payload
 
 
 def parse_MT_confirmation(msg):
-        assert msg[0:1] == b'\x44'
-        packformat = '>cHI15sIh'
-        block_len = struct.calcsize(packformat)
-        if block_len > len(msg):
-            return
-        #m = struct.unpack_from(packformat, msg)
-        m = msg.consume(packformat)
-        #self.msg.offset = offset
-        #m = self.msg.consume('>cH')
+    assert msg.peek() == 0x44
+    if MT_CONFIRMATION.size > len(msg):
+        return
+    m = msg.consume(MT_CONFIRMATION)
+    return MTConfirmation(b'\x44', m[1], m[2], m[3], m[4], m[5])
+
+
+def parse_MT_priority(msg):
+    assert msg.peek() == 0x46
+    return MTPriority(*msg.consume(MT_PRIORITY))
+
+
+# Encoding is the inverse of the parsers above. Each pack_* function packs
+# one IE at offset of a preallocated bytearray, with pack_into, and returns
+# the offset after it. The lengths (IE and message) are computed, thus any
+# 'length' in the given dicts is ignored.
+
+def _imei_bytes(imei):
+    if isinstance(imei, str):
+        imei = imei.encode()
+    assert len(imei) == 15, "Invalid IMEI: {}".format(imei)
+    return imei
+
+
+def pack_MO_header(buf, offset, header):
+    epoch = header.get('session_epoch')
+    if epoch is None:
+        epoch = int((header['session_datetime'] - EPOCH).total_seconds())
+    MO_HEADER.pack_into(buf, offset, b'\x01', MO_HEADER.size - 3,
+                        header['CDR_reference'], _imei_bytes(header['IMEI']),
+                        header['session_status'], header['MOMSN'],
+                        header['MTMSN'], epoch)
+    return offset + MO_HEADER.size
+
+
+def pack_MO_location(buf, offset, location):
+    """Encode a location, from degrees and minutes or latitude/longitude"""
+    if 'lat_deg' in location:
+        orient = location['orient']
+        lat_deg, lat_min = location['lat_deg'], location['lat_min']
+        lon_deg, lon_min = location['lon_deg'], location['lon_min']
+    else:
+        lat, lon = location['latitude'], location['longitude']
+        # 0=N,E; 1=N,W; 2=S,E; 3=S,W
+        orient = (2 if lat < 0 else 0) + (1 if lon < 0 else 0)
+        lat_deg, lat_min = divmod(abs(lat) * 60, 60)
+        lon_deg, lon_min = divmod(abs(lon) * 60, 60)
+    MO_LOCATION.pack_into(buf, offset, b'\x03', MO_LOCATION.size - 3, orient,
+                          int(lat_deg), int(round(lat_min * 1e3)),
+                          int(lon_deg), int(round(lon_min * 1e3)),
+                          location.get('CEP_radius', 0))
+    return offset + MO_LOCATION.size
+
+
+def _pack_payload(iei, buf, offset, payload):
+    data = payload['data']
+    IE_HEADER.pack_into(buf, offset, iei, len(data))
+    offset += IE_HEADER.size
+    buf[offset:offset + len(data)] = data
+    return offset + len(data)
+
+
+def pack_MO_payload(buf, offset, payload):
+    return _pack_payload(b'\x02', buf, offset, payload)
+
+
+def pack_MO_confirmation(buf, offset, confirmation):
+    MO_CONFIRMATION.pack_into(buf, offset, b'\x05', MO_CONFIRMATION.size - 3,
+                              confirmation['status'])
+    return offset + MO_CONFIRMATION.size
+
+
+def pack_MT_header(buf, offset, header):
+    MT_HEADER.pack_into(buf, offset, b'\x41', MT_HEADER.size - 3,
+                        header['unique_client_msg_id'],
+                        _imei_bytes(header['IMEI']),
+                        header['disposition_flags'])
+    return offset + MT_HEADER.size
+
+
+def pack_MT_payload(buf, offset, payload):
+    assert len(payload['data']) <= 1890, "MT payload is limited to 1890 bytes"
+    return _pack_payload(b'\x42', buf, offset, payload)
+
+
+def pack_MT_confirmation(buf, offset, confirmation):
+    MT_CONFIRMATION.pack_into(buf, offset, b'\x44', MT_CONFIRMATION.size - 3,
+                              confirmation['unique_client_msg_id'],
+                              _imei_bytes(confirmation['IMEI']),
+                              confirmation['auto_id_reference'],
+                              confirmation['status'])
+    return offset + MT_CONFIRMATION.size
+
 
-        confirmation = {}
-        confirmation['IEI'] = b'\x44'
-        confirmation['length'] = m[1]
-        confirmation['unique_client_msg_id'] = m[2]
-        confirmation['IMEI'] = m[3]
-        confirmation['auto_id_reference'] = m[4]
-        confirmation['status'] = m[5]
+def pack_MT_priority(buf, offset, priority):
+    MT_PRIORITY.pack_into(buf, offset, b'\x46', MT_PRIORITY.size - 3,
+                          priority['level'])
+    return offset + MT_PRIORITY.size
 
-        return confirmation
+
+# Packer for each section, in the order they are written:
+# (attribute name, function, size or None if variable)
+IE_ENCODERS = {
+        'MO': (('header', pack_MO_header, MO_HEADER.size),
+               ('location', pack_MO_location, MO_LOCATION.size),
+               ('payload', pack_MO_payload, None),
+               ('confirmation', pack_MO_confirmation, MO_CONFIRMATION.size)),
+        'MT': (('header', pack_MT_header, MT_HEADER.size),
+               ('payload', pack_MT_payload, None),
+               ('priority', pack_MT_priority, MT_PRIORITY.size),
+               ('confirmation', pack_MT_confirmation, MT_CONFIRMATION.size)),
+        }
+
+
+def encode_sections(mtype, sections):
+    """Binary message, protocol revision 1, from its sections
+
+    Args:
+        mtype (str): 'MO' or 'MT'.
+        sections (dict): Like IridiumSBD.attributes, with header, location,
+            payload, confirmation and priority as applicable. Missing (or
+            None) sections are not included.
+    """
+    encoders = []
+    size = IE_HEADER.size
+    for name, encoder, ie_size in IE_ENCODERS[mtype]:
+        section = sections.get(name)
+        if section is not None:
+            encoders.append((encoder, section))
+            if ie_size is None:
+                ie_size = IE_HEADER.size + len(section['data'])
+            size += ie_size
+
+    buf = bytearray(size)
+    IE_HEADER.pack_into(buf, 0, b'\x01', size - IE_HEADER.size)
+    offset = IE_HEADER.size
+    for encoder, section in encoders:
+        offset = encoder(buf, offset, section)
+    return bytes(buf)
+
+
+def encode_MT(imei, payload, unique_client_msg_id=0, disposition_flags=0,
+              priority=None):
+    """Binary MT message, as sent to the Iridium Gateway
+
+    Args:
+        imei (str): Destination IMEI, 15 digits.
+        payload (bytes): Up to 1890 bytes. Use an empty payload together
+            with disposition flags only, like flushing the MT queue.
+        unique_client_msg_id (int): Reference returned in the confirmation.
+        disposition_flags (int): Bit flags, like 1 to flush the MT queue.
+        priority (int): Optional priority level, 1 (highest) to 5.
+    """
+    sections = {'header': {'IMEI': imei,
+                           'unique_client_msg_id': unique_client_msg_id,
+                           'disposition_flags': disposition_flags}}
+    if payload:
+        sections['payload'] = {'data': payload}
+    if priority is not None:
+        sections['priority'] = {'level': priority}
+    return encode_sections('MT', sections)
+
+
+def encode_MT_confirmation(unique_client_msg_id, imei, auto_id_reference,
+                           status):
+    """Binary MT confirmation, as answered by the Iridium Gateway
+
+    Args:
+        status (int): Position in the MT queue (0 if there was no payload),
+            or negative in case of error, see MT_CONFIRMATION_STATUS.
+    """
+    return encode_sections('MT', {'confirmation': {
+        'unique_client_msg_id': unique_client_msg_id,
+        'IMEI': imei,
+        'auto_id_reference': auto_id_reference,
+        'status': status}})
+
+
+# Errors given in the status of an MT confirmation
+MT_CONFIRMATION_STATUS = {
+        -1: 'Invalid IMEI, too few characters or non-numeric',
+        -2: 'Unknown IMEI, not provisioned on the gateway',
+        -3: 'Payload size exceeded the maximum allowed',
+        -4: 'Payload expected, but none received',
+        -5: 'MT message queue full',
+        -6: 'MT resources unavailable',
+        -7: 'Violation of the MT DirectIP protocol',
+        -8: 'Ring alerts to the given IMEI are disabled',
+        -9: 'The given IMEI is not attached',
+        }
+
+
+# Parser for each IEI: (function, attribute name, message type)
+IE_PARSERS = {
+        0x01: (parse_MO_header, 'header', 'MO'),
+        0x02: (parse_MO_payload, 'payload', None),
+        0x03: (parse_MO_location, 'location', None),
+        0x05: (parse_MO_confirmation, 'confirmation', 'MO'),
+        0x41: (parse_MT_header, 'header', 'MT'),
+        0x42: (parse_MT_payload, 'payload', None),
+        0x44: (parse_MT_confirmation, 'confirmation', 'MT'),
+        0x46: (parse_MT_priority, 'priority', 'MT'),
+        }
+
+
+class Sections(MutableMapping):
+    """Sections of a message decoded only on first access, then cached
+
+    Used by IridiumSBD in lazy mode as its attributes. Behaves as a dict, but
+    the IEs are only indexed (parser and offset) until requested.
+    """
+    def __init__(self, content, data=None):
+        self.content = content
+        self.data = {} if data is None else data
+        self.pending = {}
+
+    def __getitem__(self, name):
+        if name in self.data:
+            return self.data[name]
+        parser, offset = self.pending.pop(name)
+        msg = Message(self.content)
+        msg.offset = offset
+        section = self.data[name] = parser(msg)
+        return section
+
+    def __setitem__(self, name, section):
+        self.pending.pop(name, None)
+        self.data[name] = section
+
+    def __delitem__(self, name):
+        if self.pending.pop(name, None) is None:
+            del self.data[name]
+
+    def __contains__(self, name):
+        return (name in self.data) or (name in self.pending)
+
+    def __iter__(self):
+        return iter(list(self.data) + list(self.pending))
+
+    def __len__(self):
+        return len(self.data) + len(self.pending)
+
+    def __repr__(self):
+        return repr(dict(self.data, **{
+            name: '<not decoded>' for name in self.pending}))
+
+
+def _section(name):
+    """Property to access a section as an attribute, like isbd.header"""
+    def getter(self):
+        try:
+            return self.attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+    return property(getter, doc="The {} section".format(name))
+
+
+def peek_imei_bytes(msg):
+    """IMEI of a binary message, as the raw 15 bytes, or None
+
+    The IMEI is at the same position in the MO header, MT header and MT
+    confirmation, usually the first IE, so this is just a slice.
+    """
+    offset = 3
+    size = len(msg)
+    while offset + 22 <= size:
+        if msg[offset] in (0x01, 0x41, 0x44):
+            return bytes(msg[offset + 7:offset + 22])
+        offset += 3 + ((msg[offset + 1] << 8) | msg[offset + 2])
+    return None
+
+
+def peek_imei(msg):
+    """IMEI of a binary message without parsing it, or None
+
+    Never fails on a malformed IMEI, its bytes that are not ASCII are
+    replaced by U+FFFD. See peek_imei_bytes().
+    """
+    imei = peek_imei_bytes(msg)
+    if imei is None:
+        return None
+    return imei.decode('ascii', 'replace')
 
 
 class IridiumSBD(object):
@@ -184,27 +623,56 @@ class IridiumSBD(object):
 
     >>> isbd.decode() # Parse the binary message
     >>> isbd.encode() # Encode proprieties into a binary message
+
+    With lazy=True the IEs are only located when loading, and each section
+    is decoded when accessed for the first time. Useful when only a few
+    fields are needed, like routing by IMEI (see also peek_imei()).
     """
-    def __init__(self, msg=None):
+    def __init__(self, msg=None, lazy=False):
         """Initialize an IridiumSBD object.
 
         Args:
             msg (byte): A binary ISBD message (optional). If given, runs
                 load(msg).
+            lazy (bool): Decode the sections on first access.
         """
         self.mtype = None
+        self.attributes = {}
+        self._payload = None
         if msg is not None:
-            self.load(msg)
+            self.load(msg, lazy=lazy)
 
     def __str__(self):
         return self.attributes
 
-    def load(self, msg):
+    header = _section('header')
+    location = _section('location')
+    confirmation = _section('confirmation')
+    priority = _section('priority')
+
+    @property
+    def payload(self):
+        if isinstance(self._payload, tuple):
+            parser, offset = self._payload
+            msg = Message(self.msg.content)
+            msg.offset = offset
+            self._payload = parser(msg)
+        elif self._payload is None:
+            raise AttributeError('payload')
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+
+    def load(self, msg, lazy=False):
         """Parse an Iridium SBD binary message.
 
         Args:
             msg (byte): A binary ISBD message (optional). If given, runs
                 load(msg).
+            lazy (bool): Only locate the IEs, and decode each one on first
+                access.
 
         The input (msg) is the Iridium SBD message in its original
             binary format.
@@ -220,6 +688,10 @@ class IridiumSBD(object):
                 MO Payload IEI                0x02
                 MO Location Information IEI   0x03
                 MO Confirmation IEI           0x05
+                MT Header IEI                 0x41
+                MT Payload IEI                0x42
+                MT Confirmation IEI           0x44
+                MT Message Priority IEI       0x46
 
         What is the syntax for the MO Receipt Confirmation???
         """
@@ -227,36 +699,69 @@ class IridiumSBD(object):
 
         self.msg = Message(msg)
 
-        self.attributes = {}
-        self.attributes['protocol_revision'] = self.msg.consume('>c')
-        self.attributes['msg_length'] = self.msg.consume('>H')
-        self.attributes['actual_length'] = len(self.msg)
-
-        while len(self.msg[:]) > 0:
-            if self.msg[0] == b'\x01':
-                self.attributes['header'] = parse_MO_header(self.msg)
-                self.mtype = 'MO'
-            elif self.msg[0] == b'\x02':
-                self.payload = parse_MO_payload(self.msg)
-            elif self.msg[0] == b'\x03':
-                self.attributes['location'] = parse_MO_location(self.msg)
-            elif self.msg[0] == b'\x05':
-                self.attributes['confirmation'] = parse_MO_confirmation(
-                        self.msg)
-                self.mtype = 'MO'
-            elif self.msg[0] == b'\x41':
-                self.mtype = 'MT'
-            elif self.msg[0] == b'\x42':
-                # Identical to MO payload, but size is limited to 1890 bytes.
-                print('MT Payload')
-            elif self.msg[0] == b'\x44':
-                self.attributes['confirmation'] = parse_MT_confirmation(
-                        self.msg)
-                self.mtype = 'MO'
-            elif self.msg[0] == b'\x46':
-                print('MT message Priority')
-            else:
+        revision, length = self.msg.consume(IE_HEADER)
+        size = len(self.msg)
+        attributes = {'protocol_revision': revision,
+                      'msg_length': length,
+                      'actual_length': size}
+        if lazy:
+            self.attributes = Sections(msg, attributes)
+            self._index(msg, size)
+            return
+
+        self.attributes = attributes
+        while self.msg.offset < size:
+            try:
+                parser, name, mtype = IE_PARSERS[self.msg.peek()]
+            except KeyError:
+                assert False, "Unkown section"
+            section = parser(self.msg)
+            if name == 'payload':
+                self.payload = section
+            elif name is not None:
+                self.attributes[name] = section
+            if mtype is not None:
+                self.mtype = mtype
+
+    def _index(self, msg, size):
+        """Locate the IEs, in a single pass, without decoding them"""
+        offset = self.msg.offset
+        pending = self.attributes.pending
+        while offset < size:
+            try:
+                parser, name, mtype = IE_PARSERS[msg[offset]]
+            except KeyError:
                 assert False, "Unkown section"
+            if name == 'payload':
+                self._payload = (parser, offset)
+            elif name is not None:
+                pending[name] = (parser, offset)
+            if mtype is not None:
+                self.mtype = mtype
+            if offset + 3 > size:
+                break
+            offset += 3 + ((msg[offset + 1] << 8) | msg[offset + 2])
+
+    def encode(self):
+        """Encode the attributes (and payload) into a binary message
+
+        The inverse of load(). The message type (mtype) defines which IEs
+        are encoded, and every length is computed from the content. For
+        instance, a new MO message:
+
+        >>> isbd = IridiumSBD()
+        >>> isbd.mtype = 'MO'
+        >>> isbd.attributes['header'] = {'CDR_reference': 1,
+        ...     'IMEI': '300234010753370', 'session_status': 0, 'MOMSN': 1,
+        ...     'MTMSN': 0, 'session_datetime': datetime.utcnow()}
+        >>> isbd.payload = {'data': b'hello'}
+        >>> isbd.encode()
+        """
+        assert self.mtype in IE_ENCODERS, \
+            "Unknown message type: {}".format(self.mtype)
+        sections = dict(self.attributes)
+        sections['payload'] = getattr(self, 'payload', None)
+        return encode_sections(self.mtype, sections)
 
     def payload_as_hex(self):
         return binascii.hexlify(self.payload['data'])
@@ -324,14 +829,92 @@ def valid_isbd(msg):
     return True
 
 
+class StreamParser(object):
+    """Incremental parser of a stream of ISBD messages, like a TCP socket
+
+    Push the bytes as they are received with feed(), which returns the
+    complete messages, in order, as soon as their last byte arrives. The
+    incoming chunks are appended to a single buffer and the consumed bytes
+    are dropped, so the cost is linear on the size of the stream, and there
+    is no limit on the number of reads nor on the number of back-to-back
+    messages.
+
+    Each message is validated as in valid_isbd(): protocol revision 1 and no
+    more than 2K. Once an invalid one is found the stream can't be trusted
+    anymore, thus corrupted becomes True and nothing else is parsed nor
+    buffered. Only the bytes pending at that point are kept.
+
+    >>> parser = StreamParser()
+    >>> for chunk in chunks:
+    ...     for msg in parser.feed(chunk):
+    ...         IridiumSBD(msg)
+
+    Args:
+        on_ie (callable): Optional, called with each information element
+            (IEI, length and content) as soon as it is complete, even
+            before the whole message arrives.
+    """
+    def __init__(self, on_ie=None):
+        self.buffer = bytearray()
+        self.on_ie = on_ie
+        # Next IE to be emitted, relative to the start of the message
+        self.ie_offset = 3
+        self.corrupted = False
+
+    def __len__(self):
+        """Number of bytes received that are not a complete message yet"""
+        return len(self.buffer)
+
+    def pending(self):
+        """Bytes received that are not a complete message, as bytes"""
+        return bytes(self.buffer)
+
+    def feed(self, data):
+        """Add received bytes, returning a list of the complete messages"""
+        if self.corrupted:
+            return []
+        self.buffer += data
+
+        messages = []
+        start = 0
+        while len(self.buffer) - start >= 3:
+            rev, size = IE_HEADER.unpack_from(self.buffer, start)
+            if (rev != b'\x01') or (size >= 2048):
+                self.corrupted = True
+                break
+            available = min(len(self.buffer) - start, size + 3)
+            if self.on_ie is not None:
+                self._emit_ies(start, available)
+            if available < size + 3:
+                break
+            messages.append(bytes(self.buffer[start:start + size + 3]))
+            start += size + 3
+            self.ie_offset = 3
+        if start > 0:
+            del self.buffer[:start]
+        return messages
+
+    def _emit_ies(self, start, available):
+        while self.ie_offset + 3 <= available:
+            iei, length = IE_HEADER.unpack_from(
+                    self.buffer, start + self.ie_offset)
+            end = self.ie_offset + 3 + length
+            if end > available:
+                break
+            self.on_ie(bytes(self.buffer[start + self.ie_offset:start + end]))
+            self.ie_offset = end
+
+
 def dump(file, imei):
     """Show isbd message header as text
     """
-    msg = IridiumSBD(file.read())
+    content = file.read()
     if imei:
-        print(msg.attributes['header']['IMEI'])
+        print(peek_imei(content))
         return
 
+    msg = IridiumSBD(content)
+
     print("protocol_revision: {}".format(msg.attributes['protocol_revision']))
     print("msg_length: {}".format(msg.attributes['msg_length']))
     print("actual_length: {}".format(msg.attributes['actual_length']))
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+"""Append-only segmented storage for ISBD messages.
+
+Instead of one tiny file per message, messages are appended as records to
+segment files, which are rotated once they reach a maximum size. Each
+segment (NNNNNNNN.seg) starts with SEGMENT_MAGIC followed by records:
+
+    RECORD_HEADER: data length, CRC32, receive timestamp (seconds since
+        epoch), length of the client address
+    client address (ASCII)
+    data (the binary ISBD message)
+
+Next to each segment there is a compact index (NNNNNNNN.idx) with one
+fixed size INDEX_ENTRY per record: offset in the segment, receive
+timestamp and IMEI, so it is possible to find messages by time or IMEI
+without reading the segments. SegmentStore.find() scans those index files,
+thus its cost grows with the store; for lookups on a large archive use
+index.MessageIndex, a real index by IMEI and session time.
+
+SegmentReader and StoreReader memory-map the segments to read them back,
+giving each message as a memoryview that can be passed directly to
+IridiumSBD, without copying it.
+
+The CRC32 covers the client address and the data, so a record torn by a
+crash is detected and discarded when the store is reopened.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from glob import glob
+from bisect import bisect_right
+import logging
+import mmap
+import os
+import os.path
+import re
+import struct
+import threading
+import time
+import zlib
+
+from .iridiumSBD import IridiumSBD, peek_imei_bytes
+
+
+module_logger = logging.getLogger('DirectIP')
+
+SEGMENT_MAGIC = b'ISBDSEG1'
+RECORD_HEADER = struct.Struct('>IIdB')
+INDEX_ENTRY = struct.Struct('>Id15s')
+
+FSYNC_POLICIES = ('always', 'batch', 'interval', 'never')
+
+EPOCH = datetime(1970, 1, 1)
+
+StoredMessage = namedtuple('StoredMessage', ['client_address', 'data', 't0'])
+
+Record = namedtuple('Record', ['t0', 'client_address', 'data'])
+
+
+def _imei(data):
+    """IMEI of a message, as raw bytes, or b'' if there is no header"""
+    return peek_imei_bytes(data) or b''
+
+
+def _timestamp(t0):
+    return (t0 - EPOCH).total_seconds()
+
+
+class SegmentStore(object):
+    """Append-only store of messages in rotating segment files.
+
+    Args:
+        path (str): Directory holding the segments, created if missing.
+        segment_size (int): A new segment is started once the current one
+            would grow beyond this size, in bytes.
+        fsync (str): When to fsync the segment and its index:
+            'always' after each record, 'batch' after each save_batch(),
+            'interval' on the first batch after fsync_interval seconds
+            since the last one, or 'never' (left to the operating system).
+            The store is always synced when closed.
+        fsync_interval (float): Seconds between fsyncs for the 'interval'
+            policy.
+    """
+    def __init__(self,
+                 path,
+                 segment_size=64 * 1024**2,
+                 fsync='batch',
+                 fsync_interval=1.0):
+        self.logger = logging.getLogger('DirectIP.SegmentStore')
+        assert fsync in FSYNC_POLICIES, "Invalid fsync: {}".format(fsync)
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.last_sync = time.time()
+        self.dirty = False
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        segments = self.segments()
+        if segments:
+            self.segment_id = int(os.path.basename(segments[-1])[:-4])
+            self._open(recover=True)
+        else:
+            self.segment_id = 0
+            self._open()
+
+    def segments(self):
+        """Sorted list of segment filenames"""
+        return sorted(glob(os.path.join(self.path, '[0-9]' * 8 + '.seg')))
+
+    def segment_name(self, segment_id):
+        return os.path.join(self.path, '%08d.seg' % segment_id)
+
+    def _open(self, recover=False):
+        segname = self.segment_name(self.segment_id)
+        self.seg = open(segname, 'ab')
+        self.idx = open(segname[:-4] + '.idx', 'ab')
+        if self.seg.tell() == 0:
+            self.seg.write(SEGMENT_MAGIC)
+            self.seg.flush()
+        elif recover:
+            self._recover()
+        self.size = self.seg.tell()
+        self.logger.debug('Appending to segment: {}'.format(segname))
+
+    def _recover(self):
+        """Discard a torn tail and rebuild the index of the last segment
+
+        Only the last segment can be affected by a crash, and it is at most
+        segment_size, so it is simply scanned again.
+        """
+        segname = self.segment_name(self.segment_id)
+        with open(segname, 'rb') as f:
+            content = f.read()
+        self.idx.truncate(0)
+        offset = len(SEGMENT_MAGIC)
+        for end, t, client_address, data in iter_records(content, offset):
+            self.idx.write(INDEX_ENTRY.pack(offset, t, _imei(data)))
+            offset = end
+        if offset < len(content):
+            self.logger.warning(
+                'Discarding {} bytes of a torn record in {}'.format(
+                    len(content) - offset, segname))
+            self.seg.truncate(offset)
+        self.seg.seek(0, os.SEEK_END)
+        self.idx.flush()
+
+    def _rotate(self):
+        self._sync()
+        self.seg.close()
+        self.idx.close()
+        self.segment_id += 1
+        self._open()
+
+    def _sync(self):
+        self.seg.flush()
+        self.idx.flush()
+        if self.fsync != 'never':
+            os.fsync(self.seg.fileno())
+            os.fsync(self.idx.fileno())
+        self.last_sync = time.time()
+        self.dirty = False
+
+    def _append(self, client_address, data, t0):
+        address = client_address[0].encode('ascii')
+        record = RECORD_HEADER.pack(
+            len(data),
+            zlib.crc32(data, zlib.crc32(address)) & 0xffffffff,
+            _timestamp(t0),
+            len(address))
+        size = len(record) + len(address) + len(data)
+        if (self.size > len(SEGMENT_MAGIC)) and \
+                (self.size + size > self.segment_size):
+            self._rotate()
+
+        offset = self.size
+        self.seg.write(record)
+        self.seg.write(address)
+        self.seg.write(data)
+        self.idx.write(INDEX_ENTRY.pack(offset, _timestamp(t0), _imei(data)))
+        self.size += size
+        self.dirty = True
+        return '{}:{}'.format(self.segment_name(self.segment_id), offset)
+
+    def _maybe_sync(self, policy):
+        if self.fsync == policy:
+            self._sync()
+        elif (self.fsync == 'interval') and \
+                (time.time() - self.last_sync >= self.fsync_interval):
+            self._sync()
+        else:
+            self.seg.flush()
+            self.idx.flush()
+
+    def append(self, client_address, data, t0):
+        """Append one message
+
+        Returns:
+            str: Location of the record as segment_filename:offset
+        """
+        return self.save_batch([StoredMessage(client_address, data, t0)])[0]
+
+    def save_batch(self, batch):
+        """Append a sequence of messages, syncing only once at the end
+
+        Records are always flushed to the operating system before
+        returning, even when not synced to the disk. Each item of batch
+        must have client_address, data and t0 attributes, like a
+        QueuedMessage.
+        """
+        with self.lock:
+            locations = []
+            for item in batch:
+                locations.append(
+                    self._append(item.client_address, item.data, item.t0))
+                if self.fsync == 'always':
+                    self._sync()
+            if locations:
+                self._maybe_sync('batch')
+        return locations
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.seg.closed:
+                return
+            self._sync()
+            self.seg.close()
+            self.idx.close()
+
+    def find(self, imei=None, since=None, until=None):
+        """Search the index by IMEI and/or receiving time
+
+        This is a linear scan of every index file, for each query. To look
+        up a large store, see index.MessageIndex.
+
+        Args:
+            imei (str): IMEI of the messages.
+            since (datetime): Received at or after this time.
+            until (datetime): Received before this time.
+
+        Yields:
+            (location, datetime, imei) of each matching record
+        """
+        if imei is not None:
+            imei = imei.encode('ascii')
+        since = None if since is None else _timestamp(since)
+        until = None if until is None else _timestamp(until)
+        for segname in self.segments():
+            with open(segname[:-4] + '.idx', 'rb') as f:
+                index = f.read()
+            n = len(index) // INDEX_ENTRY.size
+            for offset, t, i in INDEX_ENTRY.iter_unpack(
+                    index[:n * INDEX_ENTRY.size]):
+                if (imei is not None) and (i != imei):
+                    continue
+                if (since is not None) and (t < since):
+                    continue
+                if (until is not None) and (t >= until):
+                    continue
+                yield ('{}:{}'.format(segname, offset),
+                       EPOCH + timedelta(seconds=t),
+                       i.rstrip(b'\x00').decode('ascii', 'replace'))
+
+    def read(self, location):
+        """Read one record from a location given by append() or find()
+
+        Returns:
+            (datetime, client_address, data)
+        """
+        segname, offset = location.rsplit(':', 1)
+        with open(segname, 'rb') as f:
+            f.seek(int(offset))
+            header = f.read(RECORD_HEADER.size)
+            size, crc, t, addrlen = RECORD_HEADER.unpack(header)
+            address = f.read(addrlen)
+            data = f.read(size)
+        assert zlib.crc32(data, zlib.crc32(address)) & 0xffffffff == crc, \
+            "Corrupted record at {}".format(location)
+        return EPOCH + timedelta(seconds=t), address.decode('ascii'), data
+
+
+def iter_records(content, offset=len(SEGMENT_MAGIC)):
+    """Iterate over the valid records of a segment content
+
+    Stops at the end of content or at the first torn/corrupted record.
+
+    Yields:
+        (offset of the next record, timestamp, client_address, data)
+    """
+    end = len(content)
+    while offset + RECORD_HEADER.size <= end:
+        size, crc, t, addrlen = RECORD_HEADER.unpack_from(content, offset)
+        start = offset + RECORD_HEADER.size
+        stop = start + addrlen + size
+        if stop > end:
+            return
+        address = content[start:start + addrlen]
+        data = content[start + addrlen:stop]
+        if zlib.crc32(data, zlib.crc32(address)) & 0xffffffff != crc:
+            return
+        yield stop, t, address, data
+        offset = stop
+
+
+class SegmentReader(object):
+    """Random access to the records of one segment, using mmap.
+
+    The N-th record is found in O(1) through the offsets in the index, and
+    its data is a memoryview of the mapped segment, thus nothing is copied
+    until it is actually used. IridiumSBD accepts it directly:
+
+    >>> with SegmentReader('segments/inbox/00000000.seg') as reader:
+    ...     for isbd in reader.messages():
+    ...         print(isbd.attributes['header']['IMEI'])
+
+    The memoryviews are only valid while the reader is open. Records
+    appended after the reader is opened are not visible.
+
+    Args:
+        filename (str): Segment filename (NNNNNNNN.seg).
+        verify (bool): Check the CRC32 of each record read.
+    """
+    def __init__(self, filename, verify=False):
+        self.filename = filename
+        self.verify = verify
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+        assert self.buffer[:len(SEGMENT_MAGIC)] == SEGMENT_MAGIC, \
+            "Not a segment: {}".format(filename)
+
+        with open(filename[:-4] + '.idx', 'rb') as f:
+            index = f.read()
+        n = len(index) // INDEX_ENTRY.size
+        self.index = list(INDEX_ENTRY.iter_unpack(
+            index[:n * INDEX_ENTRY.size]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        """The N-th record, as Record(t0, client_address, data)"""
+        offset, t, imei = self.index[n]
+        size, crc, t, addrlen = RECORD_HEADER.unpack_from(
+            self.buffer, offset)
+        start = offset + RECORD_HEADER.size
+        address = self.buffer[start:start + addrlen]
+        data = self.buffer[start + addrlen:start + addrlen + size]
+        if self.verify:
+            assert zlib.crc32(data, zlib.crc32(address)) & 0xffffffff == \
+                crc, "Corrupted record {} in {}".format(n, self.filename)
+        return Record(EPOCH + timedelta(seconds=t),
+                      address.tobytes().decode('ascii'),
+                      data)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def messages(self):
+        """Iterate over the records parsed as IridiumSBD"""
+        for record in self:
+            yield IridiumSBD(record.data)
+
+    def close(self):
+        """Release the mapping
+
+        Fails with BufferError if any memoryview from this reader is still
+        referenced.
+        """
+        self.buffer.release()
+        self.mmap.close()
+
+
+class StoreReader(object):
+    """Random access over all the segments of a SegmentStore.
+
+    Records are numbered sequentially across the segments, so reader[n]
+    is the N-th record ever saved in the store. See SegmentReader.
+
+    Args:
+        path (str): Directory of the store.
+        verify (bool): Check the CRC32 of each record read.
+    """
+    def __init__(self, path, verify=False):
+        self.readers = [SegmentReader(s, verify=verify) for s in sorted(
+            glob(os.path.join(path, '[0-9]' * 8 + '.seg')))]
+        self.starts = []
+        n = 0
+        for reader in self.readers:
+            self.starts.append(n)
+            n += len(reader)
+        self.size = n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.size
+        if not 0 <= n < self.size:
+            raise IndexError('Record out of range')
+        i = bisect_right(self.starts, n) - 1
+        return self.readers[i][n - self.starts[i]]
+
+    def __iter__(self):
+        for reader in self.readers:
+            for record in reader:
+                yield record
+
+    def messages(self):
+        """Iterate over all the records parsed as IridiumSBD"""
+        for reader in self.readers:
+            for isbd in reader.messages():
+                yield isbd
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+
+class SegmentStorage(object):
+    """Storage backend for the DirectIP server using SegmentStore
+
+    Valid messages go to datadir/segments/inbox and corrupted ones to
+    datadir/segments/corrupted. Extra keyword arguments are passed to
+    SegmentStore.
+
+    Segments can't be shared by processes, thus each server worker (see
+    directip.workers) has its own, in datadir/segments/workerN.
+    """
+    def __init__(self, datadir, worker=None, **kwargs):
+        path = os.path.join(datadir, 'segments')
+        if worker is not None:
+            path = os.path.join(path, 'worker{}'.format(worker))
+        self.inbox = SegmentStore(os.path.join(path, 'inbox'), **kwargs)
+        self.corrupted = SegmentStore(
+            os.path.join(path, 'corrupted'), **kwargs)
+
+    def save_batch(self, batch):
+        """Save queued messages, returning the location of each one"""
+        locations = dict(zip(
+            [id(item) for item in batch if item.corrupted],
+            self.corrupted.save_batch([i for i in batch if i.corrupted])))
+        locations.update(zip(
+            [id(item) for item in batch if not item.corrupted],
+            self.inbox.save_batch([i for i in batch if not i.corrupted])))
+        return [locations[id(item)] for item in batch]
+
+    def close(self):
+        self.inbox.close()
+        self.corrupted.close()
+
+
+INBOX_FILENAME = re.compile(r'^(\d{20})_(.+)\.isbd$')
+
+
+def import_inbox(inbox, store, batch_size=1024):
+    """Import messages saved one per file into a SegmentStore
+
+    The receiving time and the client address are recovered from the
+    filenames created by save_isbd_msg(), like
+    20170703123456000000_127.0.0.1.isbd. Files in a different pattern are
+    skipped.
+
+    Returns:
+        int: Number of messages imported
+    """
+    filenames = sorted(os.listdir(inbox))
+    n = 0
+    for i in range(0, len(filenames), batch_size):
+        batch = []
+        for filename in filenames[i:i + batch_size]:
+            m = INBOX_FILENAME.match(filename)
+            if m is None:
+                module_logger.warning('Skipping {}'.format(filename))
+                continue
+            t0 = datetime.strptime(m.group(1), '%Y%m%d%H%M%S%f')
+            with open(os.path.join(inbox, filename), 'rb') as f:
+                batch.append(
+                    StoredMessage((m.group(2), 0), f.read(), t0))
+        store.save_batch(batch)
+        n += len(batch)
+        module_logger.debug('Imported {} messages from {}'.format(n, inbox))
+    return n
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental processing of the messages saved in a datadir/inbox.
+
+Instead of polling the inbox, which gets slower as it grows, InboxWatcher
+asks the kernel (inotify, Linux only) for the files closed after writing,
+or moved, into it. Each new message is parsed once and given to a handler.
+
+The files processed are kept in a Checkpoint, so a restart resumes where it
+stopped. When starting, the files that arrived in the meantime are parsed
+in parallel by a pool of processes (catch-up) and then handled in the order
+they were received. Files are named after their receiving time (see
+save_isbd_msg), thus everything up to a mark is done, and the files after
+it are remembered one by one, since several writers can save them slightly
+out of order.
+
+The checkpoint is saved every save_interval seconds, thus after a crash the
+files handled since then are handled again. Without inotify, the inbox is
+scanned every poll_interval seconds instead.
+"""
+
+import ctypes
+import ctypes.util
+from datetime import datetime, timedelta
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import select
+import struct
+import threading
+import time
+
+from .iridiumSBD import IridiumSBD
+from .directip.postprocessing import make_task
+from .store import INBOX_FILENAME
+
+
+module_logger = logging.getLogger('DirectIP')
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Names of the files closed after writing, or moved, into a directory
+
+    Uses the inotify API of Linux through ctypes. Raises OSError if it is
+    not available.
+    """
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed', path)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events
+
+        Returns:
+            list: Names of the files, or None if the kernel queue overflowed
+                and events were lost.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        overflow = False
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif name:
+                names.append(os.fsdecode(name))
+        return None if overflow else names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Checkpoint(object):
+    """Names of the inbox files already processed, saved as JSON
+
+    Every name up to mark is done, plus the ones in done. Names are pruned
+    from done, advancing the mark, once they are window seconds older than
+    the newest one.
+
+    Args:
+        path (str): Where the checkpoint is saved, loaded if it exists.
+        window (float): Maximum seconds a file can be saved out of order.
+    """
+    def __init__(self, path, window=3600):
+        self.path = path
+        self.window = window
+        self.mark = ''
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as fid:
+                saved = json.load(fid)
+            self.mark = saved['mark']
+            self.done = set(saved['done'])
+
+    def __contains__(self, name):
+        return (name <= self.mark) or (name in self.done)
+
+    def add(self, name):
+        if name > self.mark:
+            self.done.add(name)
+
+    def prune(self):
+        if not self.done:
+            return
+        m = INBOX_FILENAME.match(max(self.done))
+        if m is None:
+            return
+        newest = datetime.strptime(m.group(1), '%Y%m%d%H%M%S%f')
+        mark = (newest - timedelta(seconds=self.window)).strftime(
+            '%Y%m%d%H%M%S%f')
+        if mark > self.mark:
+            self.mark = mark
+            self.done = {name for name in self.done if name > mark}
+
+    def save(self):
+        """Save it, atomically replacing the previous file"""
+        self.prune()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fid:
+            json.dump({'mark': self.mark, 'done': sorted(self.done)}, fid)
+        os.replace(tmp, self.path)
+
+
+def parse_file(filename):
+    """The message saved in filename, or None if it can't be parsed"""
+    try:
+        with open(filename, 'rb') as f:
+            return IridiumSBD(f.read())
+    except Exception as e:
+        module_logger.warning('Failed to parse {}: {}'.format(filename, e))
+        return None
+
+
+def parse_files(filenames):
+    return [(filename, parse_file(filename)) for filename in filenames]
+
+
+def make_handler(spec, timeout=60):
+    """Handler from a command or a Python callable, like --post-processing
+
+    Same as the post-processing tasks (see make_task): a command is run
+    with the filename of each message as its single argument, for at most
+    timeout seconds, while a Python callable is called with each message
+    parsed.
+    """
+    return make_task(spec, timeout=timeout)
+
+
+class InboxWatcher(object):
+    """Give each new message saved in datadir/inbox to a handler, once
+
+    Args:
+        datadir (str): Data directory of the server.
+        handler (callable): Called as handler(isbd, filename) for each
+            message, in the order received. Files that can't be parsed are
+            skipped.
+        checkpoint (str): Where the checkpoint is saved, by default
+            datadir/watch.json. Each consumer needs its own.
+        workers (int): Processes parsing the files of the catch-up, default
+            is one per CPU.
+        chunksize (int): Number of files parsed by each task of the
+            catch-up.
+        poll_interval (float): Seconds between scans of the inbox if
+            inotify is not available (or not used).
+        save_interval (float): Seconds between saves of the checkpoint.
+        use_inotify (bool): Use inotify if available, or always poll.
+    """
+    def __init__(self,
+                 datadir,
+                 handler,
+                 checkpoint=None,
+                 workers=None,
+                 chunksize=100,
+                 poll_interval=1.0,
+                 save_interval=1.0,
+                 use_inotify=True):
+        self.logger = logging.getLogger('DirectIP.InboxWatcher')
+        self.inbox = os.path.join(datadir, 'inbox')
+        if not os.path.isdir(self.inbox):
+            os.makedirs(self.inbox)
+        self.handler = handler
+        if checkpoint is None:
+            checkpoint = os.path.join(datadir, 'watch.json')
+        self.checkpoint = Checkpoint(checkpoint)
+        self.workers = workers
+        self.chunksize = chunksize
+        self.poll_interval = poll_interval
+        self.save_interval = save_interval
+        self.use_inotify = use_inotify
+        self.processed = 0
+        self.stopped = threading.Event()
+
+    def pending(self):
+        """Names of the files not processed yet, in the order received"""
+        return sorted(entry.name for entry in os.scandir(self.inbox)
+                      if entry.name.endswith('.isbd') and
+                      entry.name not in self.checkpoint)
+
+    def dispatch(self, filename, isbd):
+        if isbd is not None:
+            try:
+                self.handler(isbd, filename)
+            except Exception:
+                self.logger.exception('Handler failed on {}'.format(filename))
+        self.checkpoint.add(os.path.basename(filename))
+        self.processed += 1
+
+    def catch_up(self):
+        """Process the files saved while not watching
+
+        Returns:
+            int: Number of files processed.
+        """
+        filenames = [os.path.join(self.inbox, name)
+                     for name in self.pending()]
+        if not filenames:
+            return 0
+        self.logger.info('Catching up with {} message(s)'.format(
+            len(filenames)))
+        t0 = time.time()
+        chunks = [filenames[i:i + self.chunksize]
+                  for i in range(0, len(filenames), self.chunksize)]
+        pool = None
+        if (len(chunks) > 1) and (self.workers != 1):
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap(parse_files, chunks)
+        else:
+            results = map(parse_files, chunks)
+        try:
+            for parsed in results:
+                for filename, isbd in parsed:
+                    self.dispatch(filename, isbd)
+                self.checkpoint.save()
+                if self.stopped.is_set():
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self.logger.info('Caught up in {:.1f} s'.format(time.time() - t0))
+        return len(filenames)
+
+    def run(self):
+        """Catch up, then process the new files until stop()"""
+        notifier = None
+        if self.use_inotify:
+            # Before catching up, so nothing saved meanwhile is missed
+            try:
+                notifier = Inotify(self.inbox)
+            except OSError as e:
+                self.logger.warning(
+                    'Without inotify ({}), scanning every {} s'.format(
+                        e, self.poll_interval))
+        try:
+            self.catch_up()
+            saved = time.monotonic()
+            while not self.stopped.is_set():
+                if notifier is None:
+                    self.stopped.wait(self.poll_interval)
+                    names = self.pending()
+                else:
+                    names = notifier.read(self.poll_interval)
+                    if names is None:
+                        self.logger.warning(
+                            'Lost inotify events, scanning the inbox')
+                        names = self.pending()
+                for name in names:
+                    if name.endswith('.isbd') and name not in self.checkpoint:
+                        filename = os.path.join(self.inbox, name)
+                        self.dispatch(filename, parse_file(filename))
+                if time.monotonic() - saved >= self.save_interval:
+                    self.checkpoint.save()
+                    saved = time.monotonic()
+        finally:
+            if notifier is not None:
+                notifier.close()
+            self.checkpoint.save()
+
+    def stop(self):
+        self.stopped.set()
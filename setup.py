@@ -45,6 +45,9 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'batch': ['numpy'],
+    },
     license="BSD license",
     zip_safe=False,
     keywords='isbd',
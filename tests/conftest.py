@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the tests.
+
+Timing assertions, marked as benchmark, run only with --benchmark.
+"""
+
+import time
+
+import pytest
+
+
+def wait_until(condition, timeout=10, interval=0.01):
+    """Poll condition() until true, failing after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timeout"
+        time.sleep(interval)
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+                     help='Run the tests marked as benchmark')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'benchmark: timing assertions, run with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='Benchmark, run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
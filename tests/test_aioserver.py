@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the asyncio DirectIP server."""
+
+import asyncio
+import os
+import socket
+from tempfile import TemporaryDirectory
+
+from iridiumSBD.directip.aioserver import AsyncDirectIPServer
+from iridiumSBD.directip.server import ACK
+from iridiumSBD.store import SegmentStorage
+
+from .test_iridiumSBD import minimal_full_msg
+
+
+def _send(address, chunks):
+    sock = socket.create_connection(address)
+    try:
+        for c in chunks:
+            sock.sendall(c)
+        sock.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            chunk = sock.recv(1024)
+            if not chunk:
+                return response
+            response += chunk
+    finally:
+        sock.close()
+
+
+def _run(datadir, transmissions, **kwargs):
+    async def session():
+        server = AsyncDirectIPServer(('127.0.0.1', 0), datadir, **kwargs)
+        await server.start()
+        loop = asyncio.get_event_loop()
+        acks = await asyncio.gather(*[
+            loop.run_in_executor(None, _send, server.server_address, t)
+            for t in transmissions])
+        await server.close()
+        return acks
+    return asyncio.run(session())
+
+
+def test_ack_and_save():
+    with TemporaryDirectory() as datadir:
+        acks = _run(datadir, [[minimal_full_msg]])
+        assert acks == [ACK]
+        inbox = os.listdir(os.path.join(datadir, 'inbox'))
+        assert len(inbox) == 1
+        with open(os.path.join(datadir, 'inbox', inbox[0]), 'rb') as f:
+            assert f.read() == minimal_full_msg
+
+
+def test_fragmented_message():
+    chunks = [minimal_full_msg[:2], minimal_full_msg[2:20],
+              minimal_full_msg[20:]]
+    with TemporaryDirectory() as datadir:
+        assert _run(datadir, [chunks]) == [ACK]
+
+
+def test_many_connections():
+    with TemporaryDirectory() as datadir:
+        acks = _run(datadir, [[minimal_full_msg]] * 50)
+        assert acks == [ACK] * 50
+
+
+def test_corrupted_message():
+    with TemporaryDirectory() as datadir:
+        acks = _run(datadir, [[b'\x02' + minimal_full_msg[1:]]])
+        assert acks == [b'']
+        assert len(os.listdir(os.path.join(datadir, 'corrupted'))) == 1
+
+
+def test_segment_storage():
+    with TemporaryDirectory() as datadir:
+        storage = SegmentStorage(datadir)
+        acks = _run(datadir, [[minimal_full_msg]] * 10, storage=storage)
+        assert acks == [ACK] * 10
+        assert not os.path.exists(os.path.join(datadir, 'inbox'))
+        found = list(SegmentStorage(datadir).inbox.find())
+        assert len(found) == 10
+
+
+def test_back_to_back_messages():
+    with TemporaryDirectory() as datadir:
+        acks = _run(datadir, [[minimal_full_msg * 3]])
+        assert acks == [ACK * 3]
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 3
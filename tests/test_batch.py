@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the vectorized batch decoder, using IridiumSBD as reference."""
+
+import struct
+
+import pytest
+
+from iridiumSBD import iridiumSBD as isbd
+
+from .test_iridiumSBD import minimal_full_msg, minimal_MT_msg
+
+# The batch decoder needs numpy
+pytest.importorskip('numpy')
+batch = pytest.importorskip('iridiumSBD.batch')
+
+
+def mo_msg(i, orient, with_location=True):
+    header = struct.pack('>cHI15sBHHI', b'\x01', 28, 1000 + i,
+                         b'%015d' % i, i % 256, i, 2 * i, 1500000000 + i)
+    location = struct.pack('>cHBBHBHI', b'\x03', 11, orient, i % 90,
+                           (i * 7) % 60000, i % 180, (i * 13) % 60000, i)
+    payload = struct.pack('>cH', b'\x02', 3) + b'abc'
+    body = (payload + location + header) if with_location \
+        else (header + payload)
+    return struct.pack('>cH', b'\x01', len(body)) + body
+
+
+def test_decode_batch_matches_IridiumSBD():
+    messages = [mo_msg(i, i % 4, with_location=(i % 5 != 0))
+                for i in range(200)]
+    messages += [minimal_full_msg, minimal_MT_msg]
+    buffer, offsets = batch.concatenate(messages)
+    result = batch.decode_batch(buffer, offsets)
+
+    for i, m in enumerate(messages):
+        ref = isbd.IridiumSBD(m)
+        header = ref.attributes['header']
+        if ref.mtype == 'MT':
+            assert not result['has_header'][i]
+            continue
+        h = result['header'][i]
+        for v in ('CDR_reference', 'session_status', 'MOMSN', 'MTMSN',
+                  'session_epoch'):
+            assert h[v] == header[v]
+        assert h['IMEI'].decode() == header['IMEI']
+        assert h['session_datetime'].astype(object) == \
+            header['session_datetime']
+
+        assert result['has_location'][i] == ('location' in ref.attributes)
+        if 'location' in ref.attributes:
+            loc = result['location'][i]
+            for v, value in ref.attributes['location'].items():
+                if v not in ('IEI', 'length'):
+                    assert loc[v] == pytest.approx(value)
+
+        start = result['payload_offset'][i]
+        assert buffer[start:start + result['payload_length'][i]] == \
+            ref.payload['data']
+
+
+def test_decode_list():
+    result = batch.decode_batch([minimal_full_msg] * 3)
+    assert list(result['header']['IMEI']) == [b'1234567890abcde'] * 3
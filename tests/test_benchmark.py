@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""Microbenchmarks of parsing ISBD messages.
+
+Run with `pytest -s tests/test_benchmark.py` to see the timings. The tests
+marked as benchmark, which assert on timings, are only run with
+`--benchmark`.
+"""
+
+from datetime import timedelta
+import os
+import struct
+import timeit
+from tempfile import TemporaryDirectory
+import tracemalloc
+
+import pytest
+
+from iridiumSBD import iridiumSBD as isbd
+from iridiumSBD.directip.bench import make_messages, run, local_server
+from iridiumSBD.directip.journal import GroupCommitLog
+from iridiumSBD.index import MessageIndex
+
+from .test_iridiumSBD import minimal_full_msg, minimal_MT_msg
+
+
+def msg_with_locations(n):
+    """Minimal message with n location IEs after the header"""
+    location = minimal_full_msg[34:48]
+    body = minimal_full_msg[3:34] + location * n
+    return struct.pack('>cH', b'\x01', len(body)) + body
+
+
+def parse_time(msg, parse=isbd.IridiumSBD):
+    """Best time, in seconds, to parse msg once"""
+    timer = timeit.Timer(lambda: parse(msg))
+    return min(timer.repeat(repeat=5, number=10)) / 10
+
+
+# Order of the if/elif chain that dispatched on the IEI
+OLD_DISPATCH = (0x01, 0x02, 0x03, 0x05, 0x41, 0x42, 0x44, 0x46)
+
+
+def parse_copying(msg):
+    """Walk the IEs as before, copying the rest of the message at each step
+
+    Same IE parsers, but the end of the message and each IEI compared are
+    read from content[offset:], like Message.__getitem__ used to.
+    """
+    m = isbd.Message(bytes(msg))
+    m.consume(isbd.IE_HEADER)
+    while len(m.content[m.offset:]) > 0:
+        for iei in OLD_DISPATCH:
+            if m.content[m.offset:][0] == iei:
+                break
+        isbd.IE_PARSERS[iei][0](m)
+
+
+@pytest.mark.benchmark
+def test_parse_time_per_message():
+    """Parse time with the copy-based slicing (before) and now (after)"""
+    print('{:>10}  {:>10}  {:>10}'.format('', 'before us', 'after us'))
+    for name, msg in [('minimal', minimal_full_msg),
+                      ('10 IEs', msg_with_locations(10)),
+                      ('100 IEs', msg_with_locations(100)),
+                      ('1000 IEs', msg_with_locations(1000))]:
+        before = parse_time(msg, parse_copying)
+        after = parse_time(msg)
+        print('{:>10}  {:10.1f}  {:10.1f}'.format(
+            name, before * 1e6, after * 1e6))
+    # The copies dominate once the message has many IEs
+    assert after < before
+
+
+@pytest.mark.benchmark
+def test_parse_time_is_linear_on_IEs():
+    """Parsing must not copy the rest of the message for each IE"""
+    short = parse_time(msg_with_locations(10)) / 10
+    long = parse_time(msg_with_locations(1000)) / 1000
+    assert long < 3 * short
+
+
+def test_parse_rate_per_IE_type():
+    """Messages/second decoding each type of IE alone"""
+    mt_ack = b'D\x00\x19\x00\x00\x00\x001234567890abcde\xa5\xb5n\x1a\x00\x01'
+    samples = [
+        ('MO header', isbd.parse_MO_header, minimal_full_msg[3:34]),
+        ('MO payload', isbd.parse_MO_payload, minimal_full_msg[48:]),
+        ('MO location', isbd.parse_MO_location, minimal_full_msg[34:48]),
+        ('MO confirmation', isbd.parse_MO_confirmation, b'\x05\x00\x01\x01'),
+        ('MT header', isbd.parse_MT_header, minimal_MT_msg[3:27]),
+        ('MT payload', isbd.parse_MT_payload, minimal_MT_msg[27:35]),
+        ('MT confirmation', isbd.parse_MT_confirmation, mt_ack),
+        ('MT priority', isbd.parse_MT_priority, minimal_MT_msg[35:]),
+        ]
+    for name, parser, ie in samples:
+        timer = timeit.Timer(lambda: parser(isbd.Message(ie)))
+        t = min(timer.repeat(repeat=5, number=1000)) / 1000
+        print('{:>16}: {:10.0f} msg/s'.format(name, 1 / t))
+
+
+def test_decode_batch_rate():
+    """Messages/second with the vectorized decoder"""
+    pytest.importorskip('numpy')
+    from iridiumSBD.batch import decode_batch, concatenate
+
+    buffer, offsets = concatenate([minimal_full_msg] * 100000)
+    timer = timeit.Timer(lambda: decode_batch(buffer, offsets))
+    t = min(timer.repeat(repeat=3, number=1))
+    print('decode_batch: {:10.0f} msg/s'.format(len(offsets) / t))
+
+
+def test_encode_rate():
+    """Messages/second encoding, and the round trip with load()"""
+    mo = isbd.IridiumSBD(minimal_full_msg)
+    mt = isbd.IridiumSBD(minimal_MT_msg)
+    for name, msg in [('MO', mo), ('MT', mt)]:
+        timer = timeit.Timer(msg.encode)
+        t = min(timer.repeat(repeat=5, number=1000)) / 1000
+        print('{:>16}: {:10.0f} msg/s'.format('encode ' + name, 1 / t))
+
+    timer = timeit.Timer(lambda: isbd.IridiumSBD(mo.encode()).encode())
+    t = min(timer.repeat(repeat=5, number=1000)) / 1000
+    print('{:>16}: {:10.0f} msg/s'.format('round trip MO', 1 / t))
+
+
+def test_routing_rate():
+    """Messages/second getting only the IMEI"""
+    samples = [
+        ('eager', lambda: isbd.IridiumSBD(
+            minimal_full_msg).attributes['header']['IMEI']),
+        ('lazy', lambda: isbd.IridiumSBD(minimal_full_msg, lazy=True).header[
+            'IMEI']),
+        ('peek_imei', lambda: isbd.peek_imei(minimal_full_msg)),
+        ]
+    for name, func in samples:
+        timer = timeit.Timer(func)
+        t = min(timer.repeat(repeat=5, number=1000)) / 1000
+        print('{:>16}: {:10.0f} msg/s'.format('IMEI ' + name, 1 / t))
+
+
+def memory_per_message(func, n=10000):
+    """Bytes allocated, and kept, for each of n results of func()"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [func() for i in range(n)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    return size / len(kept)
+
+
+@pytest.mark.benchmark
+def test_memory_per_message():
+    """Bytes per decoded message, sections as records or as plain dicts"""
+    data = bytes(minimal_full_msg)
+
+    def as_dicts():
+        isbd_msg = isbd.IridiumSBD(data)
+        for k, v in isbd_msg.attributes.items():
+            if isinstance(v, isbd.Record):
+                isbd_msg.attributes[k] = dict(v)
+        isbd_msg.payload = dict(isbd_msg.payload)
+        return isbd_msg
+
+    records = memory_per_message(lambda: isbd.IridiumSBD(data))
+    dicts = memory_per_message(as_dicts)
+    print('{:>16}: {:8.0f} bytes/msg'.format('records', records))
+    print('{:>16}: {:8.0f} bytes/msg'.format('dicts', dicts))
+    assert records < dicts
+
+
+@pytest.mark.benchmark
+def test_index_query_time():
+    """Milliseconds to find a week of an IMEI among many messages"""
+    n = 200000
+    with TemporaryDirectory() as tmpdir:
+        index = MessageIndex(os.path.join(tmpdir, 'index.sqlite'))
+        # 1000 IMEIs, each with a message every 3 hours
+        index.add(('{}.isbd'.format(i), '300234010{:06d}'.format(i % 1000),
+                   1500000000 + (i // 1000) * 10800, i // 1000, None)
+                  for i in range(n))
+        since = isbd.EPOCH + timedelta(seconds=1500000000 + 7 * 86400)
+        timer = timeit.Timer(lambda: index.query(
+            imei='300234010000042', since=since,
+            until=since + timedelta(days=7)))
+        t = min(timer.repeat(repeat=5, number=10)) / 10
+        index.close()
+    print('query in {} messages: {:8.2f} ms'.format(n, t * 1e3))
+    assert t < 0.05
+
+
+@pytest.mark.benchmark
+def test_durable_ack_vs_commit_interval():
+    """Throughput and accept-to-ack latency against the journal interval"""
+    messages = make_messages(400)
+    print('{:>16}  {:>8}  {:>8}  {:>8}'.format(
+        'journal', 'msg/s', 'p50 ms', 'p99 ms'))
+    configs = [('none', None), ('each message', (0, 1))] + \
+        [('{:g} ms'.format(i * 1e3), (i, 64)) for i in (0, 0.001, 0.005, 0.02)]
+    for name, config in configs:
+        with TemporaryDirectory() as datadir:
+            options = {}
+            if config is not None:
+                options['journal'] = GroupCommitLog(
+                    os.path.join(datadir, 'journal'),
+                    interval=config[0], max_batch=config[1])
+            with local_server(datadir, **options) as address:
+                result = run(address, messages, connections=20)
+        assert result['errors'] == 0
+        print('{:>16}  {:8.0f}  {:8.2f}  {:8.2f}'.format(
+            name, result['throughput'], result['p50'] * 1e3,
+            result['p99'] * 1e3))
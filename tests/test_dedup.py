@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the detection of duplicated MO messages."""
+
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+from iridiumSBD.directip.dedup import DedupCache, SharedDedupCache, \
+        message_key
+from iridiumSBD.directip.server import ACK, ThreadedDirectIPServer
+
+from .test_aioserver import _run
+from .test_iridiumSBD import minimal_full_msg, minimal_MT_msg
+
+
+def test_message_key():
+    assert message_key(minimal_full_msg) == ('1234567890abcde', 42, 123456)
+    assert message_key(minimal_MT_msg) is None
+    assert message_key(b'\x01\x00\x04\x05\x00\x01\x01') is None
+
+
+def test_lru_and_ttl():
+    cache = DedupCache(maxsize=2, ttl=60)
+    assert cache.add('a')
+    assert cache.add('b')
+    assert not cache.add('a')
+    # b is the least recently seen
+    assert cache.add('c')
+    assert 'a' in cache and 'b' not in cache
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    cache = DedupCache(ttl=0.01)
+    assert cache.add('a')
+    time.sleep(0.02)
+    assert cache.add('a')
+
+
+def test_persistence():
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'dedup.json')
+        cache = DedupCache(path=path)
+        cache.add(('1234567890abcde', 42, 123456))
+        cache.close()
+        cache = DedupCache(path=path)
+        assert ('1234567890abcde', 42, 123456) in cache
+        assert DedupCache(path=path, ttl=-1).entries == {}
+
+
+def test_threaded_server():
+    with TemporaryDirectory() as datadir:
+        server = ThreadedDirectIPServer(('127.0.0.1', 0), datadir,
+                                        dedup=DedupCache())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for i in range(3):
+                sock = socket.create_connection(server.server_address)
+                sock.sendall(minimal_full_msg)
+                assert sock.recv(1024) == ACK
+                sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 1
+        assert server.dedup.hits == 2
+
+
+def test_aioserver():
+    with TemporaryDirectory() as datadir:
+        acks = _run(datadir, [[minimal_full_msg, minimal_full_msg]],
+                    dedup=DedupCache())
+        assert acks == [ACK * 2]
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 1
+
+
+def test_shared_cache():
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'dedup.sqlite')
+        cache = SharedDedupCache(path, maxsize=2, ttl=60, prune_every=1)
+        other = SharedDedupCache(path, maxsize=2, ttl=60)
+        key = ('1234567890abcde', 42, 123456)
+        assert cache.add(key)
+        assert key in other
+        assert not other.add(key)
+        other.discard(key)
+        assert cache.add(key)
+        # b is the least recently seen
+        assert cache.add('a') and cache.add('b') and not cache.add('a')
+        assert cache.add('c')
+        assert 'a' in cache and 'b' not in cache and len(cache) == 2
+        cache.close()
+        other.close()
+
+        cache = SharedDedupCache(path, ttl=0.01)
+        time.sleep(0.02)
+        assert cache.add('a')
+        cache.close()
+
+
+def _add_keys(path, keys, results):
+    cache = SharedDedupCache(path)
+    results.put(sum(cache.add(key) for key in keys))
+    cache.close()
+
+
+def test_shared_cache_processes():
+    """Of the copies sent to several processes, only one is new"""
+    keys = [('300234010000000', i, i) for i in range(200)]
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'dedup.sqlite')
+        SharedDedupCache(path).close()
+        processes = [ctx.Process(target=_add_keys, args=(path, keys, results))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        added = sum(results.get(timeout=30) for process in processes)
+        for process in processes:
+            process.join()
+    assert added == len(keys)
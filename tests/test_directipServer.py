@@ -1,62 +1,311 @@
+# -*- coding: utf-8 -*-
 
+"""End-to-end tests of the DirectIP servers, with the load generator."""
+
+import multiprocessing
+import os
+import resource
+import signal
+import socket
 from tempfile import TemporaryDirectory
-from iridiumSBD.directip.server import DirectIPServer
+import threading
+import time
 
+from click.testing import CliRunner
+import pytest
 
+from iridiumSBD import cli
+from iridiumSBD.iridiumSBD import IridiumSBD
+from iridiumSBD.directip import metrics
+from iridiumSBD.directip.bench import make_messages, send_message, run, \
+        percentile, local_server
+from iridiumSBD.directip.server import ACK, InboxStorage, \
+        ThreadedDirectIPServer, readable, runserver
 
-with TemporaryDirectory() as datadir:
-    server = DirectIPServer(('127.0.0.1', 10801), datadir.name)
 
+def test_make_messages():
+    messages = make_messages(8, payload_size=100, location_ratio=0.25,
+                             imeis=2)
+    decoded = [IridiumSBD(m) for m in messages]
+    assert len({m.attributes['header']['CDR_reference'] for m in decoded}) \
+        == 8
+    assert {m.attributes['header']['IMEI'] for m in decoded} == \
+        {'300234010000000', '300234010000001'}
+    assert sum('location' in m.attributes for m in decoded) == 2
+    assert all(m.payload['length'] == 100 for m in decoded)
+    assert not hasattr(IridiumSBD(make_messages(1, 0)[0]), 'payload')
 
-server.serve_forever()
 
+def test_percentile():
+    values = list(range(1, 1001))
+    assert percentile(values, 50) == 500
+    assert percentile(values, 99) == 990
+    assert percentile(values, 99.9) == 999
+    assert percentile([], 50) is None
 
 
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+@pytest.mark.parametrize('mode', ['normal', 'fragmented', 'slow'])
+def test_server(backend, mode):
+    messages = make_messages(20)
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend) as address:
+            result = run(address, messages, connections=4, mode=mode,
+                         delay=0)
+        assert result['messages'] == 20
+        assert result['errors'] == 0
+        assert 0 < result['p50'] <= result['p99'] <= result['p999']
+        inbox = os.path.join(datadir, 'inbox')
+        saved = set()
+        for filename in os.listdir(inbox):
+            with open(os.path.join(inbox, filename), 'rb') as f:
+                saved.add(f.read())
+        assert saved == set(messages)
 
 
-import socket
-import threading
-import socketserver
+def test_corrupted():
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir) as address:
+            with pytest.raises(ValueError):
+                send_message(address, b'\x02\x00\x05hello')
+        assert len(os.listdir(os.path.join(datadir, 'corrupted'))) == 1
+
+
+def receive_all(sock):
+    """Everything sent by the server until it closes the connection"""
+    response = b''
+    while True:
+        chunk = sock.recv(1024)
+        if not chunk:
+            return response
+        response += chunk
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_read_timeout(backend):
+    data = make_messages(1)[0]
+    timeouts = metrics.read_timeouts.value
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend, read_timeout=0.2) as address:
+            sock = socket.create_connection(address, 5)
+            t0 = time.monotonic()
+            sock.sendall(data[:10])
+            # Stalled client, closed by the server without an ack
+            assert receive_all(sock) == b''
+            assert time.monotonic() - t0 < 2
+            sock.close()
+        assert metrics.read_timeouts.value == timeouts + 1
+        assert os.listdir(os.path.join(datadir, 'inbox')) == []
+        assert len(os.listdir(os.path.join(datadir, 'corrupted'))) == 1
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_session_timeout(backend):
+    data = make_messages(1)[0]
+    timeouts = metrics.session_timeouts.value
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend, read_timeout=1,
+                          session_timeout=0.3) as address:
+            # Each byte comes well within the read timeout, but the whole
+            # message takes longer than the session
+            with pytest.raises((ValueError, OSError)):
+                send_message(address, data, 'slow', chunk_size=1, delay=0.05)
+        assert metrics.session_timeouts.value == timeouts + 1
+        assert os.listdir(os.path.join(datadir, 'inbox')) == []
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_linger_within_session(backend):
+    data = make_messages(1)[0]
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend, linger=5,
+                          session_timeout=0.3) as address:
+            sock = socket.create_connection(address, 5)
+            sock.sendall(data)
+            started = time.monotonic()
+            assert receive_all(sock) == ACK
+            assert time.monotonic() - started < 2
+            sock.close()
+
 
-class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_max_connections_refuse(backend):
+    data = make_messages(2)
+    refused = metrics.refused.value
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend, max_connections=1) as address:
+            sock = socket.create_connection(address, 5)
+            sock.sendall(data[0][:10])
+            time.sleep(0.2)
+            with pytest.raises((ValueError, OSError)):
+                send_message(address, data[1])
+            assert metrics.refused.value == refused + 1
+            sock.sendall(data[0][10:])
+            assert receive_all(sock) == ACK
+            sock.close()
+            # The slot is free again, once the handler finished
+            time.sleep(0.2)
+            send_message(address, data[1])
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 2
 
-    def handle(self):
-        data = str(self.request.recv(1024), 'ascii')
-        cur_thread = threading.current_thread()
-        response = bytes("{}: {}".format(cur_thread.name, data), 'ascii')
-        self.request.sendall(response)
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_max_connections_wait(backend):
+    data = make_messages(2)
+    latencies = []
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend, max_connections=1,
+                          connection_policy='wait') as address:
+            sock = socket.create_connection(address, 5)
+            sock.sendall(data[0][:10])
+            time.sleep(0.2)
+            waiting = threading.Thread(
+                target=lambda: latencies.append(
+                    send_message(address, data[1])))
+            waiting.start()
+            time.sleep(0.3)
+            assert latencies == []
+            sock.sendall(data[0][10:])
+            assert receive_all(sock) == ACK
+            sock.close()
+            waiting.join(5)
+            assert len(latencies) == 1
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 2
 
-def client(ip, port, message):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((ip, port))
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_wait_policy_not_accepted(backend):
+    """Connections waiting for a slot stay in the accept queue"""
+    data = make_messages(1)[0]
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend, max_connections=1,
+                          connection_policy='wait') as address:
+            busy = socket.create_connection(address, 5)
+            busy.sendall(data[:10])
+            time.sleep(0.2)
+            fds = len(os.listdir('/proc/self/fd'))
+            waiting = [socket.create_connection(address, 5)
+                       for i in range(5)]
+            time.sleep(0.2)
+            # The client side of each one, plus the one the threaded server
+            # accepted and holds until a slot is free
+            assert len(os.listdir('/proc/self/fd')) <= fds + 6
+            busy.sendall(data[10:])
+            assert receive_all(busy) == ACK
+            busy.close()
+            for sock in waiting:
+                sock.close()
+
+
+def test_wait_policy_shutdown():
+    """Shutdown doesn't wait for a connection waiting for a slot"""
+    data = make_messages(2)
+    with TemporaryDirectory() as datadir:
+        server = ThreadedDirectIPServer(('127.0.0.1', 0), datadir,
+                                        max_connections=1,
+                                        connection_policy='wait')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        busy = socket.create_connection(server.server_address, 5)
+        busy.sendall(data[0][:10])
+        waiting = socket.create_connection(server.server_address, 5)
+        waiting.sendall(data[1])
+        time.sleep(0.3)
+        started = time.monotonic()
+        server.shutdown()
+        assert time.monotonic() - started < 2
+        thread.join()
+        assert receive_all(waiting) == b''
+        busy.close()
+        waiting.close()
+        server.server_close()
+
+
+def test_close_waits_for_handlers():
+    """A message acknowledged while closing is still saved"""
+    data = make_messages(1)[0]
+    with TemporaryDirectory() as datadir:
+        server = ThreadedDirectIPServer(('127.0.0.1', 0), datadir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(data[:10])
+        time.sleep(0.1)
+        server.shutdown()
+        thread.join()
+        closing = threading.Thread(target=server.server_close)
+        closing.start()
+        time.sleep(0.1)
+        sock.sendall(data[10:])
+        assert sock.recv(1024) == ACK
+        sock.close()
+        closing.join()
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 1
+
+
+def test_readable_high_fd():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard <= 2000:
+        pytest.skip('Not enough file descriptors')
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 2001), hard))
+    a, b = socket.socketpair()
     try:
-        sock.sendall(bytes(message, 'ascii'))
-        response = str(sock.recv(1024), 'ascii')
-        print("Received: {}".format(response))
-    finally:
+        os.dup2(a.fileno(), 2000)
+        sock = socket.socket(fileno=2000)
+        assert not readable(sock, 0)
+        b.sendall(b'x')
+        assert readable(sock, 1)
         sock.close()
+    finally:
+        a.close()
+        b.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+class SlowStorage(InboxStorage):
+    def save_batch(self, batch):
+        time.sleep(0.05)
+        return InboxStorage.save_batch(self, batch)
+
 
-if __name__ == "__main__":
-    # Port 0 means to select an arbitrary unused port
-    HOST, PORT = "localhost", 0
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
 
-    server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
-    ip, port = server.server_address
 
-    # Start a thread with the server -- that thread will then start one
-    # more thread for each request
-    server_thread = threading.Thread(target=server.serve_forever)
-    # Exit the server thread when the main thread terminates
-    server_thread.daemon = True
-    server_thread.start()
-    print("Server loop running in thread:", server_thread.name)
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_sigterm_flushes(backend):
+    messages = make_messages(20)
+    port = free_port()
+    with TemporaryDirectory() as datadir:
+        server = multiprocessing.get_context('fork').Process(
+            target=runserver, args=('127.0.0.1', port, datadir),
+            kwargs=dict(backend=backend, writers=1,
+                        storage=SlowStorage(datadir)))
+        server.start()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                assert time.monotonic() < deadline, "Timeout"
+                time.sleep(0.05)
+        result = run(('127.0.0.1', port), messages, connections=4)
+        assert result['errors'] == 0
+        # Acknowledged, but most of them still in the queue
+        os.kill(server.pid, signal.SIGTERM)
+        server.join(10)
+        assert server.exitcode == 0
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 20
 
-    client(ip, port, "Hello World 1")
-    client(ip, port, "Hello World 2")
-    client(ip, port, "Hello World 3")
 
-    server.shutdown()
-    server.server_close()
+def test_bench_command():
+    result = CliRunner().invoke(cli.main, [
+        'bench', '-n', '20', '-c', '2', '--mode', 'fragmented'])
+    assert result.exit_code == 0
+    assert '20 messages (0 errors)' in result.output
+    assert 'p99.9' in result.output
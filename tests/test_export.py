@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the bulk export."""
+
+import csv
+from datetime import datetime, timedelta
+import json
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+from click.testing import CliRunner
+
+from iridiumSBD import cli
+from iridiumSBD.directip.server import save_isbd_msg
+
+from .test_iridiumSBD import minimal_full_msg
+
+
+def _datadir(tmpdir, n):
+    t0 = datetime(2017, 7, 3)
+    for i in range(n):
+        save_isbd_msg(tmpdir, ('10.0.0.1', 0), minimal_full_msg,
+                      t0 + timedelta(seconds=i))
+    save_isbd_msg(tmpdir, ('10.0.0.1', 0), b'\x01\x00\x01\xff',
+                  t0 + timedelta(seconds=n))
+
+
+def test_export_csv():
+    with TemporaryDirectory() as tmpdir:
+        _datadir(tmpdir, 25)
+        output = os.path.join(tmpdir, 'out.csv')
+        result = CliRunner().invoke(cli.main, [
+            'export', tmpdir, '-o', output, '--workers', '2',
+            '--chunksize', '4'])
+        assert result.exit_code == 0
+        with open(output) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 25
+        assert rows == sorted(rows, key=lambda r: r['filename'])
+        assert rows[0]['IMEI'] == '1234567890abcde'
+        assert float(rows[0]['latitude']) < 0
+        assert bytes.fromhex(rows[0]['payload']) == b'hello world'
+
+
+def test_export_jsonl_unordered():
+    with TemporaryDirectory() as tmpdir:
+        _datadir(tmpdir, 10)
+        output = os.path.join(tmpdir, 'out.jsonl')
+        result = CliRunner().invoke(cli.main, [
+            'export', tmpdir, '-o', output, '--format', 'jsonl',
+            '--unordered', '--chunksize', '3'])
+        assert result.exit_code == 0
+        with open(output) as f:
+            rows = [json.loads(line) for line in f]
+        assert len(rows) == 10
+        assert rows[0]['session_datetime'] == '2017-07-14T02:40:00'
+
+
+def test_export_parquet():
+    pq = pytest.importorskip('pyarrow.parquet')
+    with TemporaryDirectory() as tmpdir:
+        _datadir(tmpdir, 10)
+        output = os.path.join(tmpdir, 'out.parquet')
+        result = CliRunner().invoke(cli.main, [
+            'export', tmpdir, '-o', output, '--format', 'parquet'])
+        assert result.exit_code == 0
+        table = pq.read_table(output)
+        assert table.num_rows == 10
+        assert table.column('payload')[0].as_py() == b'hello world'
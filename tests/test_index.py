@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the index of messages by IMEI and session time."""
+
+from datetime import datetime, timedelta
+import os
+from tempfile import TemporaryDirectory
+
+from click.testing import CliRunner
+
+from iridiumSBD import cli
+from iridiumSBD.iridiumSBD import IridiumSBD, EPOCH
+from iridiumSBD.index import MessageIndex, IndexedStorage, index_row, rebuild
+from iridiumSBD.directip.server import InboxStorage
+from iridiumSBD.directip.writer import QueuedMessage
+from iridiumSBD.store import SegmentStorage
+
+from .test_iridiumSBD import minimal_full_msg, minimal_MT_msg
+
+
+t0 = datetime(2017, 7, 3, 12, 0, 0)
+
+
+def make_msg(imei, session_datetime, momsn):
+    msg = IridiumSBD(minimal_full_msg)
+    header = msg.attributes['header']
+    header['IMEI'] = imei
+    header['session_epoch'] = int((session_datetime - EPOCH).total_seconds())
+    header['MOMSN'] = momsn
+    return msg.encode()
+
+
+def make_batch():
+    """A day of hourly messages from two IMEIs, and a corrupted one"""
+    batch = []
+    for i in range(24):
+        for imei in ('300234010753370', '300234010753371'):
+            batch.append(QueuedMessage(
+                ('10.0.0.1', 0),
+                make_msg(imei, t0 + timedelta(hours=i), i),
+                t0 + timedelta(hours=i, microseconds=int(imei[-1])),
+                False))
+    batch.append(QueuedMessage(('10.0.0.1', 0), b'\x01\x00', t0, True))
+    return batch
+
+
+def test_index_row():
+    location, imei, session_time, momsn, received = index_row(
+        'a.isbd', make_msg('300234010753370', t0, 7), t0)
+    assert (location, imei, momsn) == ('a.isbd', '300234010753370', 7)
+    assert session_time == received
+    assert index_row('b.isbd', minimal_MT_msg)[1:] == (None,) * 4
+
+
+def test_indexed_storage_and_query():
+    with TemporaryDirectory() as datadir:
+        index = MessageIndex(os.path.join(datadir, 'index.sqlite'))
+        storage = IndexedStorage(SegmentStorage(datadir), index)
+        locations = storage.save_batch(make_batch())
+        assert len(index) == 48
+
+        found = index.query(imei='300234010753370',
+                            since=t0 + timedelta(hours=6),
+                            until=t0 + timedelta(hours=12))
+        assert [f[3] for f in found] == list(range(6, 12))
+        assert found[0] == (locations[12], t0 + timedelta(hours=6),
+                            '300234010753370', 6)
+        assert len(index.query(since=t0 + timedelta(hours=23))) == 2
+        assert len(index.query(limit=5)) == 5
+        storage.close()
+
+
+def test_rebuild_and_cli():
+    with TemporaryDirectory() as datadir:
+        InboxStorage(datadir).save_batch(make_batch()[:10])
+        SegmentStorage(datadir).save_batch(make_batch()[10:])
+        index = MessageIndex(os.path.join(datadir, 'index.sqlite'))
+        index.add([('stale.isbd', None, None, None, None)])
+        assert rebuild(datadir, index, workers=2, chunksize=3) == 48
+        assert len(index.query(imei='300234010753371')) == 24
+        index.close()
+
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ['reindex', '--datadir', datadir])
+        assert result.output.splitlines()[-1] == 'Indexed 48 messages'
+        result = runner.invoke(cli.main, [
+            'query', '--datadir', datadir, '--imei', '300234010753370',
+            '--since', '2017-07-03 20:00:00', '--until', '2017-07-04'])
+        lines = [line for line in result.output.splitlines()
+                 if '\t' in line]
+        assert len(lines) == 4
+        assert lines[0].endswith(
+            '\t2017-07-03 20:00:00\t300234010753370\t8')
+
+
+def test_query_uses_index():
+    with TemporaryDirectory() as tmpdir:
+        index = MessageIndex(os.path.join(tmpdir, 'index.sqlite'))
+        plan = index.db.execute(
+            'EXPLAIN QUERY PLAN SELECT location, session_time, imei, momsn'
+            ' FROM messages WHERE imei = ? AND session_time >= ?'
+            ' AND session_time < ? ORDER BY session_time, location',
+            ('300234010753370', 0, 1)).fetchall()
+        index.close()
+    assert any('USING INDEX messages_imei' in row[-1] for row in plan)
@@ -6,6 +6,7 @@
 import pytest
 from multiprocessing import Process
 import socket
+import struct
 from time import sleep
 
 from click.testing import CliRunner
@@ -15,6 +16,21 @@ from iridiumSBD import cli
 from iridiumSBD.directip import server
 
 
+# MO message with header, location and a payload of 'hello world'
+minimal_full_msg = (
+    b'\x01\x00;'
+    b'\x01\x00\x1c\x00\x01\xe2@1234567890abcde\x0c\x00*\x00\x00Yh/\x00'
+    b'\x03\x00\x0b\x03 \xccju:\x8e\x00\x00\x00\x05'
+    b'\x02\x00\x0bhello world')
+
+# MT message with header, payload of 'hello' and priority
+minimal_MT_msg = (
+    b'\x01\x00%'
+    b'A\x00\x15\x00\x00\x04\xd2300234010753370\x00\x01'
+    b'B\x00\x05hello'
+    b'F\x00\x02\x00\x03')
+
+
 def test_parse_minimal_MO():
     msg = isbd.IridiumSBD(minimal_full_msg)
     
@@ -26,6 +42,14 @@ def test_parse_nopayload_MO():
     msg = isbd.IridiumSBD(minimal_full_msg[:48])
 
 
+def test_parse_many_IEs():
+    location = minimal_full_msg[34:48]
+    body = minimal_full_msg[3:34] + location * 1000
+    msg = isbd.IridiumSBD(struct.pack('>cH', b'\x01', len(body)) + body)
+    assert msg.attributes['msg_length'] == len(body)
+    assert msg.attributes['location']['CEP_radius'] == 5
+
+
 def test_parse_MO_acknowledgment():
     # Acknowledge success
     ack = b'\x01\x00\x04\x05\x00\x01\x01'
@@ -45,3 +69,154 @@ def test_parse_MT_acknowledgment():
     msg = isbd.IridiumSBD(ack)
     assert msg.attributes['confirmation']['IEI'] == b'\x44'
     assert msg.attributes['confirmation']['status'] == 1
+
+
+def test_parse_MT():
+    msg = isbd.IridiumSBD(minimal_MT_msg)
+    assert msg.mtype == 'MT'
+    assert msg.attributes['header']['IMEI'] == '300234010753370'
+    assert msg.attributes['header']['unique_client_msg_id'] == 1234
+    assert msg.attributes['header']['disposition_flags'] == 1
+    assert msg.attributes['priority']['level'] == 3
+    assert msg.payload['data'] == b'hello'
+
+
+def test_stream_parser():
+    ies = []
+    parser = isbd.StreamParser(on_ie=ies.append)
+    stream = minimal_full_msg + minimal_MT_msg + minimal_full_msg
+    messages = []
+    for i in range(0, len(stream), 5):
+        messages.extend(parser.feed(stream[i:i + 5]))
+        if i == 45:
+            # Header and location IEs are out before the message ends
+            assert len(messages) == 0
+            assert [ie[0] for ie in ies] == [0x01, 0x03]
+    assert messages == [minimal_full_msg, minimal_MT_msg, minimal_full_msg]
+    assert [ie[0] for ie in ies] == [1, 3, 2, 0x41, 0x42, 0x46, 1, 3, 2]
+    assert len(parser) == 0
+    assert not parser.corrupted
+
+
+def test_stream_parser_corrupted():
+    parser = isbd.StreamParser()
+    assert parser.feed(minimal_full_msg + b'\x02\x00\x01x') == \
+        [minimal_full_msg]
+    assert parser.corrupted
+    assert parser.pending() == b'\x02\x00\x01x'
+    # Whatever comes next is not buffered
+    assert parser.feed(b'garbage' * 1000) == []
+    assert parser.pending() == b'\x02\x00\x01x'
+
+
+@pytest.mark.parametrize('msg', [
+    minimal_full_msg,
+    b'\x01\x00-' + minimal_full_msg[3:48],
+    minimal_MT_msg,
+    b'\x01\x00\x04\x05\x00\x01\x01',
+    b'\x01\x00\x1cD\x00\x19\x00\x00\x00\x00'
+    b'1234567890abcde\xa5\xb5n\x1a\x00\x01',
+    ])
+def test_encode_round_trip(msg):
+    assert isbd.IridiumSBD(msg).encode() == msg
+
+
+def test_encode_new_MO():
+    from datetime import datetime
+
+    msg = isbd.IridiumSBD()
+    msg.mtype = 'MO'
+    msg.attributes['header'] = {
+        'CDR_reference': 123, 'IMEI': '300234010753370', 'session_status': 0,
+        'MOMSN': 7, 'MTMSN': 0, 'session_datetime': datetime(2017, 7, 3)}
+    msg.attributes['location'] = {'latitude': -32.5, 'longitude': -117.25,
+                                  'CEP_radius': 4}
+    msg.payload = {'data': b'\x00' * 340}
+
+    data = msg.encode()
+    assert isbd.valid_isbd(data)
+    decoded = isbd.IridiumSBD(data)
+    assert decoded.attributes['header']['session_datetime'] == \
+        datetime(2017, 7, 3)
+    assert decoded.attributes['header']['MOMSN'] == 7
+    assert decoded.attributes['location']['orient'] == 3
+    assert decoded.attributes['location']['latitude'] == pytest.approx(-32.5)
+    assert decoded.attributes['location']['longitude'] == \
+        pytest.approx(-117.25)
+    assert decoded.payload['length'] == 340
+
+
+def test_records_as_dict():
+    msg = isbd.IridiumSBD(minimal_full_msg)
+    header = msg.attributes['header']
+    assert isinstance(header, isbd.MOHeader)
+    assert header['IMEI'] == header.IMEI == '1234567890abcde'
+    assert header.get('missing') is None
+    assert 'session_datetime' in header
+    assert list(header) == ['IEI', 'length', 'CDR_reference', 'IMEI',
+                            'session_status', 'MOMSN', 'MTMSN',
+                            'session_epoch', 'session_datetime']
+    assert dict(header) == header
+    with pytest.raises(KeyError):
+        header['missing']
+    with pytest.raises(KeyError):
+        header['session_datetime'] = None
+
+    # Derived fields follow the stored ones
+    location = msg.attributes['location']
+    location['orient'] = 3
+    assert location['latitude'] < 0 and location['longitude'] < 0
+    assert not hasattr(location, '__dict__')
+
+    payload = isbd.IridiumSBD(minimal_MT_msg).payload
+    assert dict(payload) == {'IEI': b'B', 'length': 5, 'data': b'hello'}
+    # Compact, without a __dict__ for each record
+    assert not any(hasattr(r, '__dict__') for r in (header, payload))
+
+
+def test_lazy_decoding():
+    eager = isbd.IridiumSBD(minimal_full_msg)
+    lazy = isbd.IridiumSBD(minimal_full_msg, lazy=True)
+    assert lazy.mtype == 'MO'
+    assert lazy.attributes.pending.keys() == {'header', 'location'}
+    assert lazy.header == eager.attributes['header']
+    assert lazy.attributes.pending.keys() == {'location'}
+    assert dict(lazy.attributes) == eager.attributes
+    assert lazy.payload == eager.payload
+    assert 'confirmation' not in lazy.attributes
+    assert not hasattr(lazy, 'confirmation')
+
+    lazy = isbd.IridiumSBD(minimal_MT_msg, lazy=True)
+    assert lazy.mtype == 'MT'
+    assert lazy.priority['level'] == 3
+    assert lazy.encode() == minimal_MT_msg
+
+
+def test_peek_imei():
+    assert isbd.peek_imei(minimal_full_msg) == '1234567890abcde'
+    assert isbd.peek_imei(memoryview(minimal_MT_msg)) == '300234010753370'
+    # No header
+    assert isbd.peek_imei(b'\x01\x00\x04\x05\x00\x01\x01') is None
+    # Truncated header
+    assert isbd.peek_imei(minimal_full_msg[:20]) is None
+    # Not ASCII
+    bad = minimal_full_msg[:10] + b'\xff' * 15 + minimal_full_msg[25:]
+    assert isbd.peek_imei(bad) == '\ufffd' * 15
+    assert isbd.peek_imei_bytes(bad) == b'\xff' * 15
+
+
+def test_dump_imei(tmpdir):
+    filename = tmpdir.join('msg.isbd')
+    filename.write_binary(minimal_full_msg)
+    result = CliRunner().invoke(cli.main, ['dump', '--imei', str(filename)])
+    assert result.output == '1234567890abcde\n'
+
+
+def test_durable_ack_postgres(tmpdir):
+    """The journal can't wait for the rows buffered by Postgres"""
+    result = CliRunner().invoke(cli.main, [
+        'listen', '--host', '127.0.0.1', '--datadir', str(tmpdir),
+        '--storage', 'postgres', '--postgres-dsn', 'dbname=isbd',
+        '--durable-ack'])
+    assert isinstance(result.exception, AssertionError)
+    assert tmpdir.listdir() == []
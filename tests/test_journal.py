@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the durable acknowledgments with a group-committed journal."""
+
+from datetime import datetime
+from glob import glob
+import os
+from tempfile import TemporaryDirectory
+import threading
+
+import pytest
+
+from iridiumSBD.directip import metrics
+from iridiumSBD.directip.bench import make_messages, run, local_server
+from iridiumSBD.directip.journal import GroupCommitLog
+
+from .conftest import wait_until
+
+
+t0 = datetime(2017, 7, 3, 12, 0, 0)
+
+
+def segments(path):
+    return glob(os.path.join(path, '*.seg'))
+
+
+def test_group_commit():
+    messages = make_messages(4)
+    syncs = metrics.journal_syncs.value
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'journal')
+        # A long interval, so only a full group is synced before it
+        journal = GroupCommitLog(path, interval=10, max_batch=4)
+        tickets = []
+        threads = [threading.Thread(
+            target=lambda data: tickets.append(
+                journal.commit(('10.0.0.1', 0), data, t0)),
+            args=(data,)) for data in messages]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        assert len(tickets) == 4
+        assert metrics.journal_syncs.value == syncs + 1
+
+        for ticket in tickets:
+            journal.release(ticket)
+        journal.close()
+        assert segments(path) == []
+
+
+def test_failure_of_one_message(monkeypatch):
+    messages = make_messages(4)
+    with TemporaryDirectory() as datadir:
+        journal = GroupCommitLog(os.path.join(datadir, 'journal'),
+                                 interval=10, max_batch=4)
+        save_batch = journal.store.save_batch
+
+        def failing_save_batch(batch):
+            if any(m.data == messages[1] for m in batch):
+                raise OSError('No space left on device')
+            return save_batch(batch)
+        monkeypatch.setattr(journal.store, 'save_batch', failing_save_batch)
+
+        futures = [journal.submit(('10.0.0.1', 0), data, t0)
+                   for data in messages]
+        with pytest.raises(OSError):
+            futures[1].result(5)
+        tickets = [futures[i].result(5) for i in (0, 2, 3)]
+        for ticket in tickets:
+            journal.release(ticket)
+        journal.close()
+
+
+def test_replay():
+    messages = make_messages(3)
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'journal')
+        journal = GroupCommitLog(path, interval=0)
+        tickets = [journal.commit(('10.0.0.1', 0), data, t0)
+                   for data in messages]
+        journal.release(tickets[0])
+        # As if the server crashed before saving the last two messages
+        journal.close()
+        assert len(segments(path)) == 1
+
+        # The whole segment is replayed, even what was already saved
+        journal = GroupCommitLog(path, interval=0)
+        replayed = journal.replay()
+        assert [r[:3] for r in replayed] == \
+            [(('10.0.0.1', 0), data, t0) for data in messages]
+        assert journal.replay() == []
+        for client_address, data, t, ticket in replayed:
+            journal.release(ticket)
+        journal.close()
+        assert segments(path) == []
+
+
+def test_released_segments_are_removed():
+    messages = make_messages(20)
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'journal')
+        journal = GroupCommitLog(path, interval=0, segment_size=500)
+        tickets = [journal.commit(('10.0.0.1', 0), data, t0)
+                   for data in messages]
+        assert len(set(tickets)) > 2
+        for ticket in tickets[:-1]:
+            journal.release(ticket)
+        # Only the segment being appended to is left
+        wait_until(lambda: segments(path) == [tickets[-1]])
+        journal.release(tickets[-1])
+        journal.close()
+        assert segments(path) == []
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_durable_server(backend):
+    messages = make_messages(20)
+    with TemporaryDirectory() as datadir:
+        path = os.path.join(datadir, 'journal')
+        # Left by a previous run, acknowledged but not saved
+        journal = GroupCommitLog(path)
+        journal.commit(('10.0.0.1', 0), messages[0], t0)
+        journal.close()
+
+        journal = GroupCommitLog(path, interval=0.005)
+        with local_server(datadir, backend, journal=journal) as address:
+            result = run(address, messages[1:], connections=4)
+        assert result['errors'] == 0
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 20
+        assert segments(path) == []
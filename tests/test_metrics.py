@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the DirectIP server metrics."""
+
+import os
+from tempfile import TemporaryDirectory
+from urllib.request import urlopen
+
+from iridiumSBD.directip import metrics
+from iridiumSBD.directip.metrics import Registry, serve_metrics, \
+        TextfileExporter
+
+from .test_aioserver import _run
+from .test_iridiumSBD import minimal_full_msg
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.counter('test_total', 'A counter.')
+    histogram = registry.histogram('test_seconds', 'A histogram.',
+                                   buckets=(0.1, 1))
+    counter.inc()
+    counter.inc(2)
+    for v in (0.05, 0.5, 5):
+        histogram.observe(v)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE test_total counter' in lines
+    assert 'test_total 3' in lines
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_sum 5.55' in lines
+    assert 'test_seconds_count 3' in lines
+
+
+def test_server_metrics():
+    received = metrics.received.value
+    acked = metrics.acked.value
+    persisted = metrics.persisted.value
+    latencies = metrics.accept_to_ack.count
+    with TemporaryDirectory() as datadir:
+        _run(datadir, [[minimal_full_msg, minimal_full_msg]])
+    assert metrics.received.value == received + 2
+    assert metrics.acked.value == acked + 2
+    assert metrics.persisted.value == persisted + 2
+    assert metrics.accept_to_ack.count == latencies + 2
+
+
+def test_http_endpoint():
+    server = serve_metrics(('127.0.0.1', 0))
+    try:
+        response = urlopen('http://127.0.0.1:%s/metrics' %
+                           server.server_address[1])
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        assert b'isbd_accept_to_ack_seconds_count' in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_textfile():
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'isbd.prom')
+        exporter = TextfileExporter(filename, interval=60)
+        exporter.close()
+        with open(filename) as f:
+            assert 'isbd_messages_received_total' in f.read()
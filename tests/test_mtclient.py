@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the MT client, against a local stand-in for the gateway."""
+
+import socket
+import socketserver
+import threading
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from iridiumSBD.iridiumSBD import IridiumSBD, StreamParser, encode_MT, \
+        encode_MT_confirmation
+from iridiumSBD.directip import metrics
+from iridiumSBD.directip.bench import local_server
+from iridiumSBD.directip.mtclient import MTClient, MTError
+
+from .test_iridiumSBD import minimal_MT_msg
+
+
+class GatewayHandler(socketserver.BaseRequestHandler):
+    """Confirm each MT message with its position in a fake MT queue
+
+    IMEIs starting with 000 are refused as unknown, and the next status for
+    an IMEI can be forced with FakeGateway.statuses. FakeGateway.duplicates
+    confirmations are sent twice, and while FakeGateway.silent nothing is
+    confirmed until FakeGateway.release is set.
+    """
+    def handle(self):
+        self.server.connections += 1
+        parser = StreamParser()
+        while True:
+            chunk = self.request.recv(2048)
+            if not chunk:
+                return
+            for data in parser.feed(chunk):
+                if self.server.silent:
+                    self.server.release.wait(10)
+                    return
+                header = IridiumSBD(data).attributes['header']
+                self.server.received.append(data)
+                statuses = self.server.statuses.get(header['IMEI'])
+                if statuses:
+                    status = statuses.pop(0)
+                elif header['IMEI'].startswith('000'):
+                    status = -2
+                else:
+                    status = len(self.server.received)
+                confirmation = encode_MT_confirmation(
+                    header['unique_client_msg_id'], header['IMEI'],
+                    len(self.server.received), status)
+                if self.server.duplicates > 0:
+                    self.server.duplicates -= 1
+                    confirmation *= 2
+                self.request.sendall(confirmation)
+                if self.server.close_after_each:
+                    return
+
+
+class FakeGateway(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, close_after_each=False):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), GatewayHandler)
+        self.close_after_each = close_after_each
+        self.connections = 0
+        self.received = []
+        self.statuses = {}
+        self.duplicates = 0
+        self.silent = False
+        self.release = threading.Event()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def test_encode_MT():
+    assert encode_MT('300234010753370', b'hello', 1234, 1, 3) == \
+        minimal_MT_msg
+    isbd = IridiumSBD(encode_MT('300234010753370', b'', 7, 1))
+    assert isbd.mtype == 'MT'
+    assert isbd.attributes['header']['disposition_flags'] == 1
+    assert not hasattr(isbd, 'payload')
+
+
+def test_persistent_connection():
+    gateway = FakeGateway()
+    client = MTClient(gateway.server_address)
+    try:
+        futures = [client.submit(encode_MT('300234010753370', b'%d' % i, i))
+                   for i in range(50)]
+        for i, f in enumerate(futures):
+            confirmation = IridiumSBD(f.result(5)).attributes['confirmation']
+            assert confirmation['unique_client_msg_id'] == i
+        assert client.send('300234010753370', b'last', 99)['status'] == 51
+    finally:
+        client.close()
+        gateway.close()
+    assert gateway.connections == 1
+
+
+def test_gateway_closing_connections():
+    gateway = FakeGateway(close_after_each=True)
+    client = MTClient(gateway.server_address, max_in_flight=1)
+    try:
+        for i in range(5):
+            assert client.send('300234010753370', b'x', i)['status'] == i + 1
+    finally:
+        client.close()
+        gateway.close()
+    assert gateway.connections == 5
+    assert len(gateway.received) == 5
+
+
+def test_refused():
+    gateway = FakeGateway()
+    client = MTClient(gateway.server_address)
+    try:
+        with pytest.raises(MTError) as excinfo:
+            client.send('000000000000000', b'x', 1)
+        assert excinfo.value.status == -2
+    finally:
+        client.close()
+        gateway.close()
+
+
+def test_unavailable_gateway():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    client = MTClient(address, retries=1, reconnect_delay=0)
+    try:
+        with pytest.raises(OSError):
+            client.send('300234010753370', b'x', 1, timeout=5)
+    finally:
+        client.close()
+
+
+def test_unexpected_confirmation():
+    """An extra confirmation is a protocol error, not a crash"""
+    gateway = FakeGateway()
+    gateway.duplicates = 1
+    client = MTClient(gateway.server_address, reconnect_delay=0)
+    try:
+        assert client.send('300234010753370', b'x', 1, timeout=5)
+        assert client.send('300234010753370', b'y', 2, timeout=5)
+    finally:
+        client.close()
+        gateway.close()
+    # Sent again on a new connection
+    assert gateway.connections == 2
+    assert len(gateway.received) == 3
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_relay_from_server(backend):
+    gateway = FakeGateway()
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend,
+                          outbound_address=gateway.server_address,
+                          relay_from=['127.0.0.1']) as address:
+            sock = socket.create_connection(address)
+            sock.sendall(minimal_MT_msg)
+            confirmation = IridiumSBD(sock.recv(1024))
+            sock.close()
+        gateway.close()
+    assert gateway.received == [minimal_MT_msg]
+    assert confirmation.attributes['confirmation']['unique_client_msg_id'] \
+        == 1234
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_relay_not_allowed(backend):
+    gateway = FakeGateway()
+    refused = metrics.relay_refused.value
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend,
+                          outbound_address=gateway.server_address) as address:
+            sock = socket.create_connection(address, 5)
+            sock.sendall(minimal_MT_msg)
+            # Closed without forwarding it
+            assert sock.recv(1024) == b''
+            sock.close()
+        gateway.close()
+    assert gateway.received == []
+    assert metrics.relay_refused.value == refused + 1
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_relay_timeout(backend):
+    gateway = FakeGateway()
+    gateway.silent = True
+    with TemporaryDirectory() as datadir:
+        with local_server(datadir, backend,
+                          outbound_address=gateway.server_address,
+                          relay_from=['127.0.0.1'],
+                          relay_timeout=0.2) as address:
+            sock = socket.create_connection(address, 5)
+            sock.sendall(minimal_MT_msg)
+            # Closed once the relay timed out
+            assert sock.recv(1024) == b''
+            sock.close()
+            # The late confirmation doesn't break the client
+            gateway.silent = False
+            gateway.release.set()
+        gateway.close()
+    assert gateway.received == [minimal_MT_msg]
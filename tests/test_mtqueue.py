@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the durable MT queue."""
+
+import asyncio
+import os
+import socket
+from tempfile import TemporaryDirectory
+import threading
+import time
+
+from click.testing import CliRunner
+import pytest
+
+from iridiumSBD import cli
+from iridiumSBD.iridiumSBD import IridiumSBD
+from iridiumSBD.directip.aioserver import AsyncDirectIPServer
+from iridiumSBD.directip.mtclient import MTClient
+from iridiumSBD.directip.mtqueue import MTQueue, TokenBucket
+from iridiumSBD.directip.server import ThreadedDirectIPServer
+
+from .test_mtclient import FakeGateway
+
+
+IMEI_A = '300234010000001'
+IMEI_B = '300234010000002'
+
+
+def _drain(queue, ids, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(queue.get(i)[0] != 'pending' for i in ids):
+            return [queue.get(i) for i in ids]
+        time.sleep(0.01)
+    raise AssertionError('MT queue not drained')
+
+
+def _sent(gateway):
+    output = []
+    for data in gateway.received:
+        isbd = IridiumSBD(data)
+        output.append((isbd.attributes['header']['IMEI'],
+                       bytes(isbd.payload['data'])))
+    return output
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 0.1
+
+
+def test_survives_restart_and_fifo():
+    gateway = FakeGateway()
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'mt.sqlite')
+        queue = MTQueue(path)
+        ids = [queue.put(imei, b'%d' % i)
+               for i in range(5) for imei in (IMEI_A, IMEI_B)]
+        queue.close()
+
+        queue = MTQueue(path, max_concurrent=2, rate=100, poll_interval=0.1)
+        assert len(queue) == 10
+        client = MTClient(gateway.server_address)
+        queue.start(client)
+        try:
+            states = _drain(queue, ids)
+        finally:
+            queue.close()
+            client.close()
+            gateway.close()
+    assert all(s[0] == 'sent' for s in states)
+    sent = _sent(gateway)
+    for imei in (IMEI_A, IMEI_B):
+        assert [p for i, p in sent if i == imei] == \
+            [b'%d' % i for i in range(5)]
+
+
+def test_rate_limit():
+    gateway = FakeGateway()
+    with TemporaryDirectory() as tmpdir:
+        queue = MTQueue(os.path.join(tmpdir, 'mt.sqlite'),
+                        rate=20, burst=1, max_concurrent=10)
+        ids = [queue.put('3002340100000%02d' % i, b'x') for i in range(10)]
+        client = MTClient(gateway.server_address)
+        t0 = time.monotonic()
+        queue.start(client)
+        try:
+            _drain(queue, ids)
+        finally:
+            queue.close()
+            client.close()
+            gateway.close()
+    assert time.monotonic() - t0 >= 0.4
+
+
+def test_retry_and_failure():
+    gateway = FakeGateway()
+    # MT queue full on the gateway, then accepted
+    gateway.statuses[IMEI_A] = [-5, -5]
+    with TemporaryDirectory() as tmpdir:
+        queue = MTQueue(os.path.join(tmpdir, 'mt.sqlite'),
+                        backoff=0.01, poll_interval=0.01)
+        ids = [queue.put(IMEI_A, b'retry'),
+               queue.put('000000000000000', b'unknown')]
+        client = MTClient(gateway.server_address)
+        queue.start(client)
+        try:
+            states = _drain(queue, ids)
+        finally:
+            queue.close()
+            client.close()
+            gateway.close()
+    assert states[0][:2] == ('sent', 3)
+    assert states[1] == ('failed', 1, -2)
+
+
+def test_mt_send_command():
+    with TemporaryDirectory() as datadir:
+        result = CliRunner().invoke(
+            cli.main, ['mt-send', '--datadir', datadir, '--hex',
+                       IMEI_A, IMEI_B, '68656c6c6f'])
+        assert result.exit_code == 0, result.output
+        queue = MTQueue(os.path.join(datadir, 'mt_queue.sqlite'))
+        assert len(queue) == 2
+        queue.close()
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_not_started_if_bind_fails(backend):
+    gateway = FakeGateway()
+    busy = socket.socket()
+    busy.bind(('127.0.0.1', 0))
+    busy.listen()
+    with TemporaryDirectory() as datadir:
+        queue = MTQueue(os.path.join(datadir, 'mt.sqlite'))
+        # Closed together with the server
+        options = dict(outbound_address=gateway.server_address,
+                       mt_queue=queue)
+        with pytest.raises(OSError):
+            if backend == 'threaded':
+                ThreadedDirectIPServer(busy.getsockname(), datadir,
+                                       **options)
+            else:
+                server = AsyncDirectIPServer(busy.getsockname(), datadir,
+                                             **options)
+                try:
+                    asyncio.run(server.start())
+                finally:
+                    server.shutdown()
+    busy.close()
+    gateway.close()
+    assert queue.thread is None
+    assert not any(t.name == 'DirectIP-mtclient'
+                   for t in threading.enumerate())
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the PostgreSQL storage.
+
+The tests that need a database only run if the environment variable
+ISBD_TEST_POSTGRES_DSN is defined, like
+ISBD_TEST_POSTGRES_DSN="dbname=isbd_test host=localhost".
+"""
+
+import csv
+from datetime import datetime
+import io
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+from iridiumSBD.directip.postgres import PostgresStorage, as_row, COLUMNS
+from iridiumSBD.directip.writer import QueuedMessage
+
+from .test_iridiumSBD import minimal_full_msg
+
+
+DSN = os.environ.get('ISBD_TEST_POSTGRES_DSN')
+
+t0 = datetime(2017, 7, 3, 12, 0, 0)
+
+
+def test_as_row():
+    row = dict(zip(COLUMNS, as_row(
+        QueuedMessage(('10.0.0.1', 0), minimal_full_msg, t0, False))))
+    assert row['imei'] == '1234567890abcde'
+    assert row['momsn'] == 42
+    assert row['corrupted'] == 'f'
+    assert row['payload'] == '\\x' + b'hello world'.hex()
+    assert row['raw'] == '\\x' + minimal_full_msg.hex()
+
+    row = dict(zip(COLUMNS, as_row(
+        QueuedMessage(('10.0.0.1', 0), b'\x01\x00', t0, True))))
+    assert row['corrupted'] == 't'
+    assert row['imei'] is None
+    assert row['raw'] == '\\x0100'
+
+
+def test_spill_when_unavailable():
+    """Without the database, rows are kept in the spill file"""
+    with TemporaryDirectory() as tmpdir:
+        spill = os.path.join(tmpdir, 'spill.csv')
+        storage = PostgresStorage(
+            'host=127.0.0.1 port=1 dbname=isbd connect_timeout=1',
+            spill=spill, flush_interval=60)
+        batch = [QueuedMessage(('10.0.0.1', 0), minimal_full_msg, t0, False)
+                 for i in range(3)]
+        assert storage.save_batch(batch) == [None] * 3
+        storage.flush()
+        with open(spill) as f:
+            assert len(f.readlines()) == 3
+        storage.save_batch(batch)
+        storage.close()
+        with open(spill) as f:
+            assert len(f.readlines()) == 6
+
+
+class RejectingStorage(PostgresStorage):
+    """Without a database, rejecting the rows from 10.0.0.666"""
+    def __init__(self, *args, **kwargs):
+        self.copied = []
+        self.down = False
+        PostgresStorage.__init__(self, *args, **kwargs)
+
+    def copy(self, buf):
+        if self.down:
+            raise psycopg2.OperationalError('Connection refused')
+        rows = list(csv.reader(io.StringIO(buf.getvalue())))
+        if any(row[1] == '10.0.0.666' for row in rows):
+            raise psycopg2.DataError('Invalid row')
+        self.copied.extend(row[1] for row in rows)
+
+
+def test_quarantine_rejected_rows():
+    addresses = ['10.0.0.1', '10.0.0.666', '10.0.0.2']
+    batch = [QueuedMessage((address, 0), minimal_full_msg, t0, False)
+             for address in addresses]
+    with TemporaryDirectory() as tmpdir:
+        spill = os.path.join(tmpdir, 'spill.csv')
+        quarantine = os.path.join(tmpdir, 'rejected.csv')
+        storage = RejectingStorage(
+            'host=127.0.0.1 port=1 dbname=isbd connect_timeout=1',
+            spill=spill, quarantine=quarantine, flush_interval=60)
+        storage.down = True
+        storage.save_batch(batch)
+        storage.flush()
+        assert storage.copied == []
+        with open(spill) as f:
+            assert len(f.readlines()) == 3
+
+        # The bad row doesn't block the others, nor the following ones
+        storage.down = False
+        storage.save_batch(batch[:1])
+        storage.flush()
+        assert storage.copied == ['10.0.0.1', '10.0.0.2', '10.0.0.1']
+        assert not os.path.exists(spill)
+        with open(quarantine) as f:
+            assert [row[1] for row in csv.reader(f)] == ['10.0.0.666']
+        storage.save_batch(batch[2:])
+        storage.close()
+        assert storage.copied[-1] == '10.0.0.2'
+
+
+@pytest.mark.skipif(DSN is None, reason='ISBD_TEST_POSTGRES_DSN not defined')
+def test_copy_and_replay_spill():
+    table = 'isbd_test_messages'
+    with TemporaryDirectory() as tmpdir:
+        spill = os.path.join(tmpdir, 'spill.csv')
+        with open(spill, 'w', newline='') as f:
+            csv.writer(f).writerow(as_row(
+                QueuedMessage(('10.0.0.2', 0), minimal_full_msg, t0, False)))
+
+        conn = psycopg2.connect(DSN)
+        with conn.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+        conn.commit()
+
+        storage = PostgresStorage(DSN, table=table, spill=spill,
+                                  batch_size=10)
+        storage.save_batch(
+            [QueuedMessage(('10.0.0.1', 0), minimal_full_msg, t0, False)
+             for i in range(20)])
+        storage.close()
+        assert not os.path.exists(spill)
+
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT count(*), min(imei), min(momsn) FROM {}'.format(table))
+            assert cur.fetchone() == (21, '1234567890abcde', 42)
+            cur.execute('DROP TABLE {}'.format(table))
+        conn.commit()
+        conn.close()
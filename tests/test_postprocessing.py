@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the post-processing pool."""
+
+import os
+import stat
+from tempfile import TemporaryDirectory
+import threading
+import time
+
+from iridiumSBD.directip.postprocessing import (
+    load_callable, make_postprocessing, make_task, PostProcessingPool,
+    ExternalCommand)
+
+from .test_iridiumSBD import minimal_full_msg
+
+
+received = []
+
+
+def collect(isbd):
+    received.append(isbd.attributes['header']['IMEI'])
+
+
+def test_load_callable():
+    assert load_callable('os.path:join') is os.path.join
+    assert load_callable('tests.test_postprocessing:collect') is collect
+
+
+def test_callable():
+    del received[:]
+    pool = make_postprocessing('tests.test_postprocessing:collect')
+    for i in range(10):
+        pool.submit(minimal_full_msg)
+    pool.close()
+    assert received == ['1234567890abcde'] * 10
+
+
+def test_retry():
+    attempts = []
+
+    def flaky(data, filename):
+        attempts.append(time.time())
+        if len(attempts) < 3:
+            raise ValueError('Not yet')
+        return 'ok'
+
+    pool = PostProcessingPool(flaky, retries=2, backoff=0.01)
+    assert pool.submit(minimal_full_msg).result() == 'ok'
+    pool.close()
+    assert len(attempts) == 3
+
+
+def test_timeout():
+    release = threading.Event()
+
+    def stuck(data, filename):
+        release.wait()
+
+    pool = PostProcessingPool(stuck, timeout=0.01, retries=1, backoff=0.01)
+    assert pool.submit(minimal_full_msg).result() is None
+    release.set()
+    pool.close()
+
+
+def test_external_command():
+    with TemporaryDirectory() as tmpdir:
+        script = os.path.join(tmpdir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\ncp "$1" "$1.done"\n')
+        os.chmod(script, stat.S_IRWXU)
+        filename = os.path.join(tmpdir, 'msg.isbd')
+        with open(filename, 'wb') as f:
+            f.write(minimal_full_msg)
+
+        pool = make_postprocessing(script)
+        assert isinstance(pool.task, ExternalCommand)
+        assert pool.submit(minimal_full_msg, filename).result() == 0
+        pool.close()
+        assert os.path.exists(filename + '.done')
+
+
+def test_command_in_path(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        script = os.path.join(tmpdir, 'process_isbd')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(script, stat.S_IRWXU)
+        monkeypatch.setenv('PATH', tmpdir)
+        task = make_task('process_isbd')
+        assert isinstance(task, ExternalCommand)
+        assert task.command == script
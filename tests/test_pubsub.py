@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the fan-out of messages to subscribers."""
+
+from datetime import datetime
+import os
+import socket
+from tempfile import TemporaryDirectory
+import threading
+import time
+
+import pytest
+
+from iridiumSBD.directip import metrics
+from iridiumSBD.directip.bench import make_messages, run, local_server
+from iridiumSBD.directip.pubsub import Publisher, parse_address, subscribe
+
+from .conftest import wait_until
+
+
+t0 = datetime(2017, 7, 3, 12, 0, 0)
+
+
+def collect(address, n, imeis=None):
+    """Start a subscriber on a thread, which receives n messages"""
+    received = []
+
+    def run():
+        for event in subscribe(address, imeis, timeout=10):
+            received.append(event)
+            if len(received) == n:
+                return
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, received
+
+
+def test_parse_address():
+    assert parse_address('/run/isbd.sock') == '/run/isbd.sock'
+    assert parse_address('localhost:10900') == ('localhost', 10900)
+    assert parse_address(':10900') == ('127.0.0.1', 10900)
+    assert parse_address('10900') == ('127.0.0.1', 10900)
+
+
+def test_not_a_socket():
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'isbd.sock')
+        with open(path, 'w') as f:
+            f.write('Not a socket')
+        with pytest.raises(FileExistsError):
+            Publisher(path)
+        assert os.path.isfile(path)
+
+        # A socket left by a previous run is replaced
+        os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        publisher = Publisher(path)
+        publisher.close()
+        assert not os.path.exists(path)
+
+
+def test_filter_by_imei():
+    messages = make_messages(10, imeis=2)
+    with TemporaryDirectory() as tmpdir:
+        publisher = Publisher(os.path.join(tmpdir, 'isbd.sock'))
+        everything, received_all = collect(publisher.address, 10)
+        filtered, received = collect(
+            publisher.address, 5, ['300234010000001'])
+        wait_until(lambda: len(publisher) == 2)
+        for i, data in enumerate(messages):
+            publisher.publish(data, '{}.isbd'.format(i), ('10.0.0.1', 0), t0)
+        everything.join(5)
+        filtered.join(5)
+        publisher.close()
+        assert not os.path.exists(publisher.address)
+
+    assert [e['filename'] for e in received_all] == \
+        ['{}.isbd'.format(i) for i in range(10)]
+    assert [e['filename'] for e in received] == \
+        ['{}.isbd'.format(i) for i in range(1, 10, 2)]
+    assert {e['IMEI'] for e in received} == {'300234010000001'}
+    event = received[0]
+    assert bytes.fromhex(event['data']) == messages[1]
+    assert event['received'] == '2017-07-03T12:00:00'
+    assert event['client_address'] == '10.0.0.1'
+    assert event['latitude'] == pytest.approx(32.87, abs=1e-3)
+
+
+@pytest.mark.parametrize('policy', ['drop', 'disconnect'])
+def test_slow_subscriber(policy):
+    # Large enough to fill the socket buffers of a subscriber not reading
+    messages = make_messages(20, payload_size=1500)
+    dropped = metrics.published_dropped.value
+    slow = metrics.slow_subscribers.value
+    with TemporaryDirectory() as tmpdir:
+        publisher = Publisher(os.path.join(tmpdir, 'isbd.sock'),
+                              buffer_size=1000, policy=policy)
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(publisher.address)
+        stalled.sendall(b'\n')
+        fast, received = collect(publisher.address, 3000)
+        wait_until(lambda: len(publisher) == 2)
+
+        started = time.monotonic()
+        for i in range(150):
+            for data in messages:
+                publisher.publish(data)
+        # Publishing never waited for the stalled subscriber
+        assert time.monotonic() - started < 5
+        fast.join(10)
+        assert len(received) == 3000
+        if policy == 'drop':
+            assert metrics.published_dropped.value > dropped
+            assert len(publisher) == 2
+        else:
+            assert metrics.slow_subscribers.value == slow + 1
+            assert len(publisher) == 1
+        stalled.close()
+        publisher.close()
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_server_publishes(backend):
+    messages = make_messages(20)
+    with TemporaryDirectory() as datadir:
+        publisher = Publisher(('127.0.0.1', 0))
+        subscriber, received = collect(publisher.address, 20)
+        wait_until(lambda: len(publisher) == 1)
+        with local_server(datadir, backend, publisher=publisher) as address:
+            run(address, messages, connections=4)
+            subscriber.join(5)
+        saved = set(os.listdir(os.path.join(datadir, 'inbox')))
+    assert {bytes.fromhex(e['data']) for e in received} == set(messages)
+    assert {os.path.basename(e['filename']) for e in received} == saved
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the segmented message store."""
+
+from datetime import datetime, timedelta
+import os
+from tempfile import TemporaryDirectory
+
+from click.testing import CliRunner
+
+from iridiumSBD import cli
+from iridiumSBD.store import SegmentStore, StoredMessage, StoreReader
+from iridiumSBD.directip.server import save_isbd_msg
+
+from .test_iridiumSBD import minimal_full_msg
+
+
+t0 = datetime(2017, 7, 3, 12, 0, 0)
+
+
+def test_append_and_read():
+    with TemporaryDirectory() as tmpdir:
+        store = SegmentStore(tmpdir)
+        location = store.append(('10.0.0.1', 1234), minimal_full_msg, t0)
+        assert store.read(location) == (t0, '10.0.0.1', minimal_full_msg)
+        store.close()
+
+
+def test_rotation_and_find():
+    with TemporaryDirectory() as tmpdir:
+        store = SegmentStore(tmpdir, segment_size=1024, fsync='never')
+        for i in range(100):
+            store.append(('10.0.0.1', 0), minimal_full_msg,
+                         t0 + timedelta(minutes=i))
+        assert len(store.segments()) > 1
+
+        found = list(store.find(imei='1234567890abcde'))
+        assert len(found) == 100
+        assert found[0][1] == t0
+        assert list(store.find(imei='000000000000000')) == []
+        assert len(list(store.find(since=t0 + timedelta(minutes=90)))) == 10
+        store.close()
+
+
+def test_malformed_imei():
+    bad = minimal_full_msg[:10] + b'\xff' * 15 + minimal_full_msg[25:]
+    with TemporaryDirectory() as tmpdir:
+        store = SegmentStore(tmpdir)
+        locations = store.save_batch([
+            StoredMessage(('10.0.0.1', 0), data, t0)
+            for data in (minimal_full_msg, bad, minimal_full_msg)])
+        assert [store.read(location)[2] for location in locations] == \
+            [minimal_full_msg, bad, minimal_full_msg]
+        assert [imei for location, t, imei in store.find()] == \
+            ['1234567890abcde', '\ufffd' * 15, '1234567890abcde']
+        store.close()
+
+
+def test_recover_torn_record():
+    with TemporaryDirectory() as tmpdir:
+        store = SegmentStore(tmpdir)
+        store.append(('10.0.0.1', 0), minimal_full_msg, t0)
+        store.append(('10.0.0.1', 0), minimal_full_msg, t0)
+        store.close()
+        segment = store.segments()[-1]
+        with open(segment, 'ab') as f:
+            f.write(minimal_full_msg[:20])
+
+        store = SegmentStore(tmpdir)
+        assert len(list(store.find())) == 2
+        location = store.append(('10.0.0.2', 0), minimal_full_msg, t0)
+        assert store.read(location)[1] == '10.0.0.2'
+        assert len(list(store.find())) == 3
+        store.close()
+
+
+def test_migrate():
+    with TemporaryDirectory() as datadir:
+        for i in range(5):
+            save_isbd_msg(datadir, ('10.0.0.1', 0), minimal_full_msg,
+                          t0 + timedelta(seconds=i))
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ['migrate', '--datadir', datadir])
+        assert result.exit_code == 0
+
+        store = SegmentStore(os.path.join(datadir, 'segments', 'inbox'))
+        found = list(store.find())
+        assert [f[1] for f in found] == \
+            [t0 + timedelta(seconds=i) for i in range(5)]
+        assert store.read(found[0][0]) == (t0, '10.0.0.1', minimal_full_msg)
+        store.close()
+
+
+def test_reader():
+    with TemporaryDirectory() as tmpdir:
+        store = SegmentStore(tmpdir, segment_size=1024)
+        for i in range(50):
+            store.append(('10.0.0.%d' % i, 0), minimal_full_msg,
+                         t0 + timedelta(seconds=i))
+        store.close()
+
+        with StoreReader(tmpdir, verify=True) as reader:
+            assert len(reader) == 50
+            record = reader[37]
+            assert isinstance(record.data, memoryview)
+            assert record.data == minimal_full_msg
+            assert record.client_address == '10.0.0.37'
+            assert record.t0 == t0 + timedelta(seconds=37)
+            assert reader[-1].client_address == '10.0.0.49'
+            del record
+
+            n = 0
+            for isbd in reader.messages():
+                assert isbd.attributes['header']['IMEI'] == '1234567890abcde'
+                assert isbd.payload['data'] == b'hello world'
+                n += 1
+            assert n == 50
+            del isbd
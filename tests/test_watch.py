@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the incremental watch of the inbox."""
+
+from datetime import datetime, timedelta
+import os
+from tempfile import TemporaryDirectory
+import shutil
+import threading
+
+import pytest
+
+from iridiumSBD.iridiumSBD import IridiumSBD
+from iridiumSBD.directip.bench import make_messages
+from iridiumSBD.directip.postprocessing import ExternalCommand
+from iridiumSBD.directip.server import InboxStorage
+from iridiumSBD.directip.writer import QueuedMessage
+from iridiumSBD.watch import Checkpoint, InboxWatcher, Inotify, make_handler
+
+from .conftest import wait_until
+
+
+t0 = datetime(2017, 7, 3, 12, 0, 0)
+
+
+def save(datadir, messages, start=0):
+    """Save messages in the inbox like the server, a second apart"""
+    InboxStorage(datadir).save_batch([
+        QueuedMessage(('10.0.0.1', 0), data,
+                      t0 + timedelta(seconds=start + i), False)
+        for i, data in enumerate(messages)])
+
+
+def test_checkpoint():
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'watch.json')
+        checkpoint = Checkpoint(path, window=60)
+        names = ['{}_10.0.0.1.isbd'.format(
+            (t0 + timedelta(seconds=i)).strftime('%Y%m%d%H%M%S%f'))
+            for i in range(0, 200, 10)]
+        for name in names[::2]:
+            checkpoint.add(name)
+        checkpoint.save()
+
+        checkpoint = Checkpoint(path, window=60)
+        # Up to a minute before the newest one, everything counts as done
+        assert [n in checkpoint for n in names] == \
+            [True] * 13 + [False, True] * 3 + [False]
+        assert len(checkpoint.done) == 4
+
+
+def test_inotify():
+    with TemporaryDirectory() as tmpdir:
+        notifier = Inotify(tmpdir)
+        assert notifier.read(0) == []
+        with open(os.path.join(tmpdir, 'a.isbd'), 'wb') as f:
+            f.write(b'\x01')
+        os.rename(os.path.join(tmpdir, 'a.isbd'),
+                  os.path.join(tmpdir, 'b.isbd'))
+        assert notifier.read(1) == ['a.isbd', 'b.isbd']
+        notifier.close()
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watch(use_inotify):
+    messages = make_messages(60)
+    handled = []
+
+    def start(datadir):
+        watcher = InboxWatcher(
+            datadir, lambda isbd, filename: handled.append(filename),
+            workers=2, chunksize=5, poll_interval=0.05,
+            use_inotify=use_inotify)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        return watcher, thread
+
+    with TemporaryDirectory() as datadir:
+        save(datadir, messages[:20])
+        # A corrupted one is skipped
+        with open(os.path.join(datadir, 'inbox', 'bad.isbd'), 'wb') as f:
+            f.write(b'\x01\x00\x05hello')
+        watcher, thread = start(datadir)
+        wait_until(lambda: watcher.processed == 21)
+        save(datadir, messages[20:40], start=20)
+        wait_until(lambda: watcher.processed == 41)
+        watcher.stop()
+        thread.join()
+
+        # Arrived while stopped
+        save(datadir, messages[40:], start=40)
+        watcher, thread = start(datadir)
+        wait_until(lambda: watcher.processed == 20)
+        watcher.stop()
+        thread.join()
+
+        inbox = sorted(os.listdir(os.path.join(datadir, 'inbox')))
+    assert [os.path.basename(f) for f in handled] == \
+        [name for name in inbox if name != 'bad.isbd']
+
+
+def test_make_handler():
+    isbd = IridiumSBD(make_messages(1)[0])
+    assert make_handler('builtins:repr')(isbd, 'a.isbd') == repr(isbd)
+    assert isinstance(make_handler(__file__), ExternalCommand)
+    # Same as --post-processing, a command in the PATH
+    assert make_handler('sh').command == shutil.which('sh')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the server running on several worker processes."""
+
+import os
+import signal
+import socket
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from iridiumSBD.directip.bench import make_messages, run
+from iridiumSBD.directip.dedup import SharedDedupCache
+from iridiumSBD.directip.metrics import REGISTRY, AggregateRegistry
+from iridiumSBD.directip.workers import Supervisor
+
+from .conftest import wait_until
+
+
+def test_aggregate_registry():
+    registry = AggregateRegistry()
+    snapshot = REGISTRY.empty()
+    snapshot.merge(REGISTRY.snapshot())
+    snapshot.reset()
+    snapshot.metrics[0].inc(3)
+    snapshot.metrics[-1].observe(0.5)
+    registry.update(0, snapshot.snapshot())
+    registry.update(1, snapshot.snapshot())
+    registry.retire(1)
+    # The same worker again, after a restart
+    registry.update(1, snapshot.snapshot())
+    output = registry.render()
+    assert 'isbd_messages_received_total 9\n' in output
+    assert 'isbd_postprocessing_seconds_count 3\n' in output
+
+
+def accepting(address):
+    try:
+        socket.create_connection(address, 1).close()
+    except OSError:
+        return False
+    return True
+
+
+@pytest.mark.parametrize('backend', ['threaded', 'asyncio'])
+def test_workers(backend):
+    messages = make_messages(60)
+    with TemporaryDirectory() as datadir:
+        supervisor = Supervisor(
+            '127.0.0.1', 0, datadir, 3, backend=backend, stats_interval=0.1,
+            restart_delay=0, setup=lambda worker: {
+                'dedup': SharedDedupCache(
+                    os.path.join(datadir, 'dedup.sqlite'))})
+        thread = threading.Thread(target=supervisor.serve_forever)
+        thread.start()
+        try:
+            # Once a worker listens, the kernel gives it the connections
+            wait_until(lambda: accepting(supervisor.server_address))
+            result = run(supervisor.server_address, messages[:30],
+                         connections=6)
+            assert result['errors'] == 0
+
+            # A crashed worker is replaced, without losing its counts
+            pid = supervisor.processes[0].pid
+            time.sleep(0.3)
+            os.kill(pid, signal.SIGKILL)
+            wait_until(lambda: supervisor.restarts == 1)
+            result = run(supervisor.server_address, messages[30:],
+                         connections=6)
+            assert result['errors'] == 0
+
+            # Copies are skipped, whichever worker they reach
+            result = run(supervisor.server_address, messages,
+                         connections=6)
+            assert result['errors'] == 0
+        finally:
+            supervisor.shutdown()
+            thread.join()
+        assert len(os.listdir(os.path.join(datadir, 'inbox'))) == 60
+        assert 'isbd_messages_acked_total 120\n' in \
+            supervisor.registry.render()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the write-behind queue."""
+
+from datetime import datetime
+import threading
+
+from iridiumSBD.directip import metrics
+from iridiumSBD.directip.writer import WriteBehindQueue
+
+
+def test_flush_on_close():
+    saved = []
+    writer = WriteBehindQueue(saved.extend, maxsize=10, workers=2)
+    for i in range(100):
+        assert writer.put(('127.0.0.1', 0), b'%d' % i, datetime.utcnow())
+    writer.close()
+    assert sorted(int(m.data) for m in saved) == list(range(100))
+
+
+def test_batches():
+    batches = []
+    release = threading.Event()
+
+    def persist(batch):
+        release.wait()
+        batches.append(len(batch))
+
+    writer = WriteBehindQueue(persist, maxsize=100, batch_size=8)
+    for i in range(20):
+        writer.put(('127.0.0.1', 0), b'', datetime.utcnow())
+    release.set()
+    writer.close()
+    assert sum(batches) == 20
+    assert max(batches) <= 8
+
+
+def test_policies():
+    release = threading.Event()
+    saved = []
+
+    def persist(batch):
+        release.wait()
+        saved.extend(batch)
+
+    writer = WriteBehindQueue(persist, maxsize=1, policy='reject')
+    results = [writer.put(('127.0.0.1', 0), b'', datetime.utcnow())
+               for i in range(5)]
+    assert results[0] is True
+    assert False in results
+    release.set()
+    writer.close()
+    assert len(saved) == results.count(True)
+
+    saved = []
+    writer = WriteBehindQueue(saved.extend, maxsize=1, policy='inline')
+    for i in range(5):
+        assert writer.put(('127.0.0.1', 0), b'', datetime.utcnow())
+    writer.close()
+    assert len(saved) == 5
+
+
+def test_retries():
+    saved = []
+    failures = [RuntimeError('Disk full')] * 2
+
+    def persist(batch):
+        if failures:
+            raise failures.pop()
+        saved.extend(batch)
+
+    writer = WriteBehindQueue(persist, backoff=0.01)
+    writer.put(('127.0.0.1', 0), b'', datetime.utcnow())
+    writer.close()
+    assert len(saved) == 1
+
+    failed = metrics.persist_failed.value
+    failures = [RuntimeError('Disk full')] * 3
+    writer = WriteBehindQueue(persist, retries=2, backoff=0.01)
+    writer.put(('127.0.0.1', 0), b'', datetime.utcnow())
+    writer.close()
+    assert len(saved) == 1
+    assert metrics.persist_failed.value == failed + 1